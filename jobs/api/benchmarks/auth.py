@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Mede quantas requisições por segundo a API aguenta com logins e consultas
+autenticadas acontecendo ao mesmo tempo. Roda contra uma API já no ar:
+
+	python benchmarks/auth.py --url http://localhost:5000 --username ... --password ...
+
+Com logins travando o event loop, as consultas ficam lentas junto com eles;
+o que importa aqui é a vazão e a latência das consultas enquanto há logins
+acontecendo.
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def request(url: str, data: bytes = None, headers: dict = None) -> int:
+	req = urllib.request.Request(url, data=data, headers=headers or dict())
+	try:
+		with urllib.request.urlopen(req, timeout=60) as response:
+			response.read()
+			return response.status
+	except urllib.error.HTTPError as e:
+		return e.code
+
+
+def login(base_url: str, username: str, password: str) -> int:
+	data = urllib.parse.urlencode({ "username": username, "password": password }).encode("utf-8")
+	return request(f"{base_url}/token", data=data)
+
+
+def get_token(base_url: str, username: str, password: str) -> str:
+	data = urllib.parse.urlencode({ "username": username, "password": password }).encode("utf-8")
+	with urllib.request.urlopen(f"{base_url}/token", data=data, timeout=60) as response:
+		return json.load(response)["access_token"]
+
+
+def check(base_url: str, token: str) -> int:
+	return request(
+		f"{base_url}/check/benchmark",
+		headers={ "Authorization": f"Bearer {token}" }
+	)
+
+
+def run(label: str, function, count: int, concurrency: int) -> dict:
+	latencies = []
+	statuses = dict()
+	lock = threading.Lock()
+
+	def timed(_):
+		start = time.perf_counter()
+		status = function()
+		elapsed = time.perf_counter() - start
+		with lock:
+			latencies.append(elapsed)
+			statuses[status] = statuses.get(status, 0) + 1
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		list(executor.map(timed, range(count)))
+	total = time.perf_counter() - start
+
+	latencies.sort()
+	return {
+		"label": label,
+		"requests": count,
+		"seconds": round(total, 2),
+		"requests_per_sec": round(count / total, 1),
+		"p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+		"p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+		"statuses": statuses,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--url", default="http://localhost:5000")
+	parser.add_argument("--username", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--logins", type=int, default=50)
+	parser.add_argument("--checks", type=int, default=1000)
+	parser.add_argument("--concurrency", type=int, default=16)
+	args = parser.parse_args()
+
+	base_url = args.url.rstrip("/")
+	token = get_token(base_url, args.username, args.password)
+
+	results = [
+		run("checks", lambda: check(base_url, token), args.checks, args.concurrency)
+	]
+
+	# Logins e consultas ao mesmo tempo
+	concurrent = dict()
+	login_thread = threading.Thread(target=lambda: concurrent.update(
+		logins=run("logins (concurrent)", lambda: login(base_url, args.username, args.password), args.logins, args.concurrency)
+	))
+	login_thread.start()
+	results.append(
+		run("checks (during logins)", lambda: check(base_url, token), args.checks, args.concurrency)
+	)
+	login_thread.join()
+	results.append(concurrent["logins"])
+
+	for result in results:
+		print(json.dumps(result))
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import fnmatch
+import threading
+
+from loguru import logger
+
+
+DATA_PATH = "/data"
+# Por quanto tempo uma listagem do volume é reaproveitada; no meio de uma
+# exportação há milhares de arquivos, e varrer tudo a cada chamada é caro
+LIST_CACHE_TTL = 5
+# Remoções terminadas são esquecidas depois de um tempo
+FINISHED_CLEAR_TTL = 24 * 60 * 60
+# O que a limpeza do volume não apaga: o cache de exportações (que se limita
+# sozinho, por EXPORT_CACHE_MAX_MB) e os manifestos das séries delta, sem os
+# quais a próxima exportação de cada série teria que escrever tudo de novo
+CLEAR_KEEP = ( "cache", "delta" )
+
+
+def scan(path: str, max_depth: int = None, pattern: str = None) -> tuple:
+	"""Lista as pastas dentro de `path` (ela inclusa) e os arquivos dentro delas,
+	como (pasta, nome, tamanho), descendo no máximo `max_depth` níveis (None =
+	sem limite). Com `pattern`, só os arquivos cujo nome bate com o glob (ex.:
+	'*.csv')"""
+	directories = []
+	files = []
+	# (pasta, profundidade)
+	pending = [ (path, 0) ]
+	while pending:
+		(directory, depth) = pending.pop()
+		try:
+			entries = list(os.scandir(directory))
+		except (FileNotFoundError, NotADirectoryError, PermissionError):
+			# Pode ter sido apagada no meio da varredura
+			continue
+		directories.append(directory)
+		for entry in entries:
+			try:
+				if entry.is_dir(follow_symlinks=False):
+					if max_depth is None or depth < max_depth:
+						pending.append((entry.path, depth + 1))
+					continue
+				if pattern and not fnmatch.fnmatch(entry.name, pattern):
+					continue
+				# `scandir` já traz o stat na maioria dos sistemas
+				size = entry.stat(follow_symlinks=False).st_size
+			except FileNotFoundError:
+				continue
+			files.append((directory, entry.name, size))
+	directories.sort()
+	files.sort()
+	return (directories, files)
+
+
+# (profundidade, glob) => (quando, (pastas, arquivos))
+list_cache = dict()
+list_cache_lock = threading.Lock()
+
+def list_files(max_depth: int = None, pattern: str = None) -> tuple:
+	key = (max_depth, pattern)
+	with list_cache_lock:
+		cached = list_cache.get(key)
+	if cached is not None and time.time() - cached[0] < LIST_CACHE_TTL:
+		return cached[1]
+	listing = scan(DATA_PATH, max_depth, pattern)
+	with list_cache_lock:
+		list_cache[key] = (time.time(), listing)
+	return listing
+
+
+def invalidate_list_cache():
+	with list_cache_lock:
+		list_cache.clear()
+
+
+class ClearJob:
+	"""Remoção do conteúdo do volume, rodando em segundo plano"""
+
+	def __init__(self):
+		self.id = uuid.uuid4().hex
+		self.status = "running"
+		self.total = 0
+		self.removed = 0
+		self.skipped = []
+		self.errors = []
+		self.started_at = time.time()
+		self.finished_at = None
+
+	def to_dict(self) -> dict:
+		return {
+			"id": self.id,
+			"status": self.status,
+			"total": self.total,
+			"removed": self.removed,
+			"skipped": self.skipped,
+			"errors": self.errors,
+			"started_at": self.started_at,
+			"finished_at": self.finished_at,
+		}
+
+	def run(self):
+		try:
+			# Os locks das pastas das exportações são tratados junto com elas
+			items = [
+				item for item in os.scandir(DATA_PATH)
+				if item.name not in CLEAR_KEEP and not item.name.endswith(".lock")
+			]
+			self.total = len(items)
+			for item in items:
+				try:
+					if not remove_unless_in_use(item.path):
+						logger.info(f"Skipping '{item.path}', in use by an export")
+						self.skipped.append(item.name)
+						continue
+					self.removed += 1
+				except FileNotFoundError:
+					self.removed += 1
+				except Exception as e:
+					logger.warning(f"Failed to remove '{item.path}': {e!r}")
+					self.errors.append(f"{item.name}: {e!r}")
+			self.remove_orphan_locks()
+			self.status = "done" if not self.errors else "failed"
+		except Exception as e:
+			logger.error(f"Failed to clear '{DATA_PATH}': {e!r}")
+			self.errors.append(repr(e))
+			self.status = "failed"
+		finally:
+			self.finished_at = time.time()
+			invalidate_list_cache()
+
+	def remove_orphan_locks(self):
+		"""Apaga os locks cujas pastas não existem mais, se ninguém os tiver"""
+		for item in os.scandir(DATA_PATH):
+			path = item.path[:-len(".lock")]
+			if item.name.endswith(".lock") and not os.path.exists(path):
+				try:
+					remove_unless_in_use(path)
+				except Exception as e:
+					logger.warning(f"Failed to remove '{item.path}': {e!r}")
+
+
+def remove_unless_in_use(path: str) -> bool:
+	"""Apaga `path` do volume, a não ser que seja a pasta de uma exportação em
+	andamento: o worker trava '<pasta>.lock' (`flock`) enquanto usa a pasta.
+	O lock fica com a gente até a pasta e ele serem apagados, então nenhuma task
+	começa a usá-la no meio (a que estiver esperando vê que o arquivo sumiu e
+	cria outro). Retorna se apagou"""
+	lock_path = f"{path}.lock"
+	with open(lock_path, "a") as lock:
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return False
+		if os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path)
+		elif os.path.lexists(path):
+			os.remove(path)
+		os.remove(lock_path)
+	return True
+
+
+clear_jobs = dict()
+clear_jobs_lock = threading.Lock()
+
+def start_clear() -> ClearJob:
+	"""Começa a limpar o volume; se já houver uma limpeza em andamento,
+	retorna ela em vez de começar outra"""
+	with clear_jobs_lock:
+		now = time.time()
+		for (job_id, job) in list(clear_jobs.items()):
+			if job.status == "running":
+				return job
+			if job.finished_at and now - job.finished_at > FINISHED_CLEAR_TTL:
+				del clear_jobs[job_id]
+		job = ClearJob()
+		clear_jobs[job.id] = job
+	threading.Thread(target=job.run, daemon=True).start()
+	return job
+
+
+def get_clear(job_id: str):
+	with clear_jobs_lock:
+		return clear_jobs.get(job_id)
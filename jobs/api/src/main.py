@@ -1,46 +1,119 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import shutil
-from typing import Annotated
-from fastapi.responses import JSONResponse
+import time
+import threading
+from typing import Annotated, Any, Literal
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
-from celery import Celery
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
 from loguru import logger
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 import auth  # ./auth.py
+import files  # ./files.py
+import startup  # ./startup.py
+import tasks  # ./tasks.py
 import utils  # ./utils.py
 from constants import constants as const  # ./constants.py
 
-from passlib.context import CryptContext
 
-
-auth.inject_environment_variables(environment=os.environ.get("ENVIRONMENT", "dev"))
-auth.prepare_gcp_credentials()
+STARTUP = startup.StartupTimer("api")
+with STARTUP.step("secrets"):
+	STARTUP.details["secrets_source"] = auth.inject_environment_variables(
+		environment=os.environ.get("ENVIRONMENT", "dev")
+	)
+with STARTUP.step("gcp_credentials"):
+	auth.prepare_gcp_credentials()
 
 USERNAME = auth.getenv_or_action("GDB_EXPORT_USERNAME", action="raise")
 PASSWORD = auth.getenv_or_action("GDB_EXPORT_PW_HASH", action="raise")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Senhas erradas contam por IP e usuário: quem erra demais é bloqueado sem
+# afetar o mesmo usuário em outros IPs. Como um atacante pode ter vários IPs,
+# cada usuário também tem um limite bem mais alto somando todos eles
+login_throttle = auth.LoginThrottle(max_failures=5)
+user_throttle = auth.LoginThrottle(max_failures=50)
+
+# Celery e passlib só são importados quando usados pela primeira vez, para não
+# atrasar a subida do servidor
+celery_app = None
+pwd_context = None
+lazy_lock = threading.Lock()
+
+def get_celery_app():
+	global celery_app
+	with lazy_lock:
+		if celery_app is not None:
+			return celery_app
+		start = time.perf_counter()
+		from celery import Celery
+		celery_app = Celery(
+			"celery",
+			backend=os.environ.get("REDIS_SERVER"),
+			broker=os.environ.get("REDIS_SERVER"),
+		)
+		logger.info(f"Loaded Celery in {time.perf_counter() - start:.2f}s")
+		return celery_app
+
+
+def get_pwd_context():
+	global pwd_context
+	with lazy_lock:
+		if pwd_context is None:
+			from passlib.context import CryptContext
+			pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+		return pwd_context
 
-celery_app = Celery(
-	"celery",
-	backend=os.environ.get("REDIS_SERVER"),
-	broker=os.environ.get("REDIS_SERVER"),
-)
 
 app = FastAPI()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
+REQUEST_SECONDS = Histogram(
+	"gdb_export_api_request_seconds",
+	"Quanto tempo a API levou para responder, por rota e status",
+	("method", "route", "status")
+)
+EXPORTS_REQUESTED = Counter(
+	"gdb_export_api_exports_requested_total",
+	"Exportações enviadas para a fila"
+)
+
+@app.on_event("startup")
+def report_startup():
+	STARTUP.report()
+
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+	start = time.perf_counter()
+	response = await call_next(request)
+	# O caminho da rota ('/check/{id}'), e não o da requisição, para que cada
+	# ID não vire uma série diferente
+	route = request.scope.get("route")
+	REQUEST_SECONDS.labels(
+		method=request.method,
+		route=route.path if route is not None else "unmatched",
+		status=response.status_code
+	).observe(time.perf_counter() - start)
+	return response
+
+
+@app.get("/metrics")
+def get_metrics():
+	# Sem autenticação, como é comum para o Prometheus; só há contagens e
+	# tempos agregados aqui, nada sobre os arquivos exportados
+	return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 
 #############################
 
 @app.post("/token")
 async def authenticate(
+	request: Request,
 	form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ):
 	username = form_data.username or None
@@ -48,8 +121,44 @@ async def authenticate(
 
 	# [Ref] https://oauth.com/oauth2-servers/access-tokens/access-token-response/
 
-	correct_password = pwd_context.verify(password, PASSWORD)
+	# O IP é o que o uvicorn diz: o do X-Forwarded-For só quando a requisição
+	# vem de um proxy listado em FORWARDED_ALLOW_IPS, e o da conexão nos outros
+	# casos, então o cliente não consegue forjá-lo
+	client = request.client.host if request.client else "unknown"
+	throttle_key = f"{client}|{username or ''}"
+	retry_after = max(
+		login_throttle.retry_after(throttle_key),
+		user_throttle.retry_after(username or "")
+	)
+	if retry_after > 0:
+		state = "Too many failed login attempts"
+		logger.warning(f"{state} for user '{username}' (request from '{client}')")
+		return JSONResponse(
+			status_code=429,
+			headers={ "Cache-Control": "no-store", "Retry-After": str(retry_after) },
+			content={
+				"status": "ERROR",
+				"error": "too_many_requests",
+				"error_description": state,
+			},
+		)
+
+	correct_password = await auth.verify_password(get_pwd_context(), password, PASSWORD)
+	if correct_password is None:
+		state = "Too many logins in progress"
+		logger.warning(state)
+		return JSONResponse(
+			status_code=503,
+			headers={ "Cache-Control": "no-store", "Retry-After": "1" },
+			content={
+				"status": "ERROR",
+				"error": "temporarily_unavailable",
+				"error_description": state,
+			},
+		)
 	if username != USERNAME or not correct_password:
+		login_throttle.record_failure(throttle_key)
+		user_throttle.record_failure(username or "")
 		state = "Invalid username/password"
 		logger.warning(state)
 		return JSONResponse(
@@ -62,6 +171,7 @@ async def authenticate(
 			},
 		)
 
+	login_throttle.reset(throttle_key)
 	access_token = auth.create_access_token({ "sub": username })
 	return JSONResponse(
 		status_code=200,
@@ -77,44 +187,98 @@ async def authenticate(
 	)
 
 
+# Handlers síncronos (`def`) rodam no threadpool do FastAPI, então varrer ou
+# apagar o volume não trava as outras requisições
 @app.get("/list/")
-async def list_files(token: Annotated[str, Depends(oauth2_scheme)]):
+def list_files(
+	token: Annotated[str, Depends(oauth2_scheme)],
+	page: int = None,
+	page_size: int = 500,
+	depth: int = None,
+	glob: str = None,
+):
 	# Decodifica token; como não estamos usando contas individuais,
 	# é suficiente só conferir se não vai dar algum erro
 	payload = auth.decode_token(token)
 	logger.debug(payload)
 
-	out = dict()
-	for root, _, files in os.walk("/data"):
-		out[root] = [
-			(
-				filename,
-				utils.format_bytes(
-					os.path.getsize(os.path.join(root, filename))
-				)
+	(all_directories, all_files) = files.list_files(max_depth=depth, pattern=glob)
+
+	# Sem `page`, a resposta de sempre: { pasta: [ (arquivo, tamanho), ... ] },
+	# com todas as pastas e todos os arquivos
+	if page is None:
+		out = { root: [] for root in all_directories }
+		for (root, filename, size) in all_files:
+			out.setdefault(root, []).append(
+				(filename, utils.format_bytes(size))
 			)
-			for filename in files
-		]
-	return out
+		return out
+
+	page = max(page, 1)
+	page_size = min(max(page_size, 1), 5000)
+	start = (page - 1) * page_size
+
+	out = dict()
+	for (root, filename, size) in all_files[start:start + page_size]:
+		out.setdefault(root, []).append(
+			(filename, utils.format_bytes(size))
+		)
+	return {
+		"page": page,
+		"page_size": page_size,
+		"total": len(all_files),
+		"files": out,
+	}
 
 
 @app.get("/clear/")
-async def list_files(token: Annotated[str, Depends(oauth2_scheme)]):
+def clear_files(token: Annotated[str, Depends(oauth2_scheme)]):
 	payload = auth.decode_token(token)
 	logger.debug(payload)
 
-	PATH = "/data"
-	for item in os.listdir(PATH):
-		item_path = os.path.join(PATH, item)
-		if os.path.isfile(item_path):
-			os.remove(item_path)
-		elif os.path.isdir(item_path):
-			shutil.rmtree(item_path)
-	return os.listdir("/data")
+	job = files.start_clear()
+	return { "success": True, "id": job.id }
 
 
+@app.get("/clear/{id}")
+def check_clear(
+	token: Annotated[str, Depends(oauth2_scheme)],
+	id: str,
+):
+	payload = auth.decode_token(token)
+	logger.debug(payload)
+
+	job = files.get_clear(id)
+	if job is None:
+		return JSONResponse(
+			status_code=404,
+			content={ "success": False, "error": f"Unknown clear job '{id}'" },
+		)
+	return job.to_dict()
+
+
+class TableCondition(BaseModel):
+	column: str
+	op: Literal["=", "<>", "<", "<=", ">", ">=", "in", "is null", "is not null"]
+	# Um valor; uma lista, para 'in'; nada, para 'is null' e 'is not null'.
+	# Datas e horários vão como texto (ex.: '2024-01-31 08:00:00')
+	value: Any = None
+
+class TableSelection(BaseModel):
+	# Colunas a exportar; vazio exporta todas
+	columns: list[str] = []
+	# Condições que as linhas exportadas devem cumprir, todas ao mesmo tempo.
+	# Os valores vão para o Firebird como parâmetros da consulta
+	where: list[TableCondition] = []
+
 class ExportRequest(BaseModel):
 	gcs_uri: str
+	# Nome da série de backups (ex.: 'vitacare-ap10'); se dado, só exporta o
+	# que mudou desde a última exportação da mesma série
+	delta: str = ""
+	# Tabelas a exportar e o que exportar de cada uma; vazio exporta todas as
+	# tabelas inteiras
+	tables: dict[str, TableSelection] = {}
 
 @app.post("/export/")
 async def request_export(
@@ -125,9 +289,19 @@ async def request_export(
 	logger.debug(payload)
 
 	try:
-		task = celery_app.send_task("export.task", args=[req.gcs_uri])
+		task = get_celery_app().send_task(
+			"export.task",
+			args=[req.gcs_uri],
+			# Para o worker medir quanto tempo a task esperou na fila
+			kwargs={
+				"delta": req.delta,
+				"requested_at": time.time(),
+				"tables": jsonable_encoder(req.tables)
+			}
+		)
 	except Exception as e:
 		return { "success": False, "error": repr(e) }
+	EXPORTS_REQUESTED.inc()
 	return { "success": True, "id": task.id }
 
 
@@ -139,7 +313,7 @@ def dummy_task(
 	logger.debug(payload)
 
 	try:
-		task = celery_app.send_task("dummy.task")
+		task = get_celery_app().send_task("dummy.task")
 	except Exception as e:
 		return { "success": False, "error": repr(e) }
 	return { "success": True, "id": task.id }
@@ -153,25 +327,43 @@ def check_task(
 	payload = auth.decode_token(token)
 	logger.debug(payload)
 
-	task = celery_app.AsyncResult(id)
-	if task.state == "SUCCESS":
-		response = {
-			"status": task.state,
-			"result": task.result,
-			"task_id": id,
-		}
-	elif task.state == "FAILURE":
-		response = json.loads(
-			task.backend.get(
-				task.backend.get_key_for_task(task.id),
-			).decode("utf-8")
-		)
-		del response["children"]
-		del response["traceback"]
-	else:
-		response = {
-			"status": task.state,
-			"result": task.info,
-			"task_id": id,
-		}
-	return response
+	return tasks.get_task_states(get_celery_app().backend, [id])[0]
+
+
+@app.get("/check/")
+def check_tasks(
+	token: Annotated[str, Depends(oauth2_scheme)],
+	ids: str,
+):
+	payload = auth.decode_token(token)
+	logger.debug(payload)
+
+	# Vários IDs separados por vírgula, resolvidos numa só ida ao Redis
+	try:
+		task_ids = tasks.parse_task_ids(ids)
+	except ValueError as e:
+		return JSONResponse(status_code=400, content={ "success": False, "error": str(e) })
+	return tasks.get_task_states(get_celery_app().backend, task_ids)
+
+
+@app.get("/stream/")
+async def stream_tasks(
+	token: Annotated[str, Depends(oauth2_scheme)],
+	ids: str,
+):
+	payload = auth.decode_token(token)
+	logger.debug(payload)
+
+	try:
+		task_ids = tasks.parse_task_ids(ids)
+	except ValueError as e:
+		return JSONResponse(status_code=400, content={ "success": False, "error": str(e) })
+	return StreamingResponse(
+		tasks.stream_task_states(
+			get_celery_app().backend,
+			os.environ.get("REDIS_SERVER"),
+			task_ids
+		),
+		media_type="text/event-stream",
+		headers={ "Cache-Control": "no-store" },
+	)
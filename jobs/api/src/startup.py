@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import contextlib
+
+from loguru import logger
+
+
+# Onde o relatório da última inicialização é guardado, para comparação
+STARTUP_REPORT_PATH = os.environ.get("STARTUP_REPORT_PATH", "/tmp/startup-{service}.json")
+
+
+def get_process_uptime():
+	"""Há quantos segundos o processo começou (incluindo o próprio Python e os
+	imports que vieram antes deste módulo). None fora do Linux"""
+	try:
+		with open("/proc/uptime", "r") as f:
+			system_uptime = float(f.read().split()[0])
+		with open("/proc/self/stat", "r") as f:
+			# O nome do processo pode ter espaços; os campos vêm depois do ')'
+			fields = f.read().rsplit(")", maxsplit=1)[1].split()
+		# 'starttime' é o 22º campo, em ticks desde o boot
+		# [Ref] https://man7.org/linux/man-pages/man5/proc_pid_stat.5.html
+		started_at = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+		return system_uptime - started_at
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+class StartupTimer:
+	"""Mede quanto tempo leva cada etapa da inicialização do serviço e registra
+	um relatório no final, para que regressões no cold start fiquem visíveis"""
+
+	def __init__(self, service: str):
+		self.service = service
+		self.steps = []
+		self.details = dict()
+
+	@contextlib.contextmanager
+	def step(self, name: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.steps.append((name, time.perf_counter() - start))
+
+	def report(self) -> dict:
+		uptime = get_process_uptime()
+		report = {
+			"service": self.service,
+			"at": time.time(),
+			"total_seconds": round(uptime, 3) if uptime is not None else None,
+			"steps": { name: round(seconds, 3) for (name, seconds) in self.steps },
+			**self.details,
+		}
+		logger.info(
+			f"Started {self.service} in "
+			+ (f"{uptime:.2f}s" if uptime is not None else "?s")
+			+ "".join(f"; {name}: {seconds:.2f}s" for (name, seconds) in self.steps)
+		)
+		try:
+			with open(STARTUP_REPORT_PATH.format(service=self.service), "w", encoding="utf-8") as f:
+				json.dump(report, f)
+		except OSError as e:
+			logger.warning(f"Failed to write startup report: {e!r}")
+		return report
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import redis.asyncio
+from fastapi.concurrency import run_in_threadpool
+
+
+# Estados depois dos quais a task não muda mais
+READY_STATES = { "SUCCESS", "FAILURE", "REVOKED" }
+# Conexões paradas por muito tempo podem ser derrubadas por proxies no meio
+# do caminho; mandamos um comentário de tempos em tempos para mantê-las vivas
+STREAM_HEARTBEAT = 15
+# Limite de IDs por chamada, para ninguém pedir o Redis inteiro de uma vez
+MAX_TASK_IDS = 1000
+
+
+def parse_task_ids(ids: str) -> list:
+	"""Transforma 'a,b,c' em ['a', 'b', 'c'], sem repetições"""
+	task_ids = []
+	for task_id in ids.split(","):
+		task_id = task_id.strip()
+		if task_id and task_id not in task_ids:
+			task_ids.append(task_id)
+	if len(task_ids) > MAX_TASK_IDS:
+		raise ValueError(f"At most {MAX_TASK_IDS} task IDs per request; got {len(task_ids)}")
+	return task_ids
+
+
+def format_task_meta(task_id: str, meta: dict) -> dict:
+	"""Formata os metadados da task guardados pelo Celery como a resposta de
+	`/check/{id}`"""
+	# Task que não existe (ou ainda não começou) não tem nada guardado
+	if meta is None:
+		return { "status": "PENDING", "result": None, "task_id": task_id }
+	if meta["status"] == "FAILURE":
+		response = dict(meta)
+		response.pop("children", None)
+		response.pop("traceback", None)
+		return response
+	return {
+		"status": meta["status"],
+		"result": meta.get("result"),
+		"task_id": task_id,
+	}
+
+
+def get_task_states(backend, task_ids: list) -> list:
+	"""Busca o estado de todas as tasks com um único MGET no Redis"""
+	if not task_ids:
+		return []
+	keys = [ backend.get_key_for_task(task_id) for task_id in task_ids ]
+	values = backend.mget(keys)
+	return [
+		format_task_meta(
+			task_id,
+			backend.decode(value) if value is not None else None
+		)
+		for (task_id, value) in zip(task_ids, values)
+	]
+
+
+def format_event(state: dict) -> str:
+	# [Ref] https://html.spec.whatwg.org/multipage/server-sent-events.html
+	return f"event: state\ndata: {json.dumps(state, default=str)}\n\n"
+
+
+redis_client = None
+
+def get_redis_client(redis_url: str):
+	# Criado na primeira vez, dentro do event loop do servidor
+	global redis_client
+	if redis_client is None:
+		redis_client = redis.asyncio.from_url(redis_url)
+	return redis_client
+
+
+async def stream_task_states(backend, redis_url: str, task_ids: list):
+	"""Gera eventos SSE com o estado atual de cada task e, depois, com cada
+	mudança de estado, até todas terminarem. O Celery publica os metadados no
+	canal de mesmo nome da chave sempre que o estado de uma task muda, então
+	não precisamos ficar consultando o Redis"""
+	channels = {
+		backend.get_key_for_task(task_id).decode("utf-8"): task_id
+		for task_id in task_ids
+	}
+	pubsub = get_redis_client(redis_url).pubsub()
+	# Inscrevemos antes de ler o estado atual, para não perder nenhuma mudança
+	# que aconteça entre uma coisa e outra
+	await pubsub.subscribe(*channels.keys())
+	try:
+		pending = set()
+		states = await run_in_threadpool(get_task_states, backend, task_ids)
+		for state in states:
+			yield format_event(state)
+			if state["status"] not in READY_STATES:
+				pending.add(state["task_id"])
+
+		last_sent = time.monotonic()
+		while pending:
+			message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+			if message is None:
+				if time.monotonic() - last_sent > STREAM_HEARTBEAT:
+					yield ": keep-alive\n\n"
+					last_sent = time.monotonic()
+				continue
+			task_id = channels.get(message["channel"].decode("utf-8"))
+			if task_id is None:
+				continue
+			state = format_task_meta(task_id, backend.decode(message["data"]))
+			yield format_event(state)
+			last_sent = time.monotonic()
+			if state["status"] in READY_STATES:
+				pending.discard(task_id)
+	finally:
+		await pubsub.unsubscribe()
+		await pubsub.close()
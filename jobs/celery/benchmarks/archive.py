@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Compara codecs e níveis de compressão do passo (3) das exportações (gerar
+o .ZIP) numa pasta de resultados, para escolher `ARCHIVE_CODEC` e
+`ARCHIVE_LEVEL` pesando tamanho do arquivo contra tempo:
+
+	python benchmarks/archive.py /data/<id da task>/csv
+	python benchmarks/archive.py --generate-mb 500 --codecs deflate:1,deflate:6,zstd:3
+
+Sem uma pasta, gera CSVs sintéticos. A primeira linha é o
+`shutil.make_archive()` de antes, como referência.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import archive  # ../src/archive.py
+
+
+def generate_csvs(directory: str, megabytes: int):
+	"""Algumas tabelas de tamanhos bem diferentes, como num backup de verdade"""
+	random.seed(0)
+	values = [ "Atenção à saúde", "São Sebastião", "Méier", "", "123456", "4.50", "2020-01-01 08:00:00" ]
+	sizes = [ 0.6, 0.25, 0.1, 0.05 ]
+	for (i, share) in enumerate(sizes):
+		target = int(megabytes * share * 1024 * 1024)
+		with open(os.path.join(directory, f"TABELA_{i}.csv"), "w", encoding="utf-8") as f:
+			written = 0
+			while written < target:
+				line = ",".join(random.choice(values) for _ in range(10)) + f",{written}\n"
+				written += f.write(line)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("directory", nargs="?", help="Pasta com os arquivos a comprimir")
+	parser.add_argument("--generate-mb", type=int, default=200,
+		help="Tamanho dos CSVs sintéticos, se não houver pasta")
+	parser.add_argument("--codecs", default="deflate:1,deflate:6,deflate:9,gzip:6,zstd:3,zstd:9,store",
+		help="Lista de codec[:nível]")
+	parser.add_argument("--threads", type=int, default=archive.ARCHIVE_THREADS)
+	args = parser.parse_args()
+
+	workspace = tempfile.mkdtemp(prefix="archive-bench-")
+	try:
+		directory = args.directory
+		if directory is None:
+			directory = os.path.join(workspace, "csv")
+			os.makedirs(directory)
+			generate_csvs(directory, args.generate_mb)
+		zip_path = os.path.join(workspace, "out.zip")
+
+		print(f"{'codec':<14}{'threads':>8}{'seconds':>10}{'MB/s':>10}{'MB':>10}{'ratio':>8}")
+		start = time.perf_counter()
+		shutil.make_archive(zip_path[:-len(".zip")], format="zip", root_dir=directory)
+		seconds = time.perf_counter() - start
+		input_bytes = sum(
+			os.path.getsize(os.path.join(root, filename))
+			for (root, _, filenames) in os.walk(directory)
+			for filename in filenames
+		)
+		output_bytes = os.path.getsize(zip_path)
+		print(
+			f"{'make_archive':<14}{1:>8}{seconds:>10.2f}{input_bytes / seconds / 1024 / 1024:>10.1f}"
+			f"{output_bytes / 1024 / 1024:>10.1f}{input_bytes / output_bytes:>8.2f}"
+		)
+
+		for spec in args.codecs.split(","):
+			(codec, _, level) = spec.partition(":")
+			stats = archive.create_archive(directory, zip_path, codec=codec, level=level or None, threads=args.threads)
+			print(
+				f"{stats['codec']:<14}{stats['threads']:>8}{stats['seconds']:>10.2f}{stats['mb_per_sec']:>10.1f}"
+				f"{stats['output_bytes'] / 1024 / 1024:>10.1f}{stats['ratio']:>8.2f}"
+			)
+	finally:
+		shutil.rmtree(workspace)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
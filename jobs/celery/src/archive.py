@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""Gera o .ZIP final a partir da pasta de resultados, comprimindo em paralelo.
+
+Cada arquivo é dividido em blocos de `ARCHIVE_BLOCK_MB`, e os blocos são
+comprimidos em várias threads ao mesmo tempo (zlib e pyarrow liberam o GIL
+enquanto comprimem); uma tabela grande usa todos os núcleos, e não só um. Os
+blocos comprimidos são escritos no .ZIP na ordem, como entradas normais, que
+qualquer descompactador lê.
+
+Codecs (`ARCHIVE_CODEC`):
+* 'deflate' (padrão): entradas .csv comuns. Cada bloco é um trecho do mesmo
+  stream deflate, e usa os últimos 32 KiB do bloco anterior como dicionário,
+  como o pigz faz; a compressão fica praticamente igual à de um stream só
+* 'gzip': cada tabela vira uma entrada '<tabela>.csv.gz' (um membro gzip por
+  bloco, o que o gzip/gunzip lê normalmente), guardada sem recompressão
+* 'zstd': cada tabela vira '<tabela>.csv.zst' (um frame por bloco)
+* 'store': sem compressão
+
+Arquivos que já estão comprimidos (.parquet, .gz, .zip, ...) entram no .ZIP
+como estão.
+"""
+import os
+import time
+import zlib
+import zipfile
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+# Nível padrão de cada codec; `ARCHIVE_LEVEL` sobrescreve
+CODECS = {
+	"store": None,
+	"deflate": 6,
+	"gzip": 6,
+	"zstd": 3,
+}
+# Codecs que geram um arquivo comprimido por tabela, guardado no .ZIP como está
+ENTRY_SUFFIXES = {
+	"gzip": ".gz",
+	"zstd": ".zst",
+}
+ARCHIVE_CODEC = os.environ.get("ARCHIVE_CODEC", "deflate")
+ARCHIVE_LEVEL = os.environ.get("ARCHIVE_LEVEL")
+ARCHIVE_THREADS = max(int(os.environ.get("ARCHIVE_THREADS", "0")) or os.cpu_count() or 1, 1)
+ARCHIVE_BLOCK_MB = max(int(os.environ.get("ARCHIVE_BLOCK_MB", "8")), 1)
+
+# Janela do deflate; é o tanto do bloco anterior que serve de dicionário
+DEFLATE_WINDOW = 32 * 1024
+
+# Recomprimir esses só gasta tempo
+COMPRESSED_EXTENSIONS = {
+	".7z", ".bz2", ".gz", ".jpeg", ".jpg", ".parquet", ".png", ".xz", ".zip", ".zst",
+}
+# gzip, zstd, zip, bzip2, xz, parquet
+COMPRESSED_MAGIC_NUMBERS = (
+	b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"PK\x03\x04", b"BZh", b"\xfd7zXZ\x00", b"PAR1",
+)
+
+
+def get_codec(codec: str = ARCHIVE_CODEC, level=ARCHIVE_LEVEL) -> tuple:
+	"""Valida o codec e retorna (codec, nível)"""
+	if codec not in CODECS:
+		raise ValueError(f"Unknown archive codec '{codec}'; choose from {', '.join(CODECS)}")
+	if codec == "store":
+		return (codec, None)
+	if level is None or level == "":
+		return (codec, CODECS[codec])
+	return (codec, int(level))
+
+
+def get_codec_label(codec: str = ARCHIVE_CODEC, level=ARCHIVE_LEVEL) -> str:
+	"""ex.: 'deflate-6'; identifica o formato do resultado (para o cache)"""
+	(codec, level) = get_codec(codec, level)
+	return codec if level is None else f"{codec}-{level}"
+
+
+def is_compressed(path: str) -> bool:
+	if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+		return True
+	with open(path, "rb") as f:
+		head = f.read(8)
+	return any(head.startswith(magic) for magic in COMPRESSED_MAGIC_NUMBERS)
+
+
+################################################################################
+# CRC32 de blocos comprimidos em paralelo
+#
+# O .ZIP guarda o CRC32 de cada entrada inteira; cada thread calcula o do seu
+# bloco, e juntamos os CRCs em ordem: crc(A + B) = crc(A) deslocado por len(B)
+# bytes, XOR crc(B). O deslocamento é uma matriz 32x32 sobre GF(2), a mesma
+# conta do `crc32_combine()` do zlib.
+# [Ref] https://github.com/madler/zlib/blob/v1.3.1/crc32.c
+
+def gf2_matrix_times(matrix: list, vector: int) -> int:
+	total = 0
+	i = 0
+	while vector:
+		if vector & 1:
+			total ^= matrix[i]
+		vector >>= 1
+		i += 1
+	return total
+
+
+def gf2_matrix_multiply(a: list, b: list) -> list:
+	return [ gf2_matrix_times(a, column) for column in b ]
+
+
+@functools.lru_cache(maxsize=32)
+def crc32_zeros_operator(length: int) -> list:
+	"""Matriz que leva o CRC de uma sequência ao CRC dela seguida de `length`
+	bytes zero. Quase todos os blocos têm o mesmo tamanho, então o cache
+	resolve quase todas as chamadas"""
+	# Um bit zero: o polinômio (refletido) e um deslocamento
+	operator = [ 0xedb88320 ] + [ 1 << n for n in range(31) ]
+	# Um byte zero = oito bits zero
+	for _ in range(3):
+		operator = gf2_matrix_multiply(operator, operator)
+	result = None
+	while length:
+		if length & 1:
+			result = operator if result is None else gf2_matrix_multiply(operator, result)
+		length >>= 1
+		if length:
+			operator = gf2_matrix_multiply(operator, operator)
+	return result
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+	"""CRC32 de A + B, dados crc(A), crc(B) e len(B)"""
+	if length2 <= 0:
+		return crc1
+	return gf2_matrix_times(crc32_zeros_operator(length2), crc1) ^ crc2
+
+
+################################################################################
+
+class Entry:
+	"""Um arquivo da pasta, e o que já foi escrito dele no .ZIP"""
+
+	def __init__(self, path: str, name: str, codec: str):
+		self.path = path
+		self.size = os.path.getsize(path)
+		self.codec = codec
+		self.name = name + ENTRY_SUFFIXES.get(codec, "")
+		self.info = None
+		self.crc = 0
+		self.file_size = 0
+		self.zip64 = False
+
+
+def list_entries(source_dir: str, codec: str) -> list:
+	entries = []
+	for (root, dirs, filenames) in os.walk(source_dir):
+		dirs.sort()
+		for filename in sorted(filenames):
+			path = os.path.join(root, filename)
+			name = os.path.relpath(path, source_dir).replace(os.sep, "/")
+			entries.append(Entry(path, name, "store" if is_compressed(path) else codec))
+	return entries
+
+
+def iter_blocks(entries: list, block_size: int):
+	"""(entrada, início, tamanho, é o último?) de cada bloco, na ordem em que vão
+	para o .ZIP; arquivos vazios têm um bloco vazio"""
+	for entry in entries:
+		offset = 0
+		while True:
+			length = min(block_size, entry.size - offset)
+			last = offset + length >= entry.size
+			yield (entry, offset, length, last)
+			if last:
+				break
+			offset += length
+
+
+def compress_block(entry: Entry, offset: int, length: int, last: bool, level) -> tuple:
+	"""Retorna (dados para o .ZIP, CRC32 e tamanho do conteúdo da entrada)"""
+	with open(entry.path, "rb") as f:
+		if entry.codec == "deflate" and offset > 0:
+			f.seek(max(offset - DEFLATE_WINDOW, 0))
+			zdict = f.read(offset - f.tell())
+		else:
+			f.seek(offset)
+			zdict = None
+		data = f.read(length)
+
+	if entry.codec == "deflate":
+		compressor = (
+			zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+			if zdict else zlib.compressobj(level, zlib.DEFLATED, -15)
+		)
+		# Só o último bloco encerra o stream; os outros terminam alinhados em
+		# bytes (Z_SYNC_FLUSH), para que o próximo continue logo depois
+		output = compressor.compress(data) + compressor.flush(
+			zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+		)
+		# A entrada guarda o CRC dos dados descomprimidos
+		return (output, zlib.crc32(data), len(data))
+
+	if entry.codec == "gzip":
+		compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + 15)
+		output = compressor.compress(data) + compressor.flush()
+	elif entry.codec == "zstd":
+		# pyarrow já é dependência (do pandas/BigQuery); importado só se usado
+		import pyarrow
+		output = pyarrow.Codec("zstd", compression_level=level).compress(data, asbytes=True)
+	else:
+		output = data
+	# Guardados sem compressão no .ZIP: o CRC é do que vai no arquivo
+	return (output, zlib.crc32(output), len(output))
+
+
+def start_entry(zip_file: zipfile.ZipFile, entry: Entry):
+	info = zipfile.ZipInfo.from_file(entry.path, entry.name)
+	info.compress_type = zipfile.ZIP_DEFLATED if entry.codec == "deflate" else zipfile.ZIP_STORED
+	info.header_offset = zip_file.fp.tell()
+	info.CRC = 0
+	info.compress_size = 0
+	info.file_size = 0
+	# Como o `ZipFile.open()`, decidimos antes de saber o tamanho final se o
+	# cabeçalho precisa de ZIP64 (ele não pode mudar de tamanho depois)
+	entry.zip64 = entry.size * 1.05 > zipfile.ZIP64_LIMIT
+	zip_file.fp.write(info.FileHeader(entry.zip64))
+	entry.info = info
+
+
+def finish_entry(zip_file: zipfile.ZipFile, entry: Entry):
+	info = entry.info
+	info.CRC = entry.crc
+	info.file_size = entry.file_size
+	if not entry.zip64 and max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT:
+		raise RuntimeError(f"'{entry.name}' grew past the ZIP64 limit while being compressed")
+	# O `ZipFile` não tem API pública para escrever dados já comprimidos; então
+	# fazemos o que o `ZipFile.open()` faz: reescrevemos o cabeçalho com o CRC e
+	# os tamanhos, e registramos a entrada para o diretório central
+	end = zip_file.fp.tell()
+	zip_file.fp.seek(info.header_offset)
+	zip_file.fp.write(info.FileHeader(entry.zip64))
+	zip_file.fp.seek(end)
+	zip_file.filelist.append(info)
+	zip_file.NameToInfo[info.filename] = info
+	zip_file.start_dir = end
+	zip_file._didModify = True
+
+
+def create_archive(
+	source_dir: str,
+	zip_path: str,
+	codec: str = ARCHIVE_CODEC,
+	level=ARCHIVE_LEVEL,
+	threads: int = ARCHIVE_THREADS,
+	block_size: int = ARCHIVE_BLOCK_MB * 1024 * 1024,
+) -> dict:
+	"""Comprime todos os arquivos de `source_dir` em `zip_path` e retorna
+	estatísticas: tamanho antes e depois, razão de compressão e tempo"""
+	(codec, level) = get_codec(codec, level)
+	start = time.perf_counter()
+	entries = list_entries(source_dir, codec)
+
+	blocks = iter_blocks(entries, block_size)
+	# Blocos sendo comprimidos ou esperando a vez de ir para o .ZIP; limitado
+	# para não carregar a pasta inteira na memória
+	pending = deque()
+	executor = ThreadPoolExecutor(max_workers=threads)
+
+	def submit_next():
+		block = next(blocks, None)
+		if block is not None:
+			(entry, offset, length, last) = block
+			future = executor.submit(compress_block, entry, offset, length, last, level)
+			pending.append((entry, offset, last, future))
+
+	try:
+		with zipfile.ZipFile(zip_path, "w", allowZip64=True) as zip_file:
+			for _ in range(threads * 2):
+				submit_next()
+			while pending:
+				(entry, offset, last, future) = pending.popleft()
+				(output, crc, length) = future.result()
+				submit_next()
+
+				if offset == 0:
+					start_entry(zip_file, entry)
+				zip_file.fp.write(output)
+				entry.info.compress_size += len(output)
+				entry.crc = crc32_combine(entry.crc, crc, length)
+				entry.file_size += length
+				if last:
+					finish_entry(zip_file, entry)
+	except BaseException:
+		executor.shutdown(wait=True, cancel_futures=True)
+		if os.path.exists(zip_path):
+			os.remove(zip_path)
+		raise
+	executor.shutdown(wait=True)
+
+	seconds = time.perf_counter() - start
+	input_bytes = sum(entry.size for entry in entries)
+	output_bytes = os.path.getsize(zip_path)
+	stats = {
+		"codec": get_codec_label(codec, level),
+		"threads": threads,
+		"entries": len(entries),
+		"skipped": sum(1 for entry in entries if entry.codec != codec),
+		"input_bytes": input_bytes,
+		"output_bytes": output_bytes,
+		# ex.: 5.2 => o .ZIP tem 1/5.2 do tamanho original
+		"ratio": round(input_bytes / output_bytes, 2) if output_bytes else None,
+		"seconds": round(seconds, 3),
+		"mb_per_sec": round(input_bytes / seconds / 1024 / 1024, 1) if seconds else None,
+	}
+	logger.info(
+		f"Compressed {stats['entries']} file(s) ({stats['skipped']} already compressed) "
+		f"with {stats['codec']} on {threads} thread(s): {input_bytes} => {output_bytes} bytes "
+		f"(ratio {stats['ratio']}) in {seconds:.1f}s"
+	)
+	return stats
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import time
 import base64
+import hashlib
 
 from loguru import logger
-from infisical import InfisicalClient
 
 
 def getenv_or_action(env_name: str, *, action: str = "raise", default: str = None) -> str:
@@ -37,29 +39,126 @@ def getenv_or_action(env_name: str, *, action: str = "raise", default: str = Non
 	return value
 
 
-def inject_environment_variables(environment: str):
-	"""Inject environment variables from Infisical."""
-	site_url = getenv_or_action("INFISICAL_ADDRESS", action="raise")
-	token = getenv_or_action("INFISICAL_TOKEN", action="raise")
+# Secrets fetched from Infisical are cached for a while, encrypted with a key
+# derived from the Infisical address and token, so that container restarts
+# don't have to wait on Infisical before serving
+SECRETS_CACHE_PATH = os.environ.get("SECRETS_CACHE_PATH", "/tmp/secrets.cache")
+SECRETS_CACHE_TTL = int(os.environ.get("SECRETS_CACHE_TTL", "3600"))
+
+
+def get_secrets_key(site_url: str, token: str) -> bytes:
+	return hashlib.sha256(f"{site_url}\n{token}".encode("utf-8")).digest()
+
+
+def read_cached_secrets(environment: str, key: bytes) -> dict:
+	"""Return the cached secrets for `environment`, or None if there are none,
+	if they expired, or if they can't be decrypted with `key`."""
+	# Comes with `infisical`
+	from Cryptodome.Cipher import AES
+	try:
+		with open(SECRETS_CACHE_PATH, "r", encoding="utf-8") as f:
+			cached = json.load(f)
+		if cached["environment"] != environment:
+			return None
+		if time.time() - cached["fetched_at"] > SECRETS_CACHE_TTL:
+			return None
+		cipher = AES.new(key, AES.MODE_GCM, nonce=base64.b64decode(cached["nonce"]))
+		cipher.update(f"{environment}\n{cached['fetched_at']}".encode("utf-8"))
+		plaintext = cipher.decrypt_and_verify(
+			base64.b64decode(cached["ciphertext"]),
+			base64.b64decode(cached["tag"])
+		)
+		return json.loads(plaintext)
+	except (FileNotFoundError, KeyError, ValueError):
+		return None
+
+
+def write_cached_secrets(environment: str, key: bytes, secrets: dict) -> None:
+	from Cryptodome.Cipher import AES
+	fetched_at = time.time()
+	nonce = os.urandom(12)
+	cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+	# The environment and timestamp aren't secret, but can't be tampered with
+	cipher.update(f"{environment}\n{fetched_at}".encode("utf-8"))
+	(ciphertext, tag) = cipher.encrypt_and_digest(json.dumps(secrets).encode("utf-8"))
+
+	tmp_path = f"{SECRETS_CACHE_PATH}.tmp"
+	fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	with os.fdopen(fd, "w", encoding="utf-8") as f:
+		json.dump({
+			"environment": environment,
+			"fetched_at": fetched_at,
+			"nonce": base64.b64encode(nonce).decode("utf-8"),
+			"tag": base64.b64encode(tag).decode("utf-8"),
+			"ciphertext": base64.b64encode(ciphertext).decode("utf-8"),
+		}, f)
+	os.replace(tmp_path, SECRETS_CACHE_PATH)
+
+
+def fetch_secrets(environment: str, site_url: str, token: str) -> dict:
+	"""Fetch all secrets for `environment` from Infisical.
+
+	If `site_url` is 'file:///path/to/secrets.json', the secrets are read
+	from that JSON object instead; a local stand-in for Infisical, for tests.
+	"""
+	if site_url.startswith("file://"):
+		with open(site_url[len("file://"):], "r", encoding="utf-8") as f:
+			return json.load(f)
+
+	# Only imported if we actually need it
+	from infisical import InfisicalClient
 	infisical_client = InfisicalClient(
 		token=token,
 		site_url=site_url,
 	)
-	secrets = infisical_client.get_all_secrets(
-		environment=environment, attach_to_os_environ=True)
+	secrets = infisical_client.get_all_secrets(environment=environment)
+	return {
+		secret.secret_name: secret.secret_value
+		for secret in secrets
+	}
+
+
+def inject_environment_variables(environment: str) -> str:
+	"""Inject environment variables from Infisical (or from the local cache of
+	a previous fetch). Return where they came from: 'cache' or 'infisical'."""
+	site_url = getenv_or_action("INFISICAL_ADDRESS", action="raise")
+	token = getenv_or_action("INFISICAL_TOKEN", action="raise")
+	key = get_secrets_key(site_url, token)
+
+	source = "cache"
+	secrets = read_cached_secrets(environment, key)
+	if secrets is None:
+		source = "infisical"
+		secrets = fetch_secrets(environment, site_url, token)
+		try:
+			write_cached_secrets(environment, key, secrets)
+		except OSError as e:
+			logger.warning(f"Failed to cache secrets: {e!r}")
+
+	os.environ.update(secrets)
 	logger.info(
-		f"Injecting {len(secrets)} environment variables from Infisical:")
-	for secret in secrets:
+		f"Injecting {len(secrets)} environment variables from {source}:")
+	for (name, value) in secrets.items():
 		logger.info(
-			f" - {secret.secret_name}: {len(secret.secret_value)} chars")
+			f" - {name}: {len(value)} chars")
+	return source
 
 
 def prepare_gcp_credentials() -> None:
 	base64_credential = os.environ["BASEDOSDADOS_CREDENTIALS_PROD"]
+	credentials = base64.b64decode(base64_credential)
 
 	# Create tmp directory if it doesn't exist
 	os.makedirs("/tmp", exist_ok=True)
 
+	# Nothing to do if a previous start already wrote the same file
+	try:
+		with open("/tmp/credentials.json", "rb") as f:
+			if f.read() == credentials:
+				return
+	except FileNotFoundError:
+		pass
+
 	logger.info("Creating '/tmp/credentials.json'...")
 	with open("/tmp/credentials.json", "wb") as f:
-		f.write(base64.b64decode(base64_credential))
+		f.write(credentials)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os
+import abc
+import base64
+import shutil
+import hashlib
+import threading
+
+from loguru import logger
+
+import transfer  # ./transfer.py
+
+
+# 'gcs' (padrão) ou 'local'; com 'local', 'gs://bucket/caminho' vira
+# '<STORAGE_LOCAL_PATH>/bucket/caminho', para testes e benchmarks sem rede
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gcs")
+STORAGE_LOCAL_PATH = os.environ.get("STORAGE_LOCAL_PATH", "/data/storage")
+
+
+def split_uri(uri: str) -> tuple:
+	"""'gs://bucket/path/to/file' => ('bucket', 'path/to/file')"""
+	path_parts = uri[len("gs://"):].split("/", maxsplit=1)
+	return (path_parts[0], path_parts[1] if len(path_parts) > 1 else "")
+
+
+def pick_free_name(base_name: str, file_ext: str, taken: set) -> str:
+	"""Primeiro de '<base>.<ext>', '<base>-export1.<ext>', '<base>-export2.<ext>', ...
+	que não está em `taken`"""
+	name = f"{base_name}.{file_ext}"
+	i = 0
+	while name in taken:
+		i += 1
+		name = f"{base_name}-export{i}.{file_ext}"
+	return name
+
+
+class StorageBackend(abc.ABC):
+	"""Onde os GDBs são lidos e os resultados escritos. Todos os métodos
+	recebem URIs no formato 'gs://bucket/caminho'"""
+
+	@abc.abstractmethod
+	def get_metadata(self, uri: str) -> dict:
+		"""Metadados (hashes, geração, tamanho) do objeto, ou None se ele não
+		existir"""
+		...
+
+	@abc.abstractmethod
+	def exists(self, uri: str) -> bool:
+		...
+
+	@abc.abstractmethod
+	def list_names(self, bucket_name: str, prefix: str) -> set:
+		"""Nomes de todos os objetos do bucket que começam com `prefix`"""
+		...
+
+	@abc.abstractmethod
+	def download(self, uri: str, dest_path: str):
+		...
+
+	@abc.abstractmethod
+	def upload(self, src_path: str, uri: str):
+		...
+
+	def get_free_uri(self, bucket_name: str, base_name: str, file_ext: str) -> str:
+		"""URI de '<base>.<ext>' no bucket, com um sufixo -export1, -export2, ...
+		se o nome já estiver em uso. Uma única listagem por prefixo resolve
+		todas as colisões"""
+		taken = self.list_names(bucket_name, base_name)
+		return f"gs://{bucket_name}/{pick_free_name(base_name, file_ext, taken)}"
+
+
+class GCSBackend(StorageBackend):
+	"""Google Cloud Storage, com um único cliente reaproveitado entre chamadas
+	(e entre tasks do mesmo processo)"""
+
+	def __init__(self, from_file: str = "/tmp/credentials.json"):
+		self.from_file = from_file
+		self.client = None
+		self.lock = threading.Lock()
+
+	def get_client(self):
+		with self.lock:
+			if self.client is None:
+				# O cliente do GCS é pesado de importar; só o carregamos quando preciso
+				from google.cloud import storage
+				from google.oauth2 import service_account
+				from google.auth.transport.requests import AuthorizedSession
+				from requests.adapters import HTTPAdapter
+
+				credentials = service_account.Credentials.from_service_account_file(
+					self.from_file,
+				)
+				# Uma conexão por parte transferida ao mesmo tempo; o padrão do
+				# `requests` guarda só 10 por host
+				session = AuthorizedSession(credentials)
+				adapter = HTTPAdapter(
+					pool_connections=4,
+					pool_maxsize=max(transfer.TRANSFER_CONCURRENCY * 2, 10)
+				)
+				session.mount("https://", adapter)
+				self.client = storage.Client(
+					project=credentials.project_id,
+					credentials=credentials,
+					_http=session,
+				)
+			return self.client
+
+	def bucket(self, bucket_name: str):
+		return self.get_client().bucket(bucket_name)
+
+	def get_metadata(self, uri: str) -> dict:
+		(bucket_name, blob_name) = split_uri(uri)
+		blob = self.bucket(bucket_name).get_blob(blob_name)
+		if blob is None:
+			return None
+		return {
+			"uri": uri,
+			"generation": blob.generation,
+			"size": blob.size,
+			"md5_hash": blob.md5_hash,
+			"crc32c": blob.crc32c
+		}
+
+	def exists(self, uri: str) -> bool:
+		(bucket_name, blob_name) = split_uri(uri)
+		return self.bucket(bucket_name).blob(blob_name).exists()
+
+	def list_names(self, bucket_name: str, prefix: str) -> set:
+		return {
+			blob.name
+			for blob in self.get_client().list_blobs(bucket_name, prefix=prefix)
+		}
+
+	def download(self, uri: str, dest_path: str):
+		(bucket_name, blob_name) = split_uri(uri)
+		transfer.download_sliced(self.bucket(bucket_name), blob_name, dest_path)
+
+	def upload(self, src_path: str, uri: str):
+		(bucket_name, blob_name) = split_uri(uri)
+		transfer.upload_composite(self.bucket(bucket_name), src_path, blob_name)
+
+
+class LocalBackend(StorageBackend):
+	"""Guarda os objetos como arquivos em `root`/bucket/caminho"""
+
+	def __init__(self, root: str = STORAGE_LOCAL_PATH):
+		self.root = root
+
+	def get_path(self, uri: str) -> str:
+		(bucket_name, blob_name) = split_uri(uri)
+		return os.path.join(self.root, bucket_name, blob_name)
+
+	def get_metadata(self, uri: str) -> dict:
+		path = self.get_path(uri)
+		if not os.path.isfile(path):
+			return None
+		md5 = hashlib.md5()
+		with open(path, "rb") as f:
+			while True:
+				data = f.read(8 * 1024 * 1024)
+				if not data:
+					break
+				md5.update(data)
+		stat = os.stat(path)
+		return {
+			"uri": uri,
+			"generation": stat.st_mtime_ns,
+			"size": stat.st_size,
+			# Mesmo formato do GCS
+			"md5_hash": base64.b64encode(md5.digest()).decode("utf-8"),
+			"crc32c": None
+		}
+
+	def exists(self, uri: str) -> bool:
+		return os.path.isfile(self.get_path(uri))
+
+	def list_names(self, bucket_name: str, prefix: str) -> set:
+		bucket_path = os.path.join(self.root, bucket_name)
+		directory = os.path.join(bucket_path, os.path.dirname(prefix))
+		if not os.path.isdir(directory):
+			return set()
+		return {
+			os.path.relpath(entry.path, bucket_path)
+			for entry in os.scandir(directory)
+			if entry.is_file() and os.path.relpath(entry.path, bucket_path).startswith(prefix)
+		}
+
+	def download(self, uri: str, dest_path: str):
+		path = self.get_path(uri)
+		if not os.path.isfile(path):
+			raise FileNotFoundError(f"'{uri}' does not exist")
+		shutil.copyfile(path, dest_path)
+
+	def upload(self, src_path: str, uri: str):
+		path = self.get_path(uri)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# Copia para um temporário e renomeia, para nunca deixar um objeto pela metade
+		tmp_path = f"{path}.tmp"
+		shutil.copyfile(src_path, tmp_path)
+		os.replace(tmp_path, path)
+
+
+# Um backend por arquivo de credenciais, reaproveitado pelo processo inteiro
+backends = dict()
+backends_lock = threading.Lock()
+
+def get_backend(from_file: str = "/tmp/credentials.json") -> StorageBackend:
+	with backends_lock:
+		if from_file not in backends:
+			if STORAGE_BACKEND == "local":
+				logger.info(f"Using local storage at '{STORAGE_LOCAL_PATH}'")
+				backends[from_file] = LocalBackend(STORAGE_LOCAL_PATH)
+			else:
+				backends[from_file] = GCSBackend(from_file)
+		return backends[from_file]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from loguru import logger
+
+
+# Onde guardamos as entradas do cache (e os .ZIPs já gerados)
+CACHE_PATH = os.environ.get("EXPORT_CACHE_PATH", "/data/cache")
+# Quanto espaço os .ZIPs guardados podem ocupar no volume; acima disso,
+# apagamos os usados há mais tempo. A entrada (que só aponta para o arquivo
+# no GCS) continua valendo mesmo sem o .ZIP local
+CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_MB", "5120")) * 1024 * 1024
+
+
+def get_cache_key(source: dict, options: dict) -> str:
+	"""Gera a chave do cache a partir do conteúdo do GDB e das opções de
+	exportação; o mesmo arquivo exportado do mesmo jeito dá a mesma chave"""
+	# Preferimos o MD5, que identifica o conteúdo mesmo que o arquivo tenha sido
+	# reenviado ou copiado para outro caminho. Objetos compostos não têm MD5;
+	# nesse caso, usamos o CRC32C junto com o tamanho
+	if source.get("md5_hash"):
+		content = { "md5": source["md5_hash"] }
+	elif source.get("crc32c"):
+		content = { "crc32c": source["crc32c"], "size": source["size"] }
+	else:
+		content = { "uri": source["uri"], "generation": source["generation"] }
+	data = json.dumps({ "source": content, "options": options }, sort_keys=True)
+	return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def entry_path(key: str) -> str:
+	return os.path.join(CACHE_PATH, f"{key}.json")
+
+
+def artifact_path(key: str) -> str:
+	return os.path.join(CACHE_PATH, f"{key}.zip")
+
+
+def write_entry(key: str, entry: dict):
+	# Escreve em um arquivo temporário e renomeia, para nunca deixar uma
+	# entrada pela metade
+	tmp_path = f"{entry_path(key)}.tmp"
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(entry, f)
+	os.replace(tmp_path, entry_path(key))
+
+
+def lookup(key: str):
+	"""Retorna a entrada do cache para `key`, ou None"""
+	try:
+		with open(entry_path(key), "r", encoding="utf-8") as f:
+			entry = json.load(f)
+	except (FileNotFoundError, ValueError):
+		return None
+	entry["last_used"] = time.time()
+	write_entry(key, entry)
+	# O .ZIP local pode ter sido removido para liberar espaço
+	entry["artifact"] = (
+		artifact_path(key)
+		if os.path.isfile(artifact_path(key))
+		else None
+	)
+	return entry
+
+
+def store(key: str, output_uri: str, zip_filepath: str = None):
+	"""Registra `output_uri` como resultado de `key`. Se `zip_filepath` for
+	dado, o arquivo é movido para o cache (e não precisa ser apagado depois)"""
+	os.makedirs(CACHE_PATH, exist_ok=True)
+	if zip_filepath and os.path.isfile(zip_filepath):
+		# `shutil.move` porque o .ZIP pode estar em outro sistema de arquivos
+		shutil.move(zip_filepath, artifact_path(key))
+	write_entry(key, {
+		"output": output_uri,
+		"created": time.time(),
+		"last_used": time.time()
+	})
+	evict()
+
+
+def forget(key: str):
+	for path in (entry_path(key), artifact_path(key)):
+		if os.path.exists(path):
+			os.remove(path)
+
+
+def evict(max_bytes: int = CACHE_MAX_BYTES):
+	"""Apaga os .ZIPs usados há mais tempo até caberem em `max_bytes`"""
+	artifacts = []
+	for item in os.scandir(CACHE_PATH):
+		if not item.name.endswith(".zip"):
+			continue
+		key = item.name[:-len(".zip")]
+		try:
+			with open(entry_path(key), "r", encoding="utf-8") as f:
+				last_used = json.load(f).get("last_used", 0)
+		except (FileNotFoundError, ValueError):
+			last_used = 0
+		artifacts.append((last_used, item.stat().st_size, item.path))
+
+	total = sum(size for (_, size, _) in artifacts)
+	for (_, size, path) in sorted(artifacts):
+		if total <= max_bytes:
+			break
+		logger.info(f"Evicting cached '{path}' ({size} bytes)")
+		os.remove(path)
+		total -= size
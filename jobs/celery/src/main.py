@@ -1,24 +1,90 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import time
 import uuid
 import shutil
-import requests
 
 from loguru import logger
 from celery import Celery, Task
+from celery.signals import worker_init, worker_ready, worker_process_shutdown
 
 import auth  # ./auth.py
+import archive  # ./archive.py
+import cache  # ./cache.py
+import metrics  # ./metrics.py
+import startup  # ./startup.py
 import utils  # ./utils.py
 
 
-auth.inject_environment_variables(environment=os.environ.get("ENVIRONMENT", "dev"))
-auth.prepare_gcp_credentials()
+STARTUP = startup.StartupTimer("celery")
+with STARTUP.step("secrets"):
+	STARTUP.details["secrets_source"] = auth.inject_environment_variables(
+		environment=os.environ.get("ENVIRONMENT", "dev")
+	)
+with STARTUP.step("gcp_credentials"):
+	auth.prepare_gcp_credentials()
 
 celery_app = Celery(
 	"celery",
 	backend=os.environ.get("REDIS_SERVER"),
 	broker=os.environ.get("REDIS_SERVER"),
 )
+# Quantas exportações rodam ao mesmo tempo; o gdb2csv deve aceitar o mesmo
+# tanto de jobs simultâneos (`EXPORT_MAX_JOBS`)
+celery_app.conf.worker_concurrency = int(os.environ.get("EXPORT_CONCURRENCY", "1"))
+
+# Porta onde o processo principal do worker serve as métricas do Prometheus
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9808"))
+
+STAGE_SECONDS = metrics.Histogram(
+	"gdb_export_stage_seconds",
+	"Quanto tempo cada etapa das exportações levou",
+	("stage",),
+	buckets=metrics.DEFAULT_BUCKETS
+)
+TASKS = metrics.Counter(
+	"gdb_export_tasks_total",
+	"Exportações terminadas, por resultado e pela etapa em que terminaram",
+	("status", "stage")
+)
+QUEUE_WAIT_SECONDS = metrics.Histogram(
+	"gdb_export_queue_wait_seconds",
+	"Quanto tempo as exportações esperaram na fila até começar",
+	buckets=metrics.DEFAULT_BUCKETS
+)
+ARCHIVE_BYTES = metrics.Counter(
+	"gdb_export_archive_bytes_total",
+	"Bytes que entraram no .ZIP ('input') e o tamanho dos .ZIPs gerados ('output'), por codec",
+	("codec", "kind")
+)
+
+def get_queue_length():
+	with celery_app.connection_or_acquire() as connection:
+		return connection.default_channel.client.llen(celery_app.conf.task_default_queue)
+
+@worker_init.connect
+def clear_metrics(**kwargs):
+	# Antes de o worker criar os processos filhos, que já escrevem na pasta
+	metrics.clear()
+
+@worker_ready.connect
+def report_startup(**kwargs):
+	STARTUP.report()
+	metrics.serve(METRICS_PORT, collectors=[
+		metrics.FunctionGauge(
+			"gdb_export_queue_length",
+			"Quantas tasks estão na fila do Redis esperando um worker",
+			get_queue_length
+		)
+	])
+	logger.info(f"Serving metrics at port {METRICS_PORT}")
+
+@worker_process_shutdown.connect
+def forget_process_metrics(pid=None, **kwargs):
+	# As tasks rodam em processos filhos, que deixam suas contagens em arquivos
+	# para o processo principal somar; um processo que terminou não tem mais gauges
+	metrics.mark_process_dead(pid or os.getpid())
 
 #############################
 
@@ -29,19 +95,52 @@ def dummy_task(self: Task):
 
 
 @celery_app.task(name="export.task", bind=True)
-def export_task(self: Task, gcs_uri: str):
+def export_task(self: Task, gcs_uri: str, delta: str = "", requested_at: float = None, tables: dict = None):
+	# Tasks enviadas por versões antigas da API não dizem quando foram pedidas
+	if requested_at is not None:
+		QUEUE_WAIT_SECONDS.observe(max(time.time() - requested_at, 0))
+
 	if not gcs_uri.startswith("gs://"):
 		state = f"Malformed bucket URI: '{gcs_uri}'"
 		logger.warning(state)
 		raise utils.TaskFailure(state)
 
 	TOTAL_TASKS = 6
+	# Tabelas a exportar e, de cada uma, quais colunas e linhas (ex.:
+	# { "PACIENTE": { "columns": [ "ID", "NOME" ], "where": [ ... ] } }); sem
+	# nada, exporta todas as tabelas inteiras. O gdb2csv recebe isso como JSON
+	TABLE_LIST = json.dumps(tables, sort_keys=True) if tables else "all"
+	# Nome do GDB (e do .ZIP) baixado por esta task; o nome de cada snapshot
+	# de uma série delta vem dele, então não se repete entre exportações
 	FILE_UUID = (
 		str(self.request.id)
 		if hasattr(self.request, "id")
 		else str(uuid.uuid4())
 	)
-	CSV_PATH = "/data/csv"
+	# 'zip' faz o gdb2csv comprimir as linhas direto no .ZIP final, sem
+	# escrever CSVs intermediários no disco; 'csv' mantém o fluxo antigo;
+	# 'parquet' gera um .parquet tipado por tabela, que vão juntos no .ZIP
+	EXPORT_OUTPUT = os.environ.get("EXPORT_OUTPUT", "csv")
+	# Charset em que os textos estão de fato no GDB (ex.: 'WIN1252'); vazio
+	# mantém o ISO8859_1 da conexão
+	EXPORT_TEXT_CHARSET = os.environ.get("EXPORT_TEXT_CHARSET", "")
+	# Linhas por chunk; com 0, o gdb2csv escolhe por tabela, pela largura das
+	# linhas, e ajusta conforme o tempo de cada chunk. Exportações delta sempre
+	# usam 10.000 linhas, mas essas não passam pelo cache
+	EXPORT_CHUNK_SIZE = os.environ.get("EXPORT_CHUNK_SIZE", "0")
+	# Só as opções que mudam o resultado; `EXPORT_WORKERS` não muda
+	EXPORT_OPTIONS = {
+		"output_format": EXPORT_OUTPUT,
+		"table_list": TABLE_LIST,
+		"text_charset": EXPORT_TEXT_CHARSET,
+		"chunk_size": EXPORT_CHUNK_SIZE,
+		# Com 'zip', quem comprime é o gdb2csv
+		"archive": archive.get_codec_label() if EXPORT_OUTPUT != "zip" else None
+	}
+	# Pasta da exportação no volume, com o GDB, os CSVs e o .ZIP; definida
+	# (pelo arquivo e pelas opções) depois de consultarmos o bucket
+	WORKSPACE = None
+	workspace_lock = None
 
 	# ex.: 'gs://bucket_name/path/to/my/file/BACKUP.GDB'
 	#      => [ 'bucket_name/path/to/my/file', 'BACKUP.GDB' ]
@@ -51,9 +150,62 @@ def export_task(self: Task, gcs_uri: str):
 	# => [ 'bucket_name', 'path/to/my/file' ]
 	(bucket_name, gcs_path) = gcs_full_path.split("/", maxsplit=1)
 
+	timer = metrics.StageTimer(STAGE_SECONDS)
+	outcome = "failed"
 	try:
+		########################################
+		# (0) Procura uma exportação anterior do mesmo arquivo
+		timer.start("cache")
+		state = f"Checking cache for '{gcs_uri}'..."
+		self.update_state(state="PROGRESS", meta={
+			"status": state,
+			"current": 0,
+			"total": TOTAL_TASKS
+		})
+		logger.info(state)
+		source_metadata = utils.get_blob_metadata(gcs_uri)
+		CACHE_KEY = cache.get_cache_key(source_metadata, EXPORT_OPTIONS)
+
+		# Cada exportação tem sua própria pasta, e várias podem rodar ao mesmo
+		# tempo sem conflito. A mesma exportação (mesmo arquivo, mesmas opções,
+		# mesma série delta) sempre cai na mesma pasta: se uma tentativa anterior
+		# falhou, esta continua do checkpoint que ela deixou. Se outra task está
+		# fazendo a mesma exportação agora, esperamos ela terminar (e, aí, o
+		# resultado já deve estar no cache)
+		utils.remove_stale_workspaces()
+		WORKSPACE = utils.get_workspace(
+			cache.get_cache_key(source_metadata, dict(EXPORT_OPTIONS, delta=delta))
+		)
+		workspace_lock = utils.WorkspaceLock(WORKSPACE)
+		workspace_lock.acquire()
+		CSV_PATH = f"{WORKSPACE}/{'parquet' if EXPORT_OUTPUT == 'parquet' else 'csv'}"
+		# Exportações delta dependem da exportação anterior da série, e não só
+		# do arquivo; por isso não passam pelo cache
+		cached = cache.lookup(CACHE_KEY) if not delta else None
+		if cached is not None:
+			if utils.blob_exists(cached["output"]):
+				logger.info(f"Cache hit; '{cached['output']}' is still in the bucket")
+				outcome = "cached"
+				return { "success": True, "output": cached["output"], "cached": True }
+			if cached["artifact"] is not None:
+				# Alguém apagou o resultado do bucket, mas ainda temos o .ZIP
+				logger.info(f"Cache hit; re-uploading '{cached['artifact']}'")
+				output_uri = utils.upload_to_bucket(
+					cached["artifact"],
+					bucket_name,
+					f"{gcs_path}/{original_file_name}",
+					"zip"
+				)
+				cache.store(CACHE_KEY, output_uri)
+				outcome = "cached"
+				return { "success": True, "output": output_uri, "cached": True }
+			logger.info("Cached output is gone; exporting again")
+			cache.forget(CACHE_KEY)
+
+
 		########################################
 		# (1) Baixa o arquivo do bucket
+		timer.start("download")
 		state = f"Downloading '{gcs_uri}'..."
 		self.update_state(state="PROGRESS", meta={
 			"status": state,
@@ -61,15 +213,18 @@ def export_task(self: Task, gcs_uri: str):
 			"total": TOTAL_TASKS
 		})
 		logger.info(state)
-		gdb_filename = utils.download_from_bucket(gcs_uri, FILE_UUID)
+		gdb_filename = utils.find_gdb(WORKSPACE)
+		if gdb_filename is not None:
+			logger.info(f"Continuing previous attempt; reusing '{WORKSPACE}/{gdb_filename}'")
+		else:
+			gdb_filename = utils.download_from_bucket(gcs_uri, FILE_UUID, directory=WORKSPACE)
+		# O .ZIP tem o nome do GDB, que pode ser de uma tentativa anterior
+		export_name = gdb_filename.rsplit(".", maxsplit=1)[0]
 
 
 		########################################
 		# (2) Requisita a exportação pelo outro Docker
-		if os.path.exists(CSV_PATH):
-			logger.info(f"Found '{len(os.listdir(CSV_PATH))}' file(s) before export; deleting...")
-			shutil.rmtree(CSV_PATH)
-
+		timer.start("export")
 		state = f"Requesting export of file '{gdb_filename}'..."
 		self.update_state(state="PROGRESS", meta={
 			"status": state,
@@ -78,12 +233,58 @@ def export_task(self: Task, gcs_uri: str):
 		})
 		logger.info(state)
 		EXPORT_SERVER = os.environ.get("EXPORT_SERVER")
-		requests.get(f"{EXPORT_SERVER}/export/{gdb_filename}")
-		logger.info(f"Found '{len(os.listdir(CSV_PATH))}' file(s) after export")
+		# Quantas tabelas exportar em paralelo (cada uma com sua conexão)
+		EXPORT_WORKERS = os.environ.get("EXPORT_WORKERS", "1")
+		# Quantos chunks o gdb2csv pode buscar enquanto escreve o atual; com 0,
+		# busca e escrita se alternam
+		EXPORT_PIPELINE = os.environ.get("EXPORT_PIPELINE", "0")
+		export_params = {
+			"table_list": TABLE_LIST,
+			"workers": EXPORT_WORKERS,
+			"chunk_size": EXPORT_CHUNK_SIZE,
+			"pipeline": EXPORT_PIPELINE,
+			"output_format": EXPORT_OUTPUT,
+			"delta": delta,
+			"text_charset": EXPORT_TEXT_CHARSET,
+			# O gdb2csv lê o GDB e escreve o resultado na pasta da exportação
+			"workspace": os.path.basename(WORKSPACE)
+		}
+
+		def on_progress(job):
+			# ex.: "Exporting 'PACIENTE': 150000/480000 rows (2100.5 rows/s, ETA 157s)"
+			progress = job["progress"]
+			status = state
+			if progress.get("tables"):
+				status = "; ".join(
+					utils.format_table_progress(table, table_progress)
+					for (table, table_progress) in progress["tables"].items()
+				)
+				status += f" -- table(s) {progress['tables_done']}/{progress['tables_total']} done"
+			self.update_state(state="PROGRESS", meta={
+				"status": status,
+				"current": 2,
+				"total": TOTAL_TASKS,
+				"export": progress
+			})
+		# O gdb2csv só inicia a exportação e retorna o ID do job; depois,
+		# perguntamos periodicamente como ela está. Se o gdb2csv reiniciar no
+		# meio, ele esquece o job; pedimos de novo, e ele continua do checkpoint
+		resubmits = 0
+		while True:
+			job_id = utils.submit_export_job(EXPORT_SERVER, gdb_filename, export_params)
+			try:
+				utils.wait_for_export_job(EXPORT_SERVER, job_id, on_progress)
+				break
+			except utils.ExportJobLost as e:
+				resubmits += 1
+				if resubmits > utils.EXPORT_MAX_RESUBMITS:
+					raise
+				logger.warning(f"{e}; requesting it again ({resubmits}/{utils.EXPORT_MAX_RESUBMITS})")
 
 
 		########################################
 		# (3) Adiciona CSVs resultantes em .ZIP
+		timer.start("zip")
 		state = "Zipping results..."
 		self.update_state(state="PROGRESS", meta={
 			"status": state,
@@ -91,12 +292,25 @@ def export_task(self: Task, gcs_uri: str):
 			"total": TOTAL_TASKS
 		})
 		logger.info(state)
-		zip_filepath = shutil.make_archive(FILE_UUID, format="zip", root_dir=CSV_PATH)
+		archive_stats = None
+		if EXPORT_OUTPUT == "zip":
+			# O gdb2csv já gerou o .ZIP durante a exportação
+			zip_filepath = f"{WORKSPACE}/{export_name}.zip"
+			if not os.path.isfile(zip_filepath):
+				raise utils.TaskFailure(f"Export did not create '{zip_filepath}'")
+		else:
+			logger.info(f"Found '{len(os.listdir(CSV_PATH))}' file(s) after export")
+			# Comprime os arquivos em paralelo, com o codec de `ARCHIVE_CODEC`
+			zip_filepath = f"{WORKSPACE}/{export_name}.zip"
+			archive_stats = archive.create_archive(CSV_PATH, zip_filepath)
+			ARCHIVE_BYTES.labels(codec=archive_stats["codec"], kind="input").inc(archive_stats["input_bytes"])
+			ARCHIVE_BYTES.labels(codec=archive_stats["codec"], kind="output").inc(archive_stats["output_bytes"])
 		logger.info(f"Created '{zip_filepath}'")
 
 
 		########################################
 		# (4) Faz upload para o bucket
+		timer.start("upload")
 		compressed_file_ext = "unknown"
 		if zip_filepath.endswith(".zip"):
 			compressed_file_ext = "zip"
@@ -105,7 +319,9 @@ def export_task(self: Task, gcs_uri: str):
 		self.update_state(state="PROGRESS", meta={
 			"status": state,
 			"current": 4,
-			"total": TOTAL_TASKS
+			"total": TOTAL_TASKS,
+			# Tamanho antes e depois, razão de compressão e tempo do passo (3)
+			"archive": archive_stats
 		})
 		logger.info(state)
 		output_uri = utils.upload_to_bucket(
@@ -114,10 +330,18 @@ def export_task(self: Task, gcs_uri: str):
 			f"{gcs_path}/{original_file_name}",
 			compressed_file_ext
 		)
+		# Guarda o resultado (e move o .ZIP para o cache) para que a próxima
+		# exportação do mesmo arquivo termine em segundos
+		if delta:
+			# Só agora a próxima exportação da série pode se comparar com esta
+			utils.promote_delta_manifest(delta, output_uri)
+		else:
+			cache.store(CACHE_KEY, output_uri, zip_filepath)
 
 
 		########################################
 		# (5) Remove arquivos
+		timer.start("cleanup")
 		state = "Cleaning up..."
 		self.update_state(state="PROGRESS", meta={
 			"status": state,
@@ -125,11 +349,27 @@ def export_task(self: Task, gcs_uri: str):
 			"total": TOTAL_TASKS
 		})
 		logger.info(state)
-		shutil.rmtree(CSV_PATH)
-		os.remove(f"/data/{gdb_filename}")
-		os.remove(zip_filepath)
+		# GDB, CSVs, .ZIP (se não foi para o cache), checkpoint do gdb2csv, ...
+		shutil.rmtree(WORKSPACE)
 
-		return { "success": True, "output": output_uri }
+		outcome = "done"
+		return { "success": True, "output": output_uri, "archive": archive_stats }
 
 	except Exception as ex:
+		# O que a exportação deixou no volume (GDB, CSVs, .ZIP, checkpoint) só
+		# serve para uma nova tentativa continuar de onde esta parou, e só por
+		# `EXPORT_RESUME_HOURS`; sem o GDB, não serve para nada
+		if WORKSPACE is not None and workspace_lock.file is not None:
+			if utils.keep_for_resume(WORKSPACE, str(ex)):
+				logger.warning(f"Keeping '{WORKSPACE}' for {utils.EXPORT_RESUME_HOURS}h, so the export can be resumed")
+			else:
+				shutil.rmtree(WORKSPACE, ignore_errors=True)
 		raise utils.TaskFailure(str(ex))
+	finally:
+		if workspace_lock is not None:
+			# Sem a pasta, o lock não protege mais nada
+			if workspace_lock.file is not None and not os.path.isdir(WORKSPACE):
+				utils.remove_workspace(WORKSPACE, workspace_lock)
+			workspace_lock.release()
+		TASKS.labels(status=outcome, stage=timer.stage or "").inc()
+		timer.stop()
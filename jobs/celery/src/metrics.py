@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Métricas do Prometheus do worker, com o `prometheus_client` em modo
+multiprocesso.
+
+As tasks rodam em processos filhos do worker; cada um grava seus valores em
+arquivos em `PROMETHEUS_MULTIPROC_DIR`, e o processo principal soma todos num
+único endpoint (`serve()`). Os contadores recomeçam do zero quando o worker
+reinicia.
+
+[Ref] https://prometheus.github.io/client_python/multiprocess/
+"""
+import os
+import time
+import shutil
+
+# O `prometheus_client` decide, ao ser importado, se guarda os valores em
+# arquivos; então a pasta tem que estar definida antes, e as métricas são
+# criadas com o `Counter` e o `Histogram` daqui
+MULTIPROC_DIRECTORY = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/metrics")
+os.makedirs(MULTIPROC_DIRECTORY, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+
+# Segundos; de uma etapa rápida até uma exportação de horas
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+
+class FunctionGauge:
+	"""Gauge calculado na hora de gerar as métricas, por `function()`, no
+	processo principal. (No modo multiprocesso, `Gauge.set_function()` não
+	funciona, já que só o que está nos arquivos é somado)"""
+
+	def __init__(self, name, documentation, function):
+		self.name = name
+		self.documentation = documentation
+		self.function = function
+
+	def collect(self):
+		try:
+			value = self.function()
+		except Exception:
+			# Uma métrica que não conseguimos calcular agora simplesmente não aparece
+			return
+		gauge = GaugeMetricFamily(self.name, self.documentation)
+		gauge.add_metric([], value)
+		yield gauge
+
+
+class StageTimer:
+	"""Mede etapas consecutivas de um processo: `start("b")` termina a etapa
+	"a" (registrando quanto tempo ela levou em `histogram`, com o label
+	`stage`) e começa "b"; `stop()` termina a última"""
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+		self.stage = None
+		self.started_at = None
+
+	def start(self, stage):
+		self.stop()
+		self.stage = stage
+		self.started_at = time.perf_counter()
+
+	def stop(self):
+		if self.stage is not None:
+			self.histogram.labels(stage=self.stage).observe(time.perf_counter() - self.started_at)
+		self.stage = None
+
+
+def serve(port, collectors=()):
+	"""Serve, em http://0.0.0.0:`port`/metrics numa thread em segundo plano, a
+	soma das métricas de todos os processos, mais as de `collectors`"""
+	registry = CollectorRegistry()
+	multiprocess.MultiProcessCollector(registry)
+	for collector in collectors:
+		registry.register(collector)
+	start_http_server(port, registry=registry)
+
+
+def clear():
+	"""Apaga os arquivos deixados antes de um restart. Só o processo principal
+	do worker, ao iniciar, pode chamar isso: qualquer outro processo que importe
+	este módulo (um `celery inspect`, um shell) apagaria os números do worker
+	que está rodando"""
+	shutil.rmtree(MULTIPROC_DIRECTORY, ignore_errors=True)
+	os.makedirs(MULTIPROC_DIRECTORY, exist_ok=True)
+
+
+def mark_process_dead(pid):
+	"""Descarta os gauges de um processo filho que terminou; seus contadores e
+	histogramas continuam contando"""
+	multiprocess.mark_process_dead(pid)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import os
+import base64
+import uuid
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+if TYPE_CHECKING:
+	from google.cloud import storage
+
+
+# Quantas partes transferir ao mesmo tempo, e o tamanho de cada parte
+TRANSFER_CONCURRENCY = int(os.environ.get("GCS_TRANSFER_CONCURRENCY", "8"))
+PART_SIZE = int(os.environ.get("GCS_PART_SIZE_MB", "64")) * 1024 * 1024
+
+# O GCS aceita no máximo 32 objetos por chamada de compose
+# [Ref] https://cloud.google.com/storage/docs/composite-objects
+MAX_COMPOSE_SOURCES = 32
+
+
+def file_crc32c(file_path: str) -> str:
+	"""Calcula o CRC32C do arquivo no formato usado pelo GCS (base64, big-endian)"""
+	import google_crc32c
+	checksum = google_crc32c.Checksum()
+	with open(file_path, "rb") as f:
+		while True:
+			data = f.read(8 * 1024 * 1024)
+			if not data:
+				break
+			checksum.update(data)
+	return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def split_ranges(size: int, part_size: int) -> list:
+	"""Divide `size` bytes em intervalos [start, end) de até `part_size` bytes"""
+	return [
+		(start, min(start + part_size, size))
+		for start in range(0, size, part_size)
+	]
+
+
+def verify_crc32c(file_path: str, blob: storage.Blob):
+	if not blob.crc32c:
+		logger.warning(f"'{blob.name}' has no CRC32C; skipping verification")
+		return
+	local_crc32c = file_crc32c(file_path)
+	if local_crc32c != blob.crc32c:
+		raise IOError(
+			f"CRC32C mismatch for '{blob.name}': local '{local_crc32c}', remote '{blob.crc32c}'"
+		)
+	logger.info(f"CRC32C verified for '{blob.name}' ({local_crc32c})")
+
+
+def download_sliced(
+	bucket: storage.Bucket,
+	blob_name: str,
+	dest_path: str,
+	concurrency: int = TRANSFER_CONCURRENCY,
+	part_size: int = PART_SIZE,
+):
+	"""Baixa um objeto em intervalos paralelos, cada um escrito direto na sua
+	posição de um arquivo pré-alocado, e confere o CRC32C no final"""
+	blob = bucket.get_blob(blob_name)
+	if blob is None:
+		raise FileNotFoundError(f"'gs://{bucket.name}/{blob_name}' does not exist")
+
+	# Fixamos a geração do objeto, para que todas as partes venham da mesma
+	# versão mesmo que alguém sobrescreva o arquivo no meio do download
+	blob = bucket.blob(blob_name, generation=blob.generation)
+	blob.reload()
+	ranges = split_ranges(blob.size, part_size)
+	logger.info(
+		f"Downloading {blob.size} bytes in {len(ranges)} part(s) of up to "
+		f"{part_size} bytes, {concurrency} at a time"
+	)
+
+	# Pré-aloca o arquivo para que cada parte possa ser escrita na sua posição
+	with open(dest_path, "wb") as f:
+		f.truncate(blob.size)
+
+	def download_range(byte_range):
+		(start, end) = byte_range
+		with open(dest_path, "r+b") as f:
+			f.seek(start)
+			# `end` é inclusivo na API; o checksum é conferido no arquivo inteiro
+			blob.download_to_file(f, start=start, end=end - 1, checksum=None)
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		# `list()` para propagar exceções das threads
+		list(executor.map(download_range, ranges))
+
+	verify_crc32c(dest_path, blob)
+
+
+def compose(bucket: storage.Bucket, dest_blob: storage.Blob, sources: list) -> list:
+	"""Junta `sources` em `dest_blob`, em etapas de até 32 objetos se preciso.
+	Retorna os objetos intermediários criados, que também precisam ser apagados"""
+	intermediates = []
+	level = 0
+	while len(sources) > MAX_COMPOSE_SOURCES:
+		grouped = []
+		for i in range(0, len(sources), MAX_COMPOSE_SOURCES):
+			group = sources[i:i + MAX_COMPOSE_SOURCES]
+			intermediate = bucket.blob(f"{dest_blob.name}.compose-{level}-{i}")
+			intermediate.compose(group)
+			grouped.append(intermediate)
+		intermediates.extend(grouped)
+		sources = grouped
+		level += 1
+	dest_blob.compose(sources)
+	return intermediates
+
+
+def upload_composite(
+	bucket: storage.Bucket,
+	src_path: str,
+	dest_blob_name: str,
+	concurrency: int = TRANSFER_CONCURRENCY,
+	part_size: int = PART_SIZE,
+):
+	"""Envia um arquivo em partes paralelas, como objetos temporários que são
+	compostos no servidor no objeto final; confere o CRC32C no final"""
+	size = os.path.getsize(src_path)
+	dest_blob = bucket.blob(dest_blob_name)
+
+	# Arquivos pequenos não compensam o custo das partes e do compose
+	if size <= part_size:
+		dest_blob.upload_from_filename(src_path, checksum="crc32c")
+		dest_blob.reload()
+		verify_crc32c(src_path, dest_blob)
+		return
+
+	ranges = split_ranges(size, part_size)
+	logger.info(
+		f"Uploading {size} bytes in {len(ranges)} part(s) of up to "
+		f"{part_size} bytes, {concurrency} at a time"
+	)
+	prefix = f"{dest_blob_name}.parts-{uuid.uuid4()}"
+	parts = [
+		bucket.blob(f"{prefix}/{i:05d}")
+		for i in range(len(ranges))
+	]
+
+	def upload_range(i):
+		(start, end) = ranges[i]
+		with open(src_path, "rb") as f:
+			f.seek(start)
+			parts[i].upload_from_file(f, size=end - start, checksum="crc32c")
+
+	intermediates = []
+	try:
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			list(executor.map(upload_range, range(len(parts))))
+		intermediates = compose(bucket, dest_blob, parts)
+		dest_blob.reload()
+		verify_crc32c(src_path, dest_blob)
+	finally:
+		# Apaga as partes temporárias, tenha dado certo ou não
+		for blob in parts + intermediates:
+			try:
+				blob.delete()
+			except Exception as e:
+				logger.warning(f"Failed to delete temporary '{blob.name}': {e!r}")
@@ -1,31 +1,182 @@
-from google.cloud import storage
-from google.oauth2 import service_account
+import os
+import json
+import time
+import fcntl
+import shutil
+import requests
+
 from loguru import logger
 
+import backends  # ./backends.py
+import metrics  # ./metrics.py
+
 class TaskFailure(Exception):
 	pass
 
-def download_from_bucket(bucket_uri: str, file_uuid: str, from_file="/tmp/credentials.json"):
-	credentials = service_account.Credentials.from_service_account_file(
-		from_file,
-	)
-	client = storage.Client(credentials=credentials)
 
-	path_parts = bucket_uri[len("gs://"):].split("/", maxsplit=1)
-	bucket_name = path_parts[0]
-	blob_name = path_parts[1] if len(path_parts) > 1 else ""
+class ExportJobLost(TaskFailure):
+	"""O gdb2csv não conhece mais o job (ele esquece os jobs quando reinicia)"""
+	pass
+
+
+# Nenhuma requisição ao gdb2csv deveria demorar; a exportação em si roda em
+# segundo plano, e só perguntamos pelo seu estado a cada tantos segundos
+EXPORT_REQUEST_TIMEOUT = 30
+EXPORT_POLL_INTERVAL = int(os.environ.get("EXPORT_POLL_INTERVAL", "5"))
+# Quantas falhas seguidas ao consultar o gdb2csv toleramos (ex.: reinício)
+EXPORT_MAX_POLL_ERRORS = 12
+# Quantas vezes pedimos de novo uma exportação que o gdb2csv perdeu; cada nova
+# tentativa continua do checkpoint que a anterior deixou na pasta
+EXPORT_MAX_RESUBMITS = 3
+
+# As pastas das exportações ficam em /data/export-<chave>, onde a chave vem do
+# conteúdo do GDB e das opções; pedir de novo a mesma exportação usa a mesma pasta
+WORKSPACE_PREFIX = "export-"
+# Por quantas horas a pasta de uma exportação que falhou fica no volume, para
+# que a próxima tentativa continue de onde ela parou; com 0, é apagada na hora
+EXPORT_RESUME_HOURS = float(os.environ.get("EXPORT_RESUME_HOURS", "24"))
+# Arquivo que marca a pasta de uma exportação que falhou, com quando e por quê
+RESUME_MARKER = "resume.json"
+
+TRANSFER_BYTES = metrics.Counter(
+	"gdb_export_transfer_bytes_total",
+	"Bytes baixados e enviados ao armazenamento",
+	("direction",)
+)
+TRANSFER_SECONDS = metrics.Counter(
+	"gdb_export_transfer_seconds_total",
+	"Tempo gasto baixando e enviando arquivos ao armazenamento",
+	("direction",)
+)
+
+def get_workspace(key: str, data_path: str = "/data") -> str:
+	return os.path.join(data_path, f"{WORKSPACE_PREFIX}{key[:32]}")
+
+
+class WorkspaceLock:
+	"""Garante que uma só task usa a pasta `workspace` por vez; outra task com a
+	mesma exportação espera a primeira terminar. O lock é o arquivo
+	'<workspace>.lock', ao lado da pasta, que some junto com ela"""
+
+	def __init__(self, workspace: str):
+		self.path = f"{workspace}.lock"
+		self.file = None
 
-	bucket = client.get_bucket(bucket_name)
-	blob = bucket.blob(blob_name)
+	def acquire(self, blocking: bool = True) -> bool:
+		while True:
+			file = open(self.path, "a")
+			try:
+				fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+			except BlockingIOError:
+				file.close()
+				return False
+			# Quem tinha o lock pode ter apagado o arquivo ao terminar; nesse caso,
+			# o lock que temos não vale mais para ninguém
+			try:
+				if os.fstat(file.fileno()).st_ino == os.stat(self.path).st_ino:
+					self.file = file
+					return True
+			except FileNotFoundError:
+				pass
+			file.close()
 
+	def release(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+def remove_workspace(workspace: str, lock: WorkspaceLock):
+	"""Apaga a pasta e o lock dela; só quem tem o lock pode fazer isso"""
+	shutil.rmtree(workspace, ignore_errors=True)
+	try:
+		os.remove(lock.path)
+	except FileNotFoundError:
+		pass
+
+
+def keep_for_resume(workspace: str, error: str) -> bool:
+	"""Se a exportação que falhou chegou a baixar o GDB, deixa a pasta no volume
+	por `EXPORT_RESUME_HOURS`, para que a próxima tentativa continue do
+	checkpoint do gdb2csv. Retorna se a pasta foi mantida"""
+	if EXPORT_RESUME_HOURS <= 0 or find_gdb(workspace) is None:
+		return False
+	with open(os.path.join(workspace, RESUME_MARKER), "w", encoding="utf-8") as f:
+		json.dump({ "failed_at": time.time(), "error": error }, f)
+	return True
+
+
+def remove_stale_workspaces(data_path: str = "/data"):
+	"""Apaga as pastas de exportações que falharam (ou cujo worker morreu) há
+	mais de `EXPORT_RESUME_HOURS`. Pastas em uso por outra task ficam"""
+	try:
+		entries = list(os.scandir(data_path))
+	except FileNotFoundError:
+		return
+	for entry in entries:
+		if not entry.name.startswith(WORKSPACE_PREFIX) or not entry.is_dir():
+			continue
+		marker = os.path.join(entry.path, RESUME_MARKER)
+		try:
+			# Sem o marcador, o worker morreu no meio; vale a última mudança na pasta
+			changed_at = os.path.getmtime(marker if os.path.exists(marker) else entry.path)
+		except FileNotFoundError:
+			continue
+		if time.time() - changed_at < EXPORT_RESUME_HOURS * 60 * 60:
+			continue
+		lock = WorkspaceLock(entry.path)
+		if not lock.acquire(blocking=False):
+			continue
+		try:
+			logger.info(f"Removing '{entry.path}', left by an export that failed")
+			remove_workspace(entry.path, lock)
+		finally:
+			lock.release()
+
+
+def find_gdb(workspace: str):
+	"""Nome do GDB baixado por uma tentativa anterior na pasta, se houver"""
+	try:
+		names = os.listdir(workspace)
+	except FileNotFoundError:
+		return None
+	for name in sorted(names):
+		if name.endswith(".gdb"):
+			return name
+	return None
+
+
+def download_from_bucket(
+	bucket_uri: str,
+	file_uuid: str,
+	directory: str = "/data",
+	from_file="/tmp/credentials.json"
+):
 	FILENAME = f"{file_uuid}.gdb"
-	with open(f"/data/{FILENAME}", "w+") as f:
-		file_path = f.name
-		logger.info(f"Downloading '{bucket_uri}' to file '{file_path}'")
-		blob.download_to_filename(file_path)
+	os.makedirs(directory, exist_ok=True)
+	file_path = f"{directory}/{FILENAME}"
+	logger.info(f"Downloading '{bucket_uri}' to file '{file_path}'")
+	start = time.perf_counter()
+	# Só ganha o nome final quando termina; um .gdb na pasta está sempre inteiro
+	backends.get_backend(from_file).download(bucket_uri, f"{file_path}.part")
+	os.replace(f"{file_path}.part", file_path)
+	TRANSFER_SECONDS.labels(direction="download").inc(time.perf_counter() - start)
+	TRANSFER_BYTES.labels(direction="download").inc(os.path.getsize(file_path))
 	return FILENAME
 
 
+def get_blob_metadata(bucket_uri: str, from_file="/tmp/credentials.json") -> dict:
+	"""Retorna os metadados (hashes, geração, tamanho) de um objeto sem baixá-lo"""
+	metadata = backends.get_backend(from_file).get_metadata(bucket_uri)
+	if metadata is None:
+		raise TaskFailure(f"'{bucket_uri}' does not exist")
+	return metadata
+
+
+def blob_exists(bucket_uri: str, from_file="/tmp/credentials.json") -> bool:
+	return backends.get_backend(from_file).exists(bucket_uri)
+
+
 def upload_to_bucket(
 	src_filepath: str,
 	bucket_name: str,
@@ -33,35 +184,109 @@ def upload_to_bucket(
 	file_ext: str,
 	from_file="/tmp/credentials.json"
 ):
-	credentials = service_account.Credentials.from_service_account_file(
-		from_file,
+	backend = backends.get_backend(from_file)
+	# Problema: arquivo com esse nome talvez já exista no GCS
+	# Aqui listamos, de uma vez, tudo que começa com esse nome e escolhemos o
+	# primeiro livre entre os sufixos -export1, -export2, ...
+	output_uri = backend.get_free_uri(bucket_name, dest_blob_name, file_ext)
+	if output_uri != f"gs://{bucket_name}/{dest_blob_name}.{file_ext}":
+		logger.warning(f"'gs://{bucket_name}/{dest_blob_name}.{file_ext}' exists! Using '{output_uri}'")
+
+	start = time.perf_counter()
+	backend.upload(src_filepath, output_uri)
+	TRANSFER_SECONDS.labels(direction="upload").inc(time.perf_counter() - start)
+	TRANSFER_BYTES.labels(direction="upload").inc(os.path.getsize(src_filepath))
+
+	logger.info(
+		f"File '{src_filepath}' uploaded to '{output_uri}'"
 	)
-	client = storage.Client(credentials=credentials)
+	return output_uri
 
-	bucket = client.bucket(bucket_name)
-	# Problema: arquivo com esse nome talvez já exista no GCS
-	# Aqui testamos se o nome já existe e, se sim, iteramos por
-	# sufixos -export1, -export2, ... até que funcione
-	blob = None
-	output_uri = None
-	dest_filepath = dest_blob_name
-	i = 0
-	while True:
-		if i > 0:
-			dest_filepath = f"{dest_blob_name}-export{i}"
 
-		blob = bucket.blob(f"{dest_filepath}.{file_ext}")
-		output_uri = f"gs://{bucket_name}/{dest_filepath}.{file_ext}"
+def promote_delta_manifest(series: str, output_uri: str):
+	"""Torna o manifesto da última exportação delta (escrito pelo gdb2csv em
+	'/data/delta/<série>.next.json') a referência para a próxima exportação
+	da série, registrando onde o resultado foi parar"""
+	next_path = f"/data/delta/{series}.next.json"
+	if not os.path.isfile(next_path):
+		raise TaskFailure(f"Export did not create '{next_path}'")
+	with open(next_path, "r", encoding="utf-8") as f:
+		manifest = json.load(f)
+	manifest["outputs"][manifest["snapshot"]] = output_uri
+	# Escreve em um arquivo temporário e renomeia, para nunca deixar um
+	# manifesto pela metade
+	tmp_path = f"/data/delta/{series}.json.tmp"
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(manifest, f)
+	os.replace(tmp_path, f"/data/delta/{series}.json")
+	os.remove(next_path)
+	logger.info(f"Delta manifest of series '{series}' now points to '{output_uri}'")
+
 
-		if not blob.exists():
+def format_table_progress(table: str, progress: dict) -> str:
+	rows = f"{progress['rows']}"
+	if progress.get("total_rows") is not None:
+		rows += f"/{progress['total_rows']}"
+	details = []
+	if progress.get("rows_per_sec") is not None:
+		details.append(f"{progress['rows_per_sec']} rows/s")
+	if progress.get("bytes") is not None:
+		details.append(f"{progress['bytes']} bytes")
+	if progress.get("eta_seconds") is not None:
+		details.append(f"ETA {progress['eta_seconds']}s")
+	return f"Exporting '{table}': {rows} rows ({', '.join(details)})"
+
+
+def submit_export_job(export_server: str, filename: str, params: dict) -> str:
+	"""Pede ao gdb2csv a exportação de `filename` e retorna o ID do job. Tolera o
+	gdb2csv fora do ar por um tempo (ex.: reiniciando), como `wait_for_export_job()`"""
+	errors = 0
+	while True:
+		try:
+			response = requests.get(
+				f"{export_server}/export/{filename}",
+				params=params,
+				timeout=EXPORT_REQUEST_TIMEOUT
+			).json()
 			break
+		except (requests.RequestException, ValueError) as e:
+			errors += 1
+			if errors >= EXPORT_MAX_POLL_ERRORS:
+				raise TaskFailure(f"Could not reach export server: {e!r}")
+			logger.warning(f"Failed to request export ({errors}/{EXPORT_MAX_POLL_ERRORS}): {e!r}")
+			time.sleep(EXPORT_POLL_INTERVAL)
+	if not response.get("success"):
+		raise TaskFailure(f"Export request failed: {response.get('error')}")
+	return response["job_id"]
 
-		logger.warning(f"'{output_uri}' exists! Retrying with suffix change")
-		i += 1
 
-	blob.upload_from_filename(src_filepath)
+def wait_for_export_job(export_server: str, job_id: str, on_progress=None) -> dict:
+	"""Espera o job de exportação `job_id` do gdb2csv terminar, chamando
+	`on_progress(job)` a cada consulta. Retorna o job; levanta `TaskFailure`
+	se a exportação falhar, ou `ExportJobLost` se o gdb2csv esquecer o job"""
+	errors = 0
+	while True:
+		time.sleep(EXPORT_POLL_INTERVAL)
+		try:
+			response = requests.get(
+				f"{export_server}/jobs/{job_id}",
+				timeout=EXPORT_REQUEST_TIMEOUT
+			)
+		except requests.RequestException as e:
+			errors += 1
+			if errors >= EXPORT_MAX_POLL_ERRORS:
+				raise TaskFailure(f"Could not reach export server: {e!r}")
+			logger.warning(f"Failed to check export job ({errors}/{EXPORT_MAX_POLL_ERRORS}): {e!r}")
+			continue
+		# O gdb2csv esquece os jobs quando reinicia
+		if response.status_code == 404:
+			raise ExportJobLost(f"Export job '{job_id}' was lost (did the export server restart?)")
+		errors = 0
+		job = response.json()
 
-	logger.info(
-		f"File '{src_filepath}' uploaded to '{output_uri}'"
-	)
-	return output_uri
+		if on_progress:
+			on_progress(job)
+		if job["status"] == "done":
+			return job
+		if job["status"] == "failed":
+			raise TaskFailure(f"Export failed: {job['error']}")
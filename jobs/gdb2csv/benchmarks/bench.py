@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks gdb2csv's export modes against a synthetic database.
+
+Every mode runs in its own process (so peak memory is measured separately),
+exporting the same synthetic table through `export.py`, and is reported as
+rows/s, MB/s of output and peak RSS. Absolute numbers depend on the
+machine, so the check against a stored baseline looks at each mode relative
+to `plain` in the same run: if a mode's speed (or peak RSS) next to `plain`
+got worse than `--tolerance` allows, or there's no baseline for the
+configuration, the benchmark says so and exits with status 1. The committed
+baseline.json covers the defaults.
+
+	python3 benchmarks/bench.py --rows 200000 --width 12
+	python3 benchmarks/bench.py --save-baseline   # after a change that's known good
+	python3 benchmarks/bench.py --modes chunked-pk,chunked-pipelined --fetch-latency 40
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(BENCHMARKS_PATH, "..", "src")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_PATH, "baseline.json")
+
+TABLE_NAME = "SYNTHETIC"
+# The mode the others are compared to
+REFERENCE_MODE = "plain"
+
+
+def export_plain(export, con, output_path, options):
+	output = export.open_output("csv", output_path, export.get_field_types(con))
+	export.export_table_to_csv(con, TABLE_NAME, output=output)
+	output.close()
+	return output_path
+
+
+def export_chunked(output_format, keyset=True, pipeline=0):
+	def run(export, con, output_path, options):
+		# Like `export()`, every format gets the column types
+		field_types = export.get_field_types(con)
+		if output_format == "zip":
+			output_path = f"{output_path}.zip"
+		output = export.open_output(output_format, output_path, field_types)
+		export.export_table_to_csv_chunked(
+			con, TABLE_NAME, options["chunk_size"], keyset=keyset, output=output,
+			pipeline=pipeline
+		)
+		output.close()
+		return output_path
+	return run
+
+
+def export_adaptive(export, con, output_path, options):
+	# Like `export()` without a `chunk_size`: chunks sized by the table's plan,
+	# then adapted as it's read
+	output = export.open_output("csv", output_path, export.get_field_types(con))
+	plans = export.plan_tables(con, [ TABLE_NAME ], count=True)
+	export.export_table(con, TABLE_NAME, False, 0, output=output, plans=plans, adaptive_chunks=True)
+	output.close()
+	return output_path
+
+
+def export_end_to_end(export, con, output_path, options):
+	# The whole of `export()`, table planning and checkpoints included, with
+	# `output_path` as the workspace and a stand-in for the GDB file; the
+	# synthetic database is "already running", so no server is started
+	os.makedirs(output_path)
+	open(os.path.join(output_path, "bench.gdb"), "wb").close()
+	export.get_workspace = lambda workspace="": output_path
+	export.is_firebird_ready = lambda timeout=0.5: True
+	export.export("bench.gdb", chunk_size=options["chunk_size"])
+	return os.path.join(output_path, "csv")
+
+
+# Name => function(export, connection, output_path, options) that exports the
+# synthetic table and returns where the output went
+MODES = {
+	"plain": export_plain,
+	"chunked-pk": export_chunked("csv"),
+	"chunked-dbkey": export_chunked("csv"),
+	"chunked-skip": export_chunked("csv", keyset=False),
+	"chunked-adaptive": export_adaptive,
+	"chunked-pipelined": export_chunked("csv", pipeline=2),
+	"zip": export_chunked("zip"),
+	"parquet": export_chunked("parquet"),
+	"export": export_end_to_end,
+}
+
+
+def get_size(path):
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	total = 0
+	for (root, _, files) in os.walk(path):
+		for filename in files:
+			total += os.path.getsize(os.path.join(root, filename))
+	return total
+
+
+def run_mode(mode, options):
+	"""Runs one mode in this process and returns its measurements"""
+	sys.path.insert(0, BENCHMARKS_PATH)
+	sys.path.insert(0, SRC_PATH)
+	import synthetic  # ./synthetic.py
+	sys.modules["firebirdsql"] = synthetic
+	import export  # ../src/export.py
+
+	# The export logs every chunk; that's not what we're measuring
+	if not options["verbose"]:
+		export.log = lambda msg: None
+
+	synthetic.database = synthetic.Database([
+		synthetic.SyntheticTable(
+			TABLE_NAME,
+			options["rows"],
+			options["width"],
+			options["types"],
+			text_length=options["text_length"],
+			blob_size=options["blob_size"],
+			primary_key=(mode != "chunked-dbkey"),
+		)
+	], latency=options["fetch_latency"] / 1000)
+	con = synthetic.connect(charset="ISO8859_1")
+
+	directory = tempfile.mkdtemp(prefix="gdb2csv-bench-")
+	try:
+		START_TIME = time.perf_counter()
+		output_path = MODES[mode](export, con, os.path.join(directory, "out"), options)
+		seconds = time.perf_counter() - START_TIME
+		output_bytes = get_size(output_path)
+	finally:
+		shutil.rmtree(directory)
+
+	return {
+		"rows": options["rows"],
+		"seconds": round(seconds, 3),
+		"rows_per_sec": round(options["rows"] / seconds, 1),
+		"mb_per_sec": round(output_bytes / seconds / 1024 / 1024, 2),
+		"output_bytes": output_bytes,
+		# KiB on Linux
+		"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+	}
+
+
+def get_config_key(options):
+	"""Results are only comparable to a baseline taken with the same table"""
+	return json.dumps({
+		key: options[key]
+		for key in ("rows", "width", "types", "text_length", "blob_size", "chunk_size", "fetch_latency")
+	}, sort_keys=True)
+
+
+def relative(results, mode, key):
+	"""`mode`'s `key` as a multiple of the reference mode's, from the same run"""
+	return results[mode][key] / results[REFERENCE_MODE][key]
+
+
+def compare(mode, results, baseline, tolerance):
+	"""Returns the ways in which `mode` did worse, next to the reference mode,
+	in `results` than in `baseline`"""
+	regressions = []
+	speed, baseline_speed = relative(results, mode, "rows_per_sec"), relative(baseline, mode, "rows_per_sec")
+	if speed < baseline_speed * (1 - tolerance):
+		regressions.append(
+			f"{mode}: {speed:.2f}x the speed of {REFERENCE_MODE}, down from {baseline_speed:.2f}x"
+		)
+	rss, baseline_rss = relative(results, mode, "peak_rss_mb"), relative(baseline, mode, "peak_rss_mb")
+	if rss > baseline_rss * (1 + tolerance):
+		regressions.append(
+			f"{mode}: {rss:.2f}x the peak RSS of {REFERENCE_MODE}, up from {baseline_rss:.2f}x"
+		)
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=100_000)
+	parser.add_argument("--width", type=int, default=10, help="Columns per table, ID included")
+	parser.add_argument("--types", default="int,decimal,timestamp,text,blob",
+		help="Column types to cycle through: int, decimal, timestamp, text, blob")
+	parser.add_argument("--text-length", type=int, default=40)
+	parser.add_argument("--blob-size", type=int, default=256)
+	parser.add_argument("--chunk-size", type=int, default=10_000)
+	parser.add_argument("--fetch-latency", type=float, default=0,
+		help="Milliseconds the database takes per 1000 rows selected, as if it were a real server")
+	parser.add_argument("--modes", default=",".join(MODES))
+	parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+	parser.add_argument("--save-baseline", action="store_true")
+	parser.add_argument("--tolerance", type=float, default=0.2,
+		help="How much slower/bigger than in the baseline, next to plain, a mode may get (0.2 = 20%%)")
+	parser.add_argument("--repeat", type=int, default=3,
+		help="Runs of each mode; the fastest one counts")
+	parser.add_argument("--verbose", action="store_true")
+	# Used internally to run each mode in its own process
+	parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	options = {
+		"rows": args.rows,
+		"width": args.width,
+		"types": args.types.split(","),
+		"text_length": args.text_length,
+		"blob_size": args.blob_size,
+		"chunk_size": args.chunk_size,
+		"fetch_latency": args.fetch_latency,
+		"verbose": args.verbose,
+	}
+
+	if args.run_mode:
+		print(json.dumps(run_mode(args.run_mode, options)))
+		return 0
+
+	modes = args.modes.split(",")
+	for mode in modes:
+		if mode not in MODES:
+			parser.error(f"Unknown mode '{mode}'; choose from {', '.join(MODES)}")
+	# Every other mode is measured against it, so it always runs, and first
+	modes = [ REFERENCE_MODE ] + [ mode for mode in modes if mode != REFERENCE_MODE ]
+
+	config_key = get_config_key(options)
+	baselines = dict()
+	if os.path.isfile(args.baseline):
+		with open(args.baseline, "r", encoding="utf-8") as f:
+			baselines = json.load(f)
+	baseline = baselines.get(config_key, dict())
+	# Without a baseline there's nothing to compare to, and a check that can't
+	# fail isn't one
+	if not baseline and not args.save_baseline:
+		print(f"No baseline for this configuration in '{args.baseline}'; run with --save-baseline to store one")
+		return 1
+
+	results = dict()
+	failures = dict()
+	# Timings vary from run to run by much more than what we're looking for,
+	# so each mode is judged by its best run; and the runs go round all modes
+	# in turn, so a slow spell on the machine doesn't land on just one of them
+	for _ in range(max(args.repeat, 1)):
+		for mode in modes:
+			if mode in failures:
+				continue
+			command = [ sys.executable, os.path.abspath(__file__), "--run-mode", mode ] + sys.argv[1:]
+			process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+			if process.returncode != 0:
+				failures[mode] = process.returncode
+				results.pop(mode, None)
+				continue
+			run = json.loads(process.stdout.strip().splitlines()[-1])
+			if mode not in results or run["rows_per_sec"] > results[mode]["rows_per_sec"]:
+				results[mode] = run
+
+	regressions = []
+	print(f"{'mode':<18}{'rows/s':>12}{'MB/s':>10}{'peak RSS MB':>14}{'vs plain':>10}{'baseline':>10}")
+	for mode in modes:
+		if mode in failures:
+			print(f"{mode:<18}failed (exit status {failures[mode]})")
+			regressions.append(f"{mode}: failed")
+			continue
+		if REFERENCE_MODE in failures:
+			# Nothing else can be compared without it
+			print(f"{mode:<18}{results[mode]['rows_per_sec']:>12}")
+			continue
+		result = results[mode]
+
+		baseline_speed = ""
+		speed = f"{relative(results, mode, 'rows_per_sec'):.2f}x"
+		if mode in baseline and REFERENCE_MODE in baseline:
+			baseline_speed = f"{relative(baseline, mode, 'rows_per_sec'):.2f}x"
+			if mode != REFERENCE_MODE:
+				regressions.extend(compare(mode, results, baseline, args.tolerance))
+		print(f"{mode:<18}{result['rows_per_sec']:>12}{result['mb_per_sec']:>10}{result['peak_rss_mb']:>14}{speed:>10}{baseline_speed:>10}")
+
+	if args.save_baseline:
+		baselines[config_key] = dict(baseline, **results)
+		with open(args.baseline, "w", encoding="utf-8") as f:
+			json.dump(baselines, f, indent=2, sort_keys=True)
+		print(f"Saved baseline to '{args.baseline}'")
+		return 0
+
+	if regressions:
+		print("\nREGRESSIONS:")
+		for regression in regressions:
+			print(f" - {regression}")
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks how rows are turned into CSV text, without any database.
+
+Compares the generic path (each batch's column types inferred from the
+values, like pandas did) with formatters picked from the columns' Firebird
+types, with and without transcoding text columns, and checks that they write
+the same bytes. Text is served the way the driver gives it to us with the
+connection in ISO8859_1: WIN1252 bytes, each decoded as one character.
+
+	python3 benchmarks/serialize.py --rows 200000 --types int,text,timestamp
+"""
+import os
+import io
+import sys
+import time
+import hashlib
+import argparse
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_PATH)
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, "..", "src"))
+import synthetic  # ./synthetic.py
+import writers  # ../src/writers.py
+
+
+def make_batches(table, rows, batch_size):
+	"""Rows as `fetchmany()` would return them, built before timing starts"""
+	text_columns = [ i for (i, t) in enumerate(table.column_types) if t == "text" ]
+
+	def as_driver_decodes(row):
+		row = list(row)
+		for i in text_columns:
+			if row[i] is not None:
+				row[i] = row[i].encode("cp1252").decode("iso8859_1")
+		return tuple(row)
+
+	templates = [ as_driver_decodes(table.get_row(i)) for i in range(synthetic.TEMPLATE_ROWS) ]
+	return [
+		[ templates[i % len(templates)] for i in range(start, min(start + batch_size, rows)) ]
+		for start in range(0, rows, batch_size)
+	]
+
+
+def transcode_per_value(values):
+	"""What transcoding would cost done value by value, for comparison"""
+	return [ v if v is None else v.encode("iso8859_1").decode("cp1252") for v in values ]
+
+
+def run(batches, columns, formatters, repeat):
+	"""Returns (best seconds, digest of the output)"""
+	best = None
+	digest = None
+	for _ in range(repeat):
+		buffer = io.StringIO()
+		writer = writers.CsvTableWriter(buffer, "benchmark", columns, formatters=formatters)
+		start = time.perf_counter()
+		for batch in batches:
+			writer.write_rows(batch)
+		# Encoding to UTF-8 is part of writing the file
+		data = buffer.getvalue().encode("utf-8")
+		seconds = time.perf_counter() - start
+		best = seconds if best is None else min(best, seconds)
+		digest = hashlib.sha256(data).hexdigest()
+	return (best, digest)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=100_000)
+	parser.add_argument("--width", type=int, default=10, help="Columns per table, ID included")
+	parser.add_argument("--types", default="int,decimal,timestamp,text,blob",
+		help="Column types to cycle through: int, decimal, timestamp, text, blob")
+	parser.add_argument("--text-length", type=int, default=40)
+	parser.add_argument("--blob-size", type=int, default=64)
+	parser.add_argument("--batch-size", type=int, default=10_000)
+	parser.add_argument("--repeat", type=int, default=3, help="Runs per path; the best one counts")
+	args = parser.parse_args()
+
+	table = synthetic.SyntheticTable(
+		"SYNTHETIC", args.rows, args.width, args.types.split(","),
+		text_length=args.text_length, blob_size=args.blob_size
+	)
+	batches = make_batches(table, args.rows, args.batch_size)
+	field_types = {
+		column: (field_type, sub_type, scale, precision)
+		for (_, column, field_type, sub_type, scale, precision) in table.field_types()
+	}
+	transcode = writers.make_transcoder("iso8859_1", "cp1252")
+
+	paths = [
+		# (name, formatters, output should match this other path)
+		("inferred", None, None),
+		("typed", writers.get_column_formatters(table.columns, field_types), "inferred"),
+		("inferred+transcode per value", [
+			transcode_per_value if t == "text" else writers.format_column
+			for t in table.column_types
+		], None),
+		("typed+transcode", writers.get_column_formatters(table.columns, field_types, transcode), "inferred+transcode per value"),
+	]
+
+	print(f"{'path':<32}{'rows/s':>12}{'vs inferred':>14}  output")
+	results = dict()
+	failed = False
+	for (name, formatters, same_as) in paths:
+		(seconds, digest) = run(batches, table.columns, formatters, args.repeat)
+		results[name] = (seconds, digest)
+		check = ""
+		if same_as is not None:
+			check = "same" if digest == results[same_as][1] else f"DIFFERS from {same_as}"
+			failed = failed or digest != results[same_as][1]
+		speedup = results["inferred"][0] / seconds
+		print(f"{name:<32}{round(args.rows / seconds):>12}{speedup:>13.2f}x  {check}")
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""A stand-in for `firebirdsql` that serves synthetic tables, so exports can
+be benchmarked without a Firebird server or a real backup.
+
+It answers the queries `export.py` makes (table list, column types and sizes,
+primary keys, index statistics, COUNT(*) and column profiles, whole-table and chunked SELECTs,
+both with key cursors and FIRST/SKIP) and returns the same Python types the real driver does. Rows are
+built from a small pool of templates, so generating them costs next to
+nothing and doesn't count towards the export's time or memory, unless the
+database is given a `latency`, the seconds that every 1000 rows of a SELECT
+take to "run" (sleeping, like the driver waiting on the server's socket)."""
+import re
+import time
+import decimal
+import datetime
+
+
+# Firebird column types, as found in RDB$FIELDS
+# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-fields.html
+FIELD_TYPES = {
+	"int": (8, 0, 0, 0),
+	"decimal": (16, 2, -2, 18),
+	"timestamp": (35, 0, 0, 0),
+	"text": (37, 0, 0, 0),
+	"blob": (261, 0, 0, 0),
+}
+# RDB$FIELD_LENGTH of each; text columns are declared larger than what's in
+# them, like they usually are
+FIELD_LENGTHS = {
+	"int": 4,
+	"decimal": 8,
+	"timestamp": 8,
+	"text": 200,
+	"blob": 8,
+}
+
+# Accented text, as most of what's in our backups is; all of it fits WIN1252
+TEXT_SAMPLE = "Atenção à saúde – São Sebastião, Méier, Irajá, Guaratiba € "
+
+# How many distinct rows each table cycles through
+TEMPLATE_ROWS = 997
+
+
+class OperationalError(Exception):
+	pass
+
+
+class consts:
+	# `export.dbkey_to_bytes()` looks charsets up here
+	charset_map = {
+		"ISO8859_1": "iso8859_1",
+		"WIN1252": "cp1252",
+		"UTF8": "utf_8",
+	}
+
+
+def make_value(column_type, i, text_length, blob_size):
+	if column_type == "int":
+		return (i * 7919) % 1000003
+	if column_type == "decimal":
+		return decimal.Decimal(i * 104729 % 100000000) / 100
+	if column_type == "timestamp":
+		return datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=i * 3607)
+	if column_type == "text":
+		start = i % len(TEXT_SAMPLE)
+		text = (TEXT_SAMPLE * (text_length // len(TEXT_SAMPLE) + 2))[start:start + text_length]
+		# Some NULLs, like real data has
+		return None if i % 13 == 0 else text
+	if column_type == "blob":
+		return bytes((i + j) % 256 for j in range(blob_size))
+	raise ValueError(f"Unknown column type '{column_type}'")
+
+
+class SyntheticTable:
+	"""`rows` rows of an 'ID' primary key column followed by `width - 1`
+	columns, whose types cycle through `types`"""
+
+	def __init__(self, name, rows, width, types, text_length=40, blob_size=256, primary_key=True):
+		self.name = name
+		self.rows = rows
+		self.primary_key = primary_key
+		self.column_types = [ "int" ] + [ types[i % len(types)] for i in range(width - 1) ]
+		self.columns = [ "ID" ] + [
+			f"{column_type.upper()}_{i}"
+			for (i, column_type) in enumerate(self.column_types[1:], start=1)
+		]
+		self.templates = [
+			tuple(
+				make_value(column_type, t * len(self.columns) + c, text_length, blob_size)
+				for (c, column_type) in enumerate(self.column_types[1:])
+			)
+			for t in range(TEMPLATE_ROWS)
+		]
+
+	def get_row(self, i):
+		return (i + 1,) + self.templates[i % TEMPLATE_ROWS]
+
+	def get_dbkey(self, i):
+		return (i + 1).to_bytes(8, "big")
+
+	def field_types(self):
+		return [
+			(self.name, column, *FIELD_TYPES[column_type])
+			for (column, column_type) in zip(self.columns, self.column_types)
+		]
+
+	def get_column(self, column):
+		"""Every distinct value of the column, as many times as it's in the table's
+		first `TEMPLATE_ROWS` rows"""
+		index = self.columns.index(column)
+		return [ self.get_row(i)[index] for i in range(min(self.rows, TEMPLATE_ROWS)) ]
+
+	def aggregate(self, expression):
+		"""Answers the aggregates `export.get_table_profile()` asks for. Beyond
+		`TEMPLATE_ROWS`, values repeat, so counts are only right as far as being
+		zero or not"""
+		if expression == "COUNT(*)":
+			return self.rows
+		column = re.search(r"(?:COUNT|MIN|MAX)\((\w+)\)|FROM (\w+)\)", expression)
+		values = self.get_column(column.group(1) or column.group(2))
+		non_null = [ v for v in values if v is not None ]
+		if expression.startswith("COUNT(*) - COUNT("):
+			return len(values) - len(non_null)
+		if not non_null:
+			return None
+		if expression.startswith("MIN("):
+			return min(non_null)
+		if expression.startswith("MAX(CASE WHEN EXTRACT(HOUR"):
+			return max(0 if v.time() == datetime.time(0) else 1 for v in non_null)
+		if expression.startswith("MAX(CASE WHEN EXTRACT(SECOND"):
+			return max(2 if v.microsecond % 1000 else 1 if v.microsecond else 0 for v in non_null)
+		if expression.startswith("MAX("):
+			return max(non_null)
+		raise OperationalError(f"Synthetic database can't compute: {expression}")
+
+	def field_lengths(self):
+		return [
+			(self.name, column, FIELD_TYPES[column_type][0], FIELD_LENGTHS[column_type])
+			for (column, column_type) in zip(self.columns, self.column_types)
+		]
+
+
+class Database:
+	def __init__(self, tables, latency=0):
+		self.tables = { table.name: table for table in tables }
+		self.latency = latency
+
+
+# Set by the benchmark before it connects
+database = Database([])
+
+
+class Cursor:
+	def __init__(self, con):
+		self.con = con
+		self.description = None
+		self.rows = iter(())
+
+	def set_result(self, columns, rows):
+		self.description = [ (column,) for column in columns ]
+		self.rows = iter(rows)
+
+	def execute(self, query, params=None):
+		query = " ".join(query.split())
+		tables = database.tables
+
+		if "FROM RDB$DATABASE" in query:
+			return self.set_result([ "CONSTANT" ], [ (1,) ])
+		if "FROM RDB$RELATION_CONSTRAINTS" in query:
+			table = tables[re.search(r"RDB\$RELATION_NAME = '(\w+)'", query).group(1)]
+			# System table columns are CHAR(31); the driver strips their padding
+			return self.set_result(
+				[ "RDB$FIELD_NAME" ],
+				[ ("ID",) ] if table.primary_key else []
+			)
+		if "FROM RDB$INDICES" in query:
+			# The primary key's index; its selectivity is 1 / rows
+			return self.set_result(
+				[ "RDB$RELATION_NAME", "MIN" ],
+				[ (name, 1 / table.rows) for (name, table) in tables.items() if table.primary_key and table.rows ]
+			)
+		if "FROM RDB$RELATION_FIELDS" in query and "RDB$NULL_FLAG" in query:
+			# Only the primary key is NOT NULL
+			table = tables[re.search(r"RDB\$RELATION_NAME = '(\w+)'", query).group(1)]
+			return self.set_result(
+				[ "RDB$FIELD_NAME" ],
+				[ (column,) for column in table.columns if column != "ID" or not table.primary_key ]
+			)
+		if "FROM RDB$RELATION_FIELDS" in query and "RDB$FIELD_LENGTH" in query:
+			return self.set_result(
+				[ "RDB$RELATION_NAME", "RDB$FIELD_NAME", "RDB$FIELD_TYPE", "RDB$FIELD_LENGTH" ],
+				[ row for table in tables.values() for row in table.field_lengths() ]
+			)
+		if "FROM RDB$RELATION_FIELDS" in query:
+			return self.set_result(
+				[ "RDB$RELATION_NAME", "RDB$FIELD_NAME", "RDB$FIELD_TYPE", "RDB$FIELD_SUB_TYPE", "RDB$FIELD_SCALE", "RDB$FIELD_PRECISION" ],
+				[ row for table in tables.values() for row in table.field_types() ]
+			)
+		if "FROM RDB$RELATIONS" in query:
+			return self.set_result(
+				[ "RDB$RELATION_NAME" ],
+				[ (name,) for name in sorted(tables) ]
+			)
+
+		match = re.match(r"SELECT (COUNT\(\*\).*?) FROM (\w+)$", query)
+		if match:
+			table = tables[match.group(2)]
+			expressions = match.group(1).split(", ")
+			return self.set_result(
+				[ "COUNT" ] * len(expressions),
+				[ tuple(table.aggregate(expression) for expression in expressions) ]
+			)
+
+		match = re.match(
+			r"SELECT (?:FIRST (\d+) )?(?:SKIP (\d+) )?(\*|CAST\(RDB\$DB_KEY AS VARCHAR\(8\) CHARACTER SET OCTETS\), \w+\.\*) "
+			r"FROM (\w+)(?: WHERE ([\w$]+) > \?)?(?: ORDER BY [\w$]+)?$",
+			query
+		)
+		if not match:
+			raise OperationalError(f"Synthetic database can't run: {query}")
+		(first, skip, selection, table_name, where) = match.groups()
+		table = tables[table_name]
+
+		# Rows are numbered from 0 and sorted both by ID and by RDB$DB_KEY
+		start = 0
+		if where == "RDB$DB_KEY":
+			start = int.from_bytes(params[0], "big")
+		elif where:
+			start = int(params[0])
+		start += int(skip or 0)
+		end = table.rows if first is None else min(start + int(first), table.rows)
+		if database.latency and end > start:
+			time.sleep(database.latency * (end - start) / 1000)
+
+		if selection == "*":
+			rows = (table.get_row(i) for i in range(start, end))
+			return self.set_result(table.columns, rows)
+		rows = ((table.get_dbkey(i),) + table.get_row(i) for i in range(start, end))
+		return self.set_result([ "CAST" ] + table.columns, rows)
+
+	def fetchmany(self, size=1):
+		rows = []
+		for row in self.rows:
+			rows.append(row)
+			if len(rows) >= size:
+				break
+		return rows
+
+	def fetchall(self):
+		return list(self.rows)
+
+	def close(self):
+		pass
+
+
+class Connection:
+	def __init__(self, charset):
+		self.charset = charset
+
+	def cursor(self):
+		return Cursor(self)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+	def close(self):
+		pass
+
+
+def connect(dsn=None, user=None, password=None, charset="WIN1252", **kwargs):
+	return Connection(charset)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+
+
+def read_json(file_path):
+	try:
+		with open(file_path, "r", encoding="utf-8") as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return None
+
+
+def write_json(file_path, data):
+	# Writes to a temporary file first and then renames it over the old one, so
+	# a crash halfway through never leaves us with a half-written checkpoint
+	tmp_path = f"{file_path}.tmp"
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(data, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, file_path)
+
+
+class Checkpoint:
+	"""Keeps track of an export's progress, so that a restarted export can skip
+	the tables it has already finished and continue the others from the last
+	chunk it wrote. Progress lives in `directory`: a 'manifest.json' describing
+	the export, plus one '<table>.json' per table; since a table is only ever
+	exported by one worker at a time, parallel workers (even in separate
+	processes) never write to the same file.
+
+	Table files hold either `{ "status": "done" }` or, for tables exported in
+	chunks, `{ "status": "partial", "cursor": ..., "rows": ..., "bytes": ... }`,
+	where `cursor` can be passed as `cont` and `bytes` is the size of the output
+	file when that cursor was saved"""
+
+	def __init__(self, directory, fingerprint):
+		self.directory = directory
+		# Anything that changes the output of the export (the GDB itself, the
+		# requested tables, the output format, ...); if it doesn't match, the
+		# checkpoint is from a different export and we can't use it
+		self.fingerprint = fingerprint
+
+	def manifest_path(self):
+		return os.path.join(self.directory, "manifest.json")
+
+	def table_path(self, table_name):
+		return os.path.join(self.directory, f"{table_name}.json")
+
+	def load(self):
+		"""Returns whether there's progress to continue from. If the checkpoint is
+		missing or belongs to a different export, starts a new one"""
+		manifest = read_json(self.manifest_path())
+		if manifest and manifest.get("fingerprint") == self.fingerprint:
+			return True
+		self.clear()
+		os.makedirs(self.directory, exist_ok=True)
+		write_json(self.manifest_path(), { "fingerprint": self.fingerprint })
+		return False
+
+	def get_table(self, table_name):
+		return read_json(self.table_path(table_name))
+
+	def save_table(self, table_name, state):
+		write_json(self.table_path(table_name), state)
+
+	def is_done(self, table_name):
+		state = self.get_table(table_name)
+		return bool(state) and state.get("status") == "done"
+
+	def clear(self):
+		if os.path.exists(self.directory):
+			shutil.rmtree(self.directory)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import hashlib
+
+from checkpoint import read_json, write_json  # ./checkpoint.py
+
+
+# Where each series of snapshots keeps the manifest of its last export
+DELTA_PATH = "/data/delta"
+# Name of the manifest written next to the exported tables
+MANIFEST_NAME = "delta_manifest.json"
+
+
+def hash_rows(rows):
+	"""Hashes a chunk of rows, one row after the other. `repr()` tells apart
+	values that would look the same in a CSV (None and '', 1 and '1', ...)"""
+	digest = hashlib.sha1()
+	for row in rows:
+		digest.update(repr(tuple(row)).encode("utf-8", "surrogatepass"))
+		digest.update(b"\n")
+	return digest.hexdigest()
+
+
+def get_table_status(chunks, complete=True):
+	written = [ chunk for chunk in chunks if chunk["written"] ]
+	if not complete or len(written) == len(chunks):
+		return "written"
+	if not written:
+		return "reused"
+	return "partial"
+
+
+# Manifests are read once per process (and again if they change), since every
+# table needs its own slice of it
+manifest_cache = dict()
+
+def load_manifest(file_path):
+	mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else None
+	if file_path not in manifest_cache or manifest_cache[file_path][0] != mtime:
+		manifest_cache[file_path] = (mtime, read_json(file_path) or dict())
+	return manifest_cache[file_path][1]
+
+
+class Delta:
+	"""Exports only the chunks of each table that changed since the previous
+	snapshot of the same `series` (e.g. the daily backups of one database).
+
+	Every chunk is fingerprinted by its row count and a hash of its rows; a
+	chunk with the same fingerprint as one in the previous snapshot's manifest
+	is reused instead of written. The same rows can be formatted differently
+	depending on the rest of the table (see `get_table_profile()` in
+	export.py), so the manifest also keeps each table's formatting profile,
+	and a table whose profile changed is written again in full.
+
+	The new manifest says, for every chunk of every table, which snapshot
+	wrote it (`source`) and at which row of that snapshot's output of the
+	table it starts (`offset`), so the full table can be put back together
+	from the snapshots listed under `outputs`.
+
+	Progress of each table is kept in '<table>.json' inside `directory`, like
+	`Checkpoint`, so parallel workers (even in separate processes) never write
+	to the same file, and an interrupted table can be continued"""
+
+	def __init__(self, series, snapshot, directory):
+		self.series = series
+		self.snapshot = snapshot
+		self.directory = directory
+
+	def previous_path(self):
+		return os.path.join(DELTA_PATH, f"{self.series}.json")
+
+	def next_path(self):
+		# Only becomes the series' manifest once whoever asked for the export is
+		# done with it (i.e. once it's uploaded), by being renamed to
+		# '<series>.json' and having this snapshot's output added to `outputs`;
+		# until then, the next export must still compare itself against the
+		# current one
+		return os.path.join(DELTA_PATH, f"{self.series}.next.json")
+
+	def table_path(self, table_name):
+		return os.path.join(self.directory, f"{table_name}.json")
+
+	def start(self, resuming=False):
+		if not resuming and os.path.exists(self.directory):
+			shutil.rmtree(self.directory)
+		os.makedirs(self.directory, exist_ok=True)
+
+	def previous_snapshot(self):
+		return load_manifest(self.previous_path()).get("snapshot")
+
+	def open_table(self, table_name, cont=0):
+		previous = load_manifest(self.previous_path()).get("tables", dict())
+		state = None
+		# Continuing the table: keep the chunks up to the one `cont` points after
+		if cont and cont != "0":
+			state = read_json(self.table_path(table_name))
+		return TableDelta(
+			self,
+			table_name,
+			previous.get(table_name, dict()).get("chunks", []),
+			state,
+			str(cont),
+			previous.get(table_name, dict()).get("profile")
+		)
+
+	def has_table(self, table_name):
+		state = read_json(self.table_path(table_name))
+		return bool(state) and state.get("done", False)
+
+	def write_manifest(self, tables, output, chunk_size):
+		"""Puts together the manifest for `tables`, writes it next to the exported
+		tables and as the series' next manifest. Returns it"""
+		previous = load_manifest(self.previous_path())
+		manifest = {
+			"series": self.series,
+			"snapshot": self.snapshot,
+			"previous": previous.get("snapshot"),
+			"chunk_size": chunk_size,
+			# Where the output of every earlier snapshot went
+			"outputs": previous.get("outputs", dict()),
+			"tables": dict(),
+		}
+		for table_name in tables:
+			state = read_json(self.table_path(table_name)) or dict()
+			chunks = state.get("chunks", [])
+			complete = state.get("complete", False)
+			manifest["tables"][table_name] = {
+				"rows": sum(chunk["rows"] for chunk in chunks),
+				"status": get_table_status(chunks, complete),
+				"profile": state.get("profile"),
+				"hash": (
+					hash_rows((chunk["hash"], chunk["rows"]) for chunk in chunks)
+					if complete else None
+				),
+				"chunks": [
+					{
+						"hash": chunk["hash"],
+						"rows": chunk["rows"],
+						"source": chunk["source"],
+						"offset": chunk["offset"],
+					}
+					for chunk in chunks
+				] if complete else [],
+			}
+
+		# Earlier snapshots no chunk comes from anymore can be forgotten
+		sources = {
+			chunk["source"]
+			for table in manifest["tables"].values()
+			for chunk in table["chunks"]
+		}
+		manifest["outputs"] = {
+			snapshot: uri
+			for (snapshot, uri) in manifest["outputs"].items()
+			if snapshot in sources
+		}
+
+		output.write_file(MANIFEST_NAME, json.dumps(manifest))
+		os.makedirs(DELTA_PATH, exist_ok=True)
+		write_json(self.next_path(), manifest)
+		return manifest
+
+	def clear(self):
+		if os.path.exists(self.directory):
+			shutil.rmtree(self.directory)
+
+
+class TableDelta:
+	"""Fingerprints the chunks of one table as they're read and decides which
+	of them need to be written"""
+
+	def __init__(self, delta, table_name, previous_chunks, state=None, cont=None, previous_profile=None):
+		self.delta = delta
+		self.table_name = table_name
+		# Previous chunks by fingerprint; identical chunks are interchangeable
+		self.previous = {
+			(chunk["hash"], chunk["rows"]): chunk
+			for chunk in previous_chunks
+		}
+		self.previous_profile = previous_profile
+		self.profile = None
+		self.chunks = []
+		self.complete = True
+		if state is not None:
+			cursors = [ chunk["cursor"] for chunk in state.get("chunks", []) ]
+			if cont in cursors:
+				self.chunks = state["chunks"][:cursors.index(cont)+1]
+				self.complete = state.get("complete", True)
+			else:
+				# We don't know what came before `cont`, so this table can't be
+				# compared against the next snapshot
+				self.complete = False
+		elif cont and cont != "0":
+			self.complete = False
+		self.written_rows = sum(
+			chunk["rows"] for chunk in self.chunks if chunk["written"]
+		)
+
+	def set_profile(self, profile):
+		"""Sets how the table's columns are formatted (as given to the output's
+		`open_table()`). If that's not how the previous snapshot's chunks were
+		formatted, none of them can be reused; returns False in that case"""
+		self.profile = profile
+		if self.previous and profile != self.previous_profile:
+			self.previous = dict()
+			return False
+		return True
+
+	def add_chunk(self, rows, cursor):
+		"""Records the chunk; returns whether it has to be written"""
+		fingerprint = (hash_rows(rows), len(rows))
+		previous = self.previous.get(fingerprint)
+		# An empty table still gets its header written, unless it was empty before
+		write = (previous is None)
+		self.chunks.append({
+			"hash": fingerprint[0],
+			"rows": fingerprint[1],
+			"written": write,
+			"source": self.delta.snapshot if write else previous["source"],
+			"offset": self.written_rows if write else previous["offset"],
+			"cursor": cursor,
+		})
+		if write:
+			self.written_rows += len(rows)
+		self.save()
+		return write
+
+	def finish(self):
+		self.save(done=True)
+		reused = len([ chunk for chunk in self.chunks if not chunk["written"] ])
+		return (reused, len(self.chunks))
+
+	def save(self, done=False):
+		write_json(self.delta.table_path(self.table_name), {
+			"profile": self.profile,
+			"chunks": self.chunks,
+			"complete": self.complete,
+			"done": done,
+		})
+
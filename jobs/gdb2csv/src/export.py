@@ -1,37 +1,193 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import socket
 import shutil
 import subprocess
 import time
+import uuid
 import datetime
+import threading
+import multiprocessing
+import concurrent.futures
+from typing import Union
 
 import firebirdsql
-import pandas as pd
+from prometheus_client import Counter, Histogram
 
+from writers import CsvDirectoryOutput, ZipArchiveOutput, ParquetDirectoryOutput, make_transcoder, get_profiled_columns, get_timestamp_profile, PROFILE_INT  # ./writers.py
+from checkpoint import Checkpoint  # ./checkpoint.py
+from delta import Delta  # ./delta.py
+from progress import Progress  # ./progress.py
+from planning import ChunkSizer, estimate_column_bytes, get_chunk_size, order_largest_first  # ./planning.py
+from pipeline import Prefetcher  # ./pipeline.py
+from selection import parse_table_list, build_selection, has_column, get_select_list, get_where, get_params  # ./selection.py
+
+
+# When exporting tables in parallel, each worker thread tags its log lines with
+# the table it's working on, so the interleaved output is still readable
+log_context = threading.local()
+log_lock = threading.Lock()
 
 def log(msg):
 	current_time = datetime.datetime.now().replace(tzinfo=None)
-	print(f"{current_time}| {msg}", flush=True)
+	table = getattr(log_context, "table", None)
+	prefix = f"[{table}] " if table else ""
+	with log_lock:
+		print(f"{current_time}| {prefix}{msg}", flush=True)
+
+
+# Firebird's server listens on port 3050 once it's up
+# [Ref] https://firebirdsql.org/manual/qsg15-config.html
+FIREBIRD_HOST = "localhost"
+FIREBIRD_PORT = 3050
+# How long to wait for Firebird to come up: 0.05s, 0.1s, 0.2s, ... up to 2s
+# between checks, for at most a minute
+READY_BASE_DELAY = 0.05
+READY_MAX_DELAY = 2
+READY_TIMEOUT = 60
+
+firebird_lock = threading.Lock()
+
+def is_firebird_ready(timeout=0.5):
+	try:
+		with socket.create_connection((FIREBIRD_HOST, FIREBIRD_PORT), timeout=timeout):
+			return True
+	except OSError:
+		return False
+
+
+def start_firebird():
+	"""Makes sure Firebird is running, starting it if it isn't, and waits until
+	it accepts connections. Returns right away if it's already up"""
+	if is_firebird_ready():
+		return
+	# Only one thread starts the server; the others just wait for it
+	with firebird_lock:
+		if is_firebird_ready():
+			return
+		log("Starting Firebird")
+		# This command might be run multiple times but it doesn't error out
+		subprocess.call(["/etc/init.d/firebird", "start"])
+		START_TIME = time.time()
+		delay = READY_BASE_DELAY
+		while not is_firebird_ready():
+			if time.time() - START_TIME > READY_TIMEOUT:
+				log("Firebird didn't start :(")
+				raise ConnectionError(f"Firebird isn't accepting connections after {READY_TIMEOUT}s")
+			time.sleep(delay)
+			delay = min(delay * 2, READY_MAX_DELAY)
+		log(f"Firebird is up after {time.time() - START_TIME:.2f}s")
+
+
+class ConnectionPool:
+	"""Keeps connections that are done being used around for a little while, so
+	the next export (or retry, or worker) of the same database doesn't have to
+	connect again. Idle connections are closed after `idle_timeout` seconds, or
+	as soon as their database file is gone, so Firebird doesn't hold on to
+	files that were already deleted"""
+
+	CHECK_INTERVAL = 10
+
+	def __init__(self, idle_timeout=60):
+		self.idle_timeout = idle_timeout
+		self.lock = threading.Lock()
+		# (db_path, user, password, charset) => [ (connection, released_at) ]
+		self.idle = dict()
+		# id(connection) => key, for connections this pool handed out
+		self.keys = dict()
+		self.reaper = None
+
+	def acquire(self, key):
+		while True:
+			with self.lock:
+				if not self.idle.get(key):
+					return None
+				(con, _) = self.idle[key].pop()
+			# It might have been dropped while it sat there
+			try:
+				cur = con.cursor()
+				cur.execute("SELECT 1 FROM RDB$DATABASE")
+				cur.fetchall()
+				cur.close()
+				return con
+			except Exception:
+				self.discard(con)
+
+	def add(self, key, con):
+		with self.lock:
+			self.keys[id(con)] = key
+
+	def release(self, con):
+		with self.lock:
+			key = self.keys.get(id(con))
+		if key is None or not os.path.exists(key[0]):
+			self.discard(con)
+			return
+		try:
+			# Whatever transaction the last export left open is of no use now
+			con.rollback()
+		except Exception:
+			self.discard(con)
+			return
+		with self.lock:
+			self.idle.setdefault(key, []).append((con, time.time()))
+			if self.reaper is None:
+				self.reaper = threading.Thread(target=self.reap_forever, daemon=True)
+				self.reaper.start()
+
+	def discard(self, con):
+		with self.lock:
+			self.keys.pop(id(con), None)
+		try:
+			con.close()
+		except Exception:
+			pass
+
+	def reap(self):
+		now = time.time()
+		stale = []
+		with self.lock:
+			for (key, connections) in self.idle.items():
+				keep = []
+				for (con, released_at) in connections:
+					if now - released_at > self.idle_timeout or not os.path.exists(key[0]):
+						stale.append(con)
+					else:
+						keep.append((con, released_at))
+				self.idle[key] = keep
+		for con in stale:
+			self.discard(con)
+
+	def reap_forever(self):
+		while True:
+			time.sleep(self.CHECK_INTERVAL)
+			self.reap()
+
 
+connection_pool = ConnectionPool()
+
+
+def get_connection(db_path, user="SYSDBA", password="masterkey", charset="ISO8859_1"):
+	key = (db_path, user, password, charset)
+	con = connection_pool.acquire(key)
+	if con is not None:
+		log("Reusing idle connection")
+		return con
 
-def get_connection(db_path, user="SYSDBA", password="masterkey", charset="WIN1252"):
-	con = None
 	# Sometimes we can't connect the first or second times we try,
 	# so let's loop it and limit our attempts
 	MAX_ATTEMPTS = 20
 	attempt = 1
+	delay = READY_BASE_DELAY
 	success = False
 	while not success:
 		# If we've tried too many times, then give up :\
 		if attempt > MAX_ATTEMPTS:
 			log("Conection to Firebird failed :(")
-			exit(1)
-		# Make sure Firebird is running. This command might be run multiple times
-		# but it doesn't error out, so it's fine
-		subprocess.call(["/etc/init.d/firebird", "start"])
-
-		# We give it a few seconds to start and warm up, we got time
-		time.sleep(5)
+			raise ConnectionError(f"Couldn't connect to '{db_path}' after {MAX_ATTEMPTS} attempts")
+		# Make sure Firebird is running; if it is, this costs us a single check
+		start_firebird()
 
 		# Attempts to connect to Firebird
 		try:
@@ -54,20 +210,90 @@ def get_connection(db_path, user="SYSDBA", password="masterkey", charset="WIN125
 			log(f"Unexpected Exception!")
 			log(repr(e))
 			attempt += 1
+		if not success:
+			time.sleep(delay)
+			delay = min(delay * 2, READY_MAX_DELAY)
 
+	connection_pool.add(key, con)
 	return con
 
 
-def execute_query(con, query):
-	try:
-		cur = con.cursor()
-		log(f"Running query:\n{query}")
+def release_connection(con):
+	"""Hands a connection back once we're done with it, so it can be reused"""
+	connection_pool.release(con)
 
-		START_TIME = time.time()
+
+# Seconds; from a fast query up to a table that takes hours
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+# Per-table times are plain totals (seconds); a histogram per table would be
+# hundreds of series. Queries not about any one table are labeled ''
+QUERY_SECONDS = Counter(
+	"gdb2csv_query_seconds_total",
+	"Time spent running queries (until the first row is available), per table",
+	("table",)
+)
+FETCH_SECONDS = Counter(
+	"gdb2csv_fetch_seconds_total",
+	"Time spent fetching rows of queries, per table",
+	("table",)
+)
+QUERY_DURATION = Histogram(
+	"gdb2csv_query_duration_seconds",
+	"How long each query took, by stage ('query' or 'fetch')",
+	("stage",),
+	buckets=DURATION_BUCKETS
+)
+ROWS_WRITTEN = Counter(
+	"gdb2csv_rows_written_total",
+	"Rows written to the output, per table and output format",
+	("table", "format")
+)
+BYTES_WRITTEN = Counter(
+	"gdb2csv_bytes_written_total",
+	"Bytes written to the output (compressed, for zip and parquet), per table and output format",
+	("table", "format")
+)
+PIPELINE_IDLE_SECONDS = Counter(
+	"gdb2csv_pipeline_idle_seconds_total",
+	"In pipelined exports, time spent fetching nothing while waiting for writing to catch up ('fetch') and writing nothing while waiting for rows ('write')",
+	("stage",)
+)
+TABLE_SECONDS = Histogram(
+	"gdb2csv_table_export_seconds",
+	"How long exporting each table took, by output format and outcome",
+	("format", "status"),
+	buckets=DURATION_BUCKETS
+)
+
+def record_query_time(table_name, stage, seconds):
+	(QUERY_SECONDS if stage == "query" else FETCH_SECONDS).labels(table=table_name or "").inc(seconds)
+	QUERY_DURATION.labels(stage=stage).observe(seconds)
+
+
+def open_query(con, query, params=None):
+	"""Runs the query and returns the cursor, without fetching any rows"""
+	cur = con.cursor()
+	log(f"Running query:\n{query}")
+	if params:
+		log(f"Parameters: {params!r}")
+		cur.execute(query, params)
+	else:
 		cur.execute(query)
+	return cur
+
+
+def execute_query(con, query, params=None, table_name=None):
+	cur = None
+	try:
+		START_TIME = time.time()
+		cur = open_query(con, query, params)
+		QUERY_TIME = time.time() - START_TIME
+		record_query_time(table_name, "query", QUERY_TIME)
 		log("Obtaining results...")
 		rows = cur.fetchall()
 		TOTAL_TIME = time.time() - START_TIME
+		record_query_time(table_name, "fetch", TOTAL_TIME - QUERY_TIME)
 
 		log(f"Took {TOTAL_TIME:.1f}s")
 
@@ -77,105 +303,813 @@ def execute_query(con, query):
 	except Exception as e:
 		log(f"Unexpected Exception!")
 		log(repr(e))
-		cur.close()
-		con.close()
-		exit(1)
+		if cur:
+			cur.close()
+		raise
+
+
+# How many rows to fetch at a time, if we don't know how wide they are (and
+# for delta exports, whose chunks must line up between snapshots)
+DEFAULT_CHUNK_SIZE = 10_000
 
+# Failed chunks are retried in-process, waiting 1s, 2s, 4s, ... between tries;
+# if a table still fails, it's retried from its last checkpoint over a new
+# connection, in case the one we had is what broke
+MAX_CHUNK_ATTEMPTS = 5
+MAX_TABLE_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1
+
+def with_retries(action, description, max_attempts=MAX_CHUNK_ATTEMPTS):
+	attempt = 1
+	while True:
+		try:
+			return action()
+		except Exception as e:
+			if attempt >= max_attempts:
+				log(f"{description} failed {attempt} time(s); giving up")
+				raise
+			delay = RETRY_BASE_DELAY * 2**(attempt-1)
+			log(f"{description} failed ({attempt}/{max_attempts}): {e!r}; retrying in {delay}s")
+			time.sleep(delay)
+			attempt += 1
 
-def export_table_to_csv(con, table_name):
+
+def export_table_to_csv(con, table_name, batch_size=10_000, output=None, on_progress=None, selection=None):
+	"""Exports the whole table, or the columns and rows in `selection` (see
+	`build_selection()`)"""
 	log(f"Reading entire table '{table_name}'")
+	output = output or CsvDirectoryOutput("/data/csv")
 
 	try:
-		query = f"""
-SELECT * FROM {table_name}
-		"""
-		(rows, columns) = execute_query(con, query)
-		df = pd.DataFrame(rows, columns=columns)
-		row_count = len(df)
-		log(f"Fetched {row_count} rows")
-
-		# Guarantees /csv directory exists
-		file_path = f"/data/csv/{table_name}.csv"
-		os.makedirs(os.path.dirname(file_path), exist_ok=True)
-		df.to_csv(file_path, mode='w', header=True, index=False)
-		log(f"Saved to '{file_path}'")
+		(table_size, profile) = get_table_profile(con, table_name, output, selection)
+		START_TIME = time.time()
+		cur = open_query(con, f"""
+SELECT {get_select_list(selection)} FROM {table_name}
+{get_where(selection)}
+		""", get_params(selection))
+		record_query_time(table_name, "query", time.time() - START_TIME)
+		columns = [ desc[0] for desc in cur.description ]
+
+		if on_progress:
+			on_progress(0, table_size)
+		# Rows go straight from the cursor to the file, `batch_size` at a time, so
+		# memory use doesn't depend on the size of the table
+		with output.open_table(table_name, columns, profile=profile) as writer:
+			while True:
+				FETCH_START = time.time()
+				rows = cur.fetchmany(batch_size)
+				record_query_time(table_name, "fetch", time.time() - FETCH_START)
+				if not rows:
+					break
+				writer.write_rows(rows)
+				ROWS_WRITTEN.labels(table=table_name, format=output.format).inc(len(rows))
+				# Rows are only counted beforehand if the table had to be profiled
+				if on_progress:
+					on_progress(writer.row_count, table_size)
+		cur.close()
+		TOTAL_TIME = time.time() - START_TIME
+
+		log(f"Fetched {writer.row_count} rows in {TOTAL_TIME:.1f}s")
+		log(f"Saved to '{writer.name}'")
 
 	except Exception as e:
 		log(f"Unexpected Exception!")
 		log(repr(e))
-		con.close()
-		exit(1)
+		raise
 
 
-def export_table_to_csv_chunked(con, table_name, chunk_size, cont=0):
-	log(f"Reading table '{table_name}' in chunks of {chunk_size} rows")
+def get_primary_key(con, table_name):
+	"""Returns the name of the table's primary key column, or `None` if the table
+	has no primary key or if it spans more than one column"""
+	# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-relconstraints.html
+	(rows, _) = execute_query(con, f"""
+SELECT seg.RDB$FIELD_NAME
+FROM RDB$RELATION_CONSTRAINTS rc
+JOIN RDB$INDEX_SEGMENTS seg ON seg.RDB$INDEX_NAME = rc.RDB$INDEX_NAME
+WHERE rc.RDB$RELATION_NAME = '{table_name}'
+  AND rc.RDB$CONSTRAINT_TYPE = 'PRIMARY KEY'
+	""")
+	# Composite keys would need `(a > ?) OR (a = ? AND b > ?)`, which Firebird
+	# 1.5 can't use an index for; we're better off with RDB$DB_KEY then
+	if len(rows) != 1:
+		return None
+	# System table columns are CHAR(31), so they come padded with spaces
+	return rows[0][0].strip()
 
-	cont = int(cont) or 0
-	offset = cont
-	first_write = True
-	table_size = None
-	while True:
-		try:
-			if first_write:
-				(rows, _) = execute_query(con, f"""
-SELECT COUNT(*) FROM {table_name}
-				""")
-				# `rows` is [  ( table_size, )  ]
-				table_size = rows[0][0]
-				log(f"Table has {table_size} row(s)")
-
-			# Get chunked results via FIRST N SKIP M syntax using RDB$DB_KEY as a
-			# unique representation of each table record
-			# [Ref FIRST/SKIP] https://www.firebirdsql.org/refdocs/langrefupd20-select.html#langrefupd20-first-skip
-			# [Ref RDB$DB_KEY] https://www.ibphoenix.com/articles/art-00000384
-			query = f"""
-SELECT FIRST {chunk_size} SKIP {offset} *
+
+def get_field_types(con):
+	"""Returns the type of every column of every table (system tables included),
+	as `{ table: { column: (field_type, sub_type, scale, precision) } }`"""
+	# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-relfields.html
+	(rows, _) = execute_query(con, """
+SELECT rf.RDB$RELATION_NAME, rf.RDB$FIELD_NAME,
+       f.RDB$FIELD_TYPE, f.RDB$FIELD_SUB_TYPE, f.RDB$FIELD_SCALE, f.RDB$FIELD_PRECISION
+FROM RDB$RELATION_FIELDS rf
+JOIN RDB$FIELDS f ON f.RDB$FIELD_NAME = rf.RDB$FIELD_SOURCE
+	""")
+	field_types = dict()
+	for (table, column, field_type, sub_type, scale, precision) in rows:
+		field_types.setdefault(table.strip(), dict())[column.strip()] = (
+			field_type, sub_type, scale, precision
+		)
+	return field_types
+
+
+def get_nullable_columns(con, table_name):
+	"""Returns the columns of the table that accept NULLs, both in themselves
+	and in their domain"""
+	(rows, _) = execute_query(con, f"""
+SELECT rf.RDB$FIELD_NAME
+FROM RDB$RELATION_FIELDS rf
+JOIN RDB$FIELDS f ON f.RDB$FIELD_NAME = rf.RDB$FIELD_SOURCE
+WHERE rf.RDB$RELATION_NAME = '{table_name}'
+  AND COALESCE(rf.RDB$NULL_FLAG, 0) = 0
+  AND COALESCE(f.RDB$NULL_FLAG, 0) = 0
+	""", table_name=table_name)
+	return { column.strip() for (column,) in rows }
+
+
+def get_table_profile(con, table_name, output, selection=None, count=False):
+	"""Profiles the columns of the table that `output` writes according to all
+	of their values (see `get_profiled_columns()`), over the rows in `selection`,
+	in a single pass. Returns `(rows, profile)`, where `rows` is how many rows
+	there are, or None if the table didn't have to be read (`count` makes it)"""
+	field_types = (output.field_types or dict()).get(table_name) or dict()
+	kinds = dict()
+	if output.uses_profiles:
+		kinds = {
+			column: kind
+			for (column, kind) in get_profiled_columns(field_types).items()
+			if has_column(selection, column)
+		}
+	# Integer columns that can't be NULL don't need to be looked at
+	nullable = set()
+	if PROFILE_INT in kinds.values():
+		nullable = with_retries(
+			lambda: get_nullable_columns(con, table_name), f"Listing nullable columns of '{table_name}'"
+		)
+
+	profile = dict()
+	profiled = []
+	aggregates = [ "COUNT(*)" ]
+	for (column, kind) in kinds.items():
+		if kind == PROFILE_INT:
+			if column not in nullable:
+				profile[column] = { "nulls": False }
+				continue
+			aggregates.append(f"COUNT(*) - COUNT({column})")
+		else:
+			# Firebird keeps 1/10000s, which EXTRACT(SECOND ...) gives as a fraction
+			second = f"EXTRACT(SECOND FROM {column})"
+			aggregates.extend([
+				f"MIN({column})",
+				f"MAX({column})",
+				f"MAX(CASE WHEN EXTRACT(HOUR FROM {column}) > 0 OR EXTRACT(MINUTE FROM {column}) > 0 OR {second} > 0 THEN 1 ELSE 0 END)",
+				f"MAX(CASE WHEN {second} * 1000 <> CAST({second} * 1000 AS INTEGER) THEN 2 WHEN {second} <> CAST({second} AS INTEGER) THEN 1 ELSE 0 END)",
+			])
+		profiled.append((column, kind))
+	if not profiled and not count:
+		return (None, profile)
+
+	(rows, _) = with_retries(lambda: execute_query(con, f"""
+SELECT {", ".join(aggregates)}
+FROM {table_name}
+{get_where(selection)}
+	""", get_params(selection), table_name=table_name), f"Profiling '{table_name}'")
+	# `rows` is [  ( table_size, <column aggregates>... )  ]
+	values = list(rows[0])
+	table_size = values.pop(0)
+	for (column, kind) in profiled:
+		if kind == PROFILE_INT:
+			profile[column] = { "nulls": values.pop(0) > 0 }
+		else:
+			profile[column] = get_timestamp_profile(*values[:4])
+			del values[:4]
+	return (table_size, profile)
+
+
+def get_column_widths(con):
+	"""Returns about how many bytes each column of each table (system tables
+	included) takes, going by its declared size, as `{ table: { column: bytes } }`"""
+	(rows, _) = execute_query(con, """
+SELECT rf.RDB$RELATION_NAME, rf.RDB$FIELD_NAME, f.RDB$FIELD_TYPE, f.RDB$FIELD_LENGTH
+FROM RDB$RELATION_FIELDS rf
+JOIN RDB$FIELDS f ON f.RDB$FIELD_NAME = rf.RDB$FIELD_SOURCE
+	""")
+	widths = dict()
+	for (table, column, field_type, field_length) in rows:
+		widths.setdefault(table.strip(), dict())[column.strip()] = estimate_column_bytes(field_type, field_length)
+	return widths
+
+
+def get_row_estimates(con):
+	"""Returns about how many rows each table with a unique index has. Firebird
+	1.5 doesn't keep row counts anywhere, but it does keep each index's
+	selectivity (1 / number of distinct keys), which for a unique index is
+	1 / rows, as of when it was last computed (when the index was built, e.g.
+	by restoring the backup, or by SET STATISTICS)"""
+	# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-indices.html
+	(rows, _) = execute_query(con, """
+SELECT RDB$RELATION_NAME, MIN(RDB$STATISTICS)
+FROM RDB$INDICES
+WHERE RDB$UNIQUE_FLAG = 1 AND RDB$STATISTICS > 0
+GROUP BY RDB$RELATION_NAME
+	""")
+	return { table.strip(): round(1 / selectivity) for (table, selectivity) in rows }
+
+
+def plan_tables(con, tables, count=False, selections=None):
+	"""Sizes up each of `tables`, as `{ table: { "rows": ..., "exact": ...,
+	"row_bytes": ... } }`, counting only the columns in its selection, if it
+	has one (see `build_selection()`). Row counts are estimates (see
+	`get_row_estimates()`), or None for tables without a unique index; with
+	`count`, those and tables whose rows are filtered are counted instead,
+	which exporting them in chunks would have done anyway"""
+	widths = get_column_widths(con)
+	estimates = get_row_estimates(con)
+	plans = dict()
+	for table in tables:
+		selection = (selections or dict()).get(table)
+		rows = estimates.get(table)
+		exact = False
+		if count and (rows is None or get_where(selection)):
+			(result, _) = with_retries(lambda: execute_query(con, f"""
+SELECT COUNT(*) FROM {table}
+{get_where(selection)}
+			""", get_params(selection), table_name=table), f"Counting rows of '{table}'")
+			rows = result[0][0]
+			exact = True
+		column_widths = widths.get(table, dict())
+		if selection and selection["columns"]:
+			column_widths = { c: column_widths.get(c, 0) for c in selection["columns"] }
+		plans[table] = {
+			"rows": rows,
+			"exact": exact,
+			"row_bytes": sum(column_widths.values()) or None,
+		}
+	return plans
+
+
+def parse_cont(cont):
+	"""Splits `cont` into a row offset and a key cursor. Row offsets are plain
+	integers (or strings of digits); key cursors are strings prefixed by 'key:',
+	as logged by `export_table_to_csv_chunked` after every chunk"""
+	if isinstance(cont, str) and cont.startswith("key:"):
+		return (0, cont[len("key:"):])
+	return (int(cont or 0), None)
+
+
+def dbkey_to_bytes(key, charset):
+	"""`firebirdsql` decodes RDB$DB_KEY with the connection charset, so we encode
+	it back to get the original 8 bytes. This only round-trips for charsets that
+	map every byte, like ISO8859_1 (which is what `export()` uses)"""
+	if isinstance(key, bytes):
+		return key
+	# [Ref] https://github.com/nakagami/pyfirebirdsql/blob/master/firebirdsql/consts.py
+	codec = firebirdsql.consts.charset_map.get(charset, charset)
+	key = key.encode(codec)
+	# A wrong cursor would silently skip rows, so we'd rather fail
+	if len(key) != 8:
+		raise ValueError(f"RDB$DB_KEY should have 8 bytes, got {key!r}")
+	return key
+
+
+def format_cursor(key):
+	# RDB$DB_KEY comes back as 8 raw bytes, so we log it as hex
+	if isinstance(key, bytes):
+		return f"key:{key.hex()}"
+	return f"key:{key}"
+
+
+def export_table_to_csv_chunked(con, table_name, chunk_size, cont=0, keyset=True, output=None, on_chunk=None, delta=None, on_progress=None, table_size=None, selection=None, pipeline=0):
+	"""Exports the table `chunk_size` rows at a time (or as many as it says, if
+	it's a `ChunkSizer`). After every chunk is written, calls
+	`on_chunk(cursor, rows)`, where `cursor` can be passed as `cont` to continue
+	from the next chunk, and `rows` is how many rows have been written so far,
+	and `on_progress(rows, table_size)`. If `delta` (a `TableDelta`) is given,
+	chunks that it says haven't changed since the previous snapshot are
+	skipped. If `table_size` is given, the rows aren't counted again. Only
+	the columns and rows in `selection` are exported (see `build_selection()`).
+	With `pipeline`, up to that many chunks are fetched ahead of the one being
+	written, in another thread"""
+	sizer = chunk_size if isinstance(chunk_size, ChunkSizer) else ChunkSizer(chunk_size)
+	if sizer.adaptive:
+		log(f"Reading table '{table_name}' in chunks of {sizer.size} rows to start with")
+	else:
+		log(f"Reading table '{table_name}' in chunks of {sizer.size} rows")
+	output = output or CsvDirectoryOutput("/data/csv")
+
+	(offset, last_key) = parse_cont(cont)
+	if last_key is not None and not keyset:
+		log("Key cursors are only valid in keyset mode")
+		raise ValueError(f"cont='{cont}' requires keyset mode")
+
+	# In keyset mode, we remember the last key we've read and ask for the rows
+	# after it (`WHERE key > ?`) instead of making Firebird sort and throw away
+	# every row we've already read (`SKIP offset`). We use the primary key if
+	# there's one, since then Firebird can walk its index; otherwise we fall
+	# back to RDB$DB_KEY, which still saves us the sort of the rows already read
+	key_column = None
+	if keyset:
+		key_column = get_primary_key(con, table_name)
+		if key_column:
+			log(f"Using primary key '{key_column}' as keyset cursor")
+		else:
+			log("No single-column primary key; using RDB$DB_KEY as keyset cursor")
+		if last_key is not None and not key_column:
+			last_key = bytes.fromhex(last_key)
+	# If the key we keep track of isn't one of the columns we export, it goes
+	# in front of them, and is removed before writing
+	key_first = keyset and not (key_column and has_column(selection, key_column))
+
+	from_cursor = (last_key is not None)
+	log_table = getattr(log_context, "table", None)
+
+	# Columns are formatted according to the whole table, not to each chunk, so
+	# where chunks start and end doesn't change the output; profiling them takes
+	# the same pass over the table as counting its rows
+	(counted, profile) = get_table_profile(con, table_name, output, selection, count=(table_size is None))
+	if table_size is None:
+		table_size = counted
+	log(f"Table has {table_size} row(s)")
+	if delta is not None and not delta.set_profile(profile):
+		log("Columns are formatted differently than in the previous snapshot; writing every chunk")
+	if on_progress:
+		on_progress(offset, table_size)
+
+	def fetch_chunks(offset, last_key, table_size):
+		"""Fetches the table chunk by chunk, yielding `(rows, columns, cursor,
+		total_so_far, table_size)`. When pipelined, this runs in the
+		`Prefetcher`'s thread, so it mustn't touch `output`"""
+		log_context.table = log_table
+		fetched_first_chunk = False
+		total_so_far = offset
+		while True:
+			chunk_size = sizer.size
+			params = get_params(selection)
+			if not keyset:
+				# Get chunked results via FIRST N SKIP M syntax using RDB$DB_KEY as a
+				# unique representation of each table record
+				# [Ref FIRST/SKIP] https://www.firebirdsql.org/refdocs/langrefupd20-select.html#langrefupd20-first-skip
+				# [Ref RDB$DB_KEY] https://www.ibphoenix.com/articles/art-00000384
+				query = f"""
+SELECT FIRST {chunk_size} SKIP {offset} {get_select_list(selection)}
+FROM {table_name}
+{get_where(selection)}
+ORDER BY RDB$DB_KEY
+				"""
+			else:
+				# The first chunk might still need to skip rows, if we're continuing
+				# from a row offset; after that, we only ever need the key cursor
+				skip = f"SKIP {offset} " if offset > 0 and not fetched_first_chunk else ""
+				after_key = ""
+				if last_key is not None:
+					after_key = f"{key_column or 'RDB$DB_KEY'} > ?"
+					params = get_params(selection, last_key)
+				where = get_where(selection, after_key)
+				# With RDB$DB_KEY, we select it as the first column so we know where
+				# we stopped; it's removed before writing. It's a CHAR(8), and the
+				# driver `rstrip()`s CHARs, which would also eat key bytes that happen
+				# to be whitespace (\t, \x1f, \xa0, ...); VARCHARs are left alone
+				# [Ref] https://github.com/nakagami/pyfirebirdsql/blob/master/firebirdsql/xsqlvar.py
+				if key_column and not key_first:
+					query = f"""
+SELECT FIRST {chunk_size} {skip}{get_select_list(selection)}
+FROM {table_name}
+{where}
+ORDER BY {key_column}
+					"""
+				elif key_column:
+					query = f"""
+SELECT FIRST {chunk_size} {skip}{key_column}, {get_select_list(selection, table_name)}
+FROM {table_name}
+{where}
+ORDER BY {key_column}
+					"""
+				else:
+					query = f"""
+SELECT FIRST {chunk_size} {skip}CAST(RDB$DB_KEY AS VARCHAR(8) CHARACTER SET OCTETS), {get_select_list(selection, table_name)}
 FROM {table_name}
+{where}
 ORDER BY RDB$DB_KEY
-			"""
-			(rows, columns) = execute_query(con, query)
-
-			# We could manually write the CSV but we can just use Pandas instead
-			df = pd.DataFrame(rows, columns=columns)
-			row_count = len(df)
-			total_so_far = row_count + offset
-			if table_size:
+					"""
+			# Only the successful attempt counts towards how long fetching takes
+			def fetch_chunk():
+				FETCH_START = time.time()
+				result = execute_query(con, query, params, table_name=table_name)
+				return (result, time.time() - FETCH_START)
+			((rows, columns), fetch_time) = with_retries(
+				fetch_chunk, f"Fetching chunk of '{table_name}'"
+			)
+			fetched_first_chunk = True
+
+			if key_first:
+				if rows:
+					last_key = rows[-1][0] if key_column else dbkey_to_bytes(rows[-1][0], con.charset)
+				rows = [ row[1:] for row in rows ]
+				columns = columns[1:]
+			elif keyset and rows:
+				last_key = rows[-1][columns.index(key_column)]
+
+			row_count = len(rows)
+			total_so_far += row_count
+			# If we started from a key cursor, we don't know how many rows came before
+			if table_size and not from_cursor:
 				pct = round((total_so_far/table_size)*100_00)/1_00
 				log(f"Fetched {row_count} rows -- ({pct}%) {total_so_far} read of {table_size} total")
 			else:
 				log(f"Fetched {row_count} rows -- {total_so_far} read")
+			cursor = str(offset + row_count)
+			if keyset and last_key is not None:
+				cursor = format_cursor(last_key)
 
-			# If we've already created the file previously
-			if first_write and cont > 0:
-				first_write = False
-			file_path = f"/data/csv/{table_name}.csv"
-			if first_write:
-				# Guarantees /csv directory exists
-				os.makedirs(os.path.dirname(file_path), exist_ok=True)
-				df.to_csv(file_path, mode='w', header=True, index=False)
-				first_write = False
-				log(f"Saved to '{file_path}'")
-			else:
-				df.to_csv(file_path, mode='a', header=False, index=False)
-				log(f"Appended to '{file_path}'")
+			yield (rows, columns, cursor, total_so_far, table_size)
 
 			# If we fetched no rows (empty table, row count is exact multiple
 			# of chunk_size, ...), we're done
 			if row_count <= 0:
 				log("Fetched no rows; assuming end of table")
-				break
+				return
 			# If the number of rows fetched is less than chunk_size, we're done
 			if row_count < chunk_size:
 				log(f"Fetched fewer rows than `chunk_size` ({chunk_size}); assuming end of table")
-				break
+				return
+			if sizer.record(rows, fetch_time):
+				log(f"Chunk took {fetch_time:.1f}s at ~{round(sizer.row_bytes)} bytes/row; next chunks will have {sizer.size} rows")
 			# Increment offset for the next chunk
-			offset += chunk_size
+			if not keyset:
+				offset += chunk_size
+
+	# Pipelined, the connection fetches the next chunks while this thread writes
+	# the current one, instead of each waiting for the other
+	chunks = fetch_chunks(offset, last_key, table_size)
+	prefetcher = None
+	if pipeline:
+		log(f"Fetching up to {pipeline} chunk(s) ahead of the one being written")
+		prefetcher = Prefetcher(chunks, pipeline)
+		chunks = iter(prefetcher)
+
+	first_write = (offset <= 0 and not from_cursor)
+	writer = None
+	try:
+		for (rows, columns, cursor, total_so_far, table_size) in chunks:
+			row_count = len(rows)
+			# In a delta export, unchanged chunks aren't written at all. The empty
+			# chunk that ends a table only counts if it's the whole table
+			write = True
+			if delta is not None:
+				write = (row_count > 0 or total_so_far == 0) and delta.add_chunk(rows, cursor)
+				if not write:
+					log("Chunk unchanged since previous snapshot; skipping")
+
+			if write:
+				# The file stays open between chunks; if we're continuing a previous
+				# extraction, we append to the file that's already there
+				if writer is None:
+					append = (not first_write) and output.has_table(table_name)
+					writer = output.open_table(table_name, columns, append=append, profile=profile)
+				writer.write_rows(rows)
+				# Flush every chunk so the file always ends where the cursor says it does
+				writer.flush()
+				ROWS_WRITTEN.labels(table=table_name, format=output.format).inc(len(rows))
+				if first_write:
+					first_write = False
+					log(f"Saved to '{writer.name}'")
+				else:
+					log(f"Appended to '{writer.name}'")
+			if cursor.startswith("key:"):
+				log(f"Continue from here with cont='{cursor}'")
+			if on_chunk and row_count > 0:
+				on_chunk(cursor, total_so_far)
+			if on_progress:
+				on_progress(total_so_far, table_size)
+
+	except Exception as e:
+		log(f"Unexpected Exception!")
+		log(repr(e))
+		if writer:
+			writer.close()
+		raise
+	finally:
+		if prefetcher:
+			prefetcher.close()
+			PIPELINE_IDLE_SECONDS.labels(stage="fetch").inc(prefetcher.producer_idle)
+			PIPELINE_IDLE_SECONDS.labels(stage="write").inc(prefetcher.consumer_idle)
+			log(
+				f"Fetching waited {prefetcher.producer_idle:.1f}s for writing; "
+				f"writing waited {prefetcher.consumer_idle:.1f}s for fetching"
+			)
+
+	if writer:
+		writer.close()
+
+
+def export_table(con, table_name, no_chunks, chunk_size, cont=0, keyset=True, output=None, checkpoint=None, delta=None, on_progress=None, plans=None, adaptive_chunks=False, selections=None, pipeline=0):
+	"""Exports one table, in chunks or not. `on_progress(table_name, rows,
+	total_rows, bytes_written)` is called as rows are written. Without a
+	`chunk_size`, chunks are sized by the table's row width in `plans` (see
+	`plan_tables()`), and, with `adaptive_chunks`, resized as it's read. If
+	`selections` has the table, only its columns and rows are exported. With
+	`pipeline`, chunks are fetched while the previous ones are written"""
+	selection = (selections or dict()).get(table_name)
+	plan = (plans or dict()).get(table_name) or dict()
+	if chunk_size:
+		sizer = ChunkSizer(chunk_size)
+	else:
+		row_bytes = plan.get("row_bytes")
+		sizer = ChunkSizer(
+			get_chunk_size(row_bytes) or DEFAULT_CHUNK_SIZE, row_bytes, adaptive=adaptive_chunks
+		)
+	# Rows counted while planning don't need to be counted again
+	table_size = plan["rows"] if plan.get("exact") else None
+
+	# When continuing from a key cursor, the export only counts rows from there
+	# on, so we add the ones the checkpoint says came before
+	rows_before = 0
+	state = checkpoint.get_table(table_name) if checkpoint else None
+	if state and state.get("status") == "partial" and state.get("cursor") == cont:
+		if parse_cont(cont)[1] is not None:
+			rows_before = state["rows"]
+
+	on_rows = None
+	if on_progress:
+		def on_rows(rows, total_rows):
+			on_progress(table_name, rows_before + rows, total_rows, output.get_table_size(table_name))
+
+	# Only appendable outputs can continue mid-table, so there's no point
+	# saving partial progress for the others
+	on_chunk = None
+	if checkpoint and output.can_append:
+		def on_chunk(cursor, rows):
+			checkpoint.save_table(table_name, {
+				"status": "partial",
+				"cursor": cursor,
+				"rows": rows_before + rows,
+				"bytes": output.get_table_size(table_name),
+			})
+
+	table_delta = delta.open_table(table_name, cont) if delta else None
+
+	# A table continued from a checkpoint already has some of its bytes written
+	bytes_before = (output.get_table_size(table_name) or 0) if cont else 0
+	START_TIME = time.time()
+	status = "failed"
+	try:
+		# If user doesn't want chunks, we just try exporting the entire table
+		if no_chunks:
+			export_table_to_csv(con, table_name, batch_size=sizer.size, output=output, on_progress=on_rows, selection=selection)
+		# Otherwise, we do the more labor-intensive process of chunking the results
+		else:
+			export_table_to_csv_chunked(
+				con, table_name, sizer,
+				cont=cont, keyset=keyset, output=output, on_chunk=on_chunk,
+				delta=table_delta, on_progress=on_rows, table_size=table_size, selection=selection,
+				pipeline=pipeline
+			)
+		status = "done"
+	finally:
+		TABLE_SECONDS.labels(format=output.format, status=status).observe(time.time() - START_TIME)
+		bytes_written = (output.get_table_size(table_name) or 0) - bytes_before
+		if bytes_written > 0:
+			BYTES_WRITTEN.labels(table=table_name, format=output.format).inc(bytes_written)
+
+	if table_delta:
+		(reused, total) = table_delta.finish()
+		log(f"Reused {reused} of {total} chunk(s) from previous snapshot")
+
+	if checkpoint and output.can_rewrite:
+		checkpoint.save_table(table_name, { "status": "done" })
+
+
+def get_resume_cont(table_name, output, checkpoint):
+	"""Returns where to continue exporting the table from, according to the
+	checkpoint, or 0 to start it over"""
+	state = checkpoint.get_table(table_name) if checkpoint else None
+	if not state or state.get("status") != "partial" or not output.can_append:
+		return 0
+	# Rows written after the checkpoint was saved (if we crashed between writing
+	# a chunk and saving the checkpoint) would be written again, so we cut them
+	if not output.truncate_table(table_name, state["bytes"]):
+		log(f"Output of '{table_name}' doesn't match its checkpoint; starting over")
+		return 0
+	log(f"Continuing '{table_name}' from checkpoint ({state['rows']} rows already written)")
+	return state["cursor"]
+
 
+def export_table_with_retries(con, connection_args, table_name, output, checkpoint=None, cont=0, **options):
+	"""Exports the table, and if it fails (after the in-process retries of each
+	chunk), tries it again over a new connection, continuing from its last
+	checkpoint if possible. Returns the connection that was last used"""
+	attempt = 1
+	while True:
+		try:
+			export_table(con, table_name, cont=cont, output=output, checkpoint=checkpoint, **options)
+			return con
 		except Exception as e:
-			log(f"Unexpected Exception!")
-			log(repr(e))
-			con.close()
-			exit(1)
+			# A ZIP entry can't be rewritten, so retrying would duplicate it
+			if attempt >= MAX_TABLE_ATTEMPTS or not output.can_rewrite:
+				raise
+			log(f"Export of '{table_name}' failed ({attempt}/{MAX_TABLE_ATTEMPTS}): {e!r}; reconnecting")
+			attempt += 1
+			connection_pool.discard(con)
+			con = get_connection(**connection_args)
+			cont = get_resume_cont(table_name, output, checkpoint)
+
+
+def get_text_codecs(charset, text_charset):
+	"""Returns the Python codecs to transcode text from (what the driver decoded
+	it as) and to (what it actually is), or None if there's nothing to do"""
+	if not text_charset or text_charset == charset:
+		return None
+	# [Ref] https://github.com/nakagami/pyfirebirdsql/blob/master/firebirdsql/consts.py
+	charset_map = firebirdsql.consts.charset_map
+	return (charset_map.get(charset, charset), charset_map.get(text_charset, text_charset))
+
+
+def open_output(output_format, output_path, field_types=None, text_codecs=None):
+	"""`text_codecs` is what `get_text_codecs()` returned; it's not the
+	transcoder itself so that it can be sent to worker processes"""
+	transcode = make_transcoder(*text_codecs) if text_codecs else None
+	if output_format == "zip":
+		return ZipArchiveOutput(output_path, field_types, transcode)
+	if output_format == "parquet":
+		return ParquetDirectoryOutput(output_path, field_types or dict(), transcode=transcode)
+	return CsvDirectoryOutput(output_path, field_types, transcode)
+
+
+def get_checkpoint_path(workspace, filename):
+	return os.path.join(workspace, filename.rsplit(".", maxsplit=1)[0] + ".checkpoint")
+
+
+def get_workspace(workspace=""):
+	"""Returns the directory the GDB is in and the export is written to: /data
+	itself, or a directory inside it, so that exports running at the same time
+	(e.g. one per Celery task) don't step on each other's files"""
+	if not workspace:
+		return "/data"
+	# Just a name, so it can't point outside /data
+	if workspace in (".", "..") or "/" in workspace or "\\" in workspace:
+		log(f"workspace='{workspace}' must be the name of a directory inside /data!")
+		raise ValueError(f"workspace='{workspace}' must be the name of a directory inside /data!")
+	return os.path.join("/data", workspace)
+
+
+def get_worker_output_path(output_format, output_path, table_name):
+	# Workers can't write to the same ZIP archive at once, so each table goes
+	# into its own, which gets merged into the final archive once it's done
+	if output_format == "zip":
+		return f"{output_path}.{table_name}.part"
+	return output_path
+
+
+################################################################################
+
+
+# A Firebird connection can only run one query at a time, so every worker
+# thread (or process) gets its own, reused for all tables it exports. Several
+# exports can run at once, so connections are kept per pool of workers
+worker_state = threading.local()
+worker_connections = dict()
+worker_connections_lock = threading.Lock()
+
+def add_worker_connection(pool_id, con):
+	worker_state.con = con
+	with worker_connections_lock:
+		worker_connections.setdefault(pool_id, []).append(con)
+
+
+def get_worker_connection(connection_args, pool_id):
+	con = getattr(worker_state, "con", None)
+	if con is None:
+		con = get_connection(**connection_args)
+		add_worker_connection(pool_id, con)
+	return con
+
+
+def export_table_in_worker(table_name, position, connection_args, output_args, options, pool_id):
+	log_context.table = table_name
+	try:
+		con = get_worker_connection(connection_args, pool_id)
+		log(f"Reading table {position}")
+		(output_format, output_path, field_types, text_codecs) = output_args
+		output = open_output(
+			output_format,
+			get_worker_output_path(output_format, output_path, table_name),
+			field_types,
+			text_codecs
+		)
+		try:
+			new_con = export_table_with_retries(
+				con, connection_args, table_name, output, **options
+			)
+		finally:
+			output.close()
+		# Retries might have replaced the connection with a new one
+		if new_con is not con:
+			add_worker_connection(pool_id, new_con)
+		log(f"Done with {table_name}!")
+	except BaseException:
+		# We don't know what state the connection is in after a failure, so the
+		# next table this worker gets uses a new one
+		worker_state.con = None
+		raise
+	finally:
+		log_context.table = None
+
+
+def close_worker_connections(pool_id):
+	with worker_connections_lock:
+		connections = worker_connections.pop(pool_id, [])
+	for con in connections:
+		release_connection(con)
+
+
+class QueuedProgress:
+	"""Stands in for an `on_progress` callback in worker processes, which can't
+	call back into the main one; calls go through `queue` instead"""
+
+	def __init__(self, queue):
+		self.queue = queue
+
+	def __call__(self, *args):
+		self.queue.put(args)
+
+
+def forward_progress(queue, on_progress):
+	# Runs in a thread of the main process until it gets a `None`
+	while True:
+		args = queue.get()
+		if args is None:
+			break
+		on_progress(*args)
+
+
+def export_tables_in_parallel(tables, connection_args, output, output_args, options, workers, worker_type, on_table_done=None):
+	"""Exports `tables`, a list of `(table_name, cont)`, concurrently over
+	`workers` threads or processes, each with its own connection. A table that
+	fails doesn't affect the others; its partial output is removed, unless a
+	checkpoint lets us continue it later. Calls `on_table_done(table, failed)`
+	as each table finishes. Returns the tables that failed"""
+	Executor = (
+		concurrent.futures.ProcessPoolExecutor
+		if worker_type == "process"
+		else concurrent.futures.ThreadPoolExecutor
+	)
+	log(f"Exporting {len(tables)} table(s) with {workers} {worker_type} worker(s)")
+
+	manager = None
+	forwarder = None
+	on_progress = options.get("on_progress")
+	if worker_type == "process" and on_progress:
+		manager = multiprocessing.Manager()
+		progress_queue = manager.Queue()
+		options = dict(options, on_progress=QueuedProgress(progress_queue))
+		forwarder = threading.Thread(
+			target=forward_progress, args=(progress_queue, on_progress), daemon=True
+		)
+		forwarder.start()
+
+	pool_id = uuid.uuid4().hex
+	failed_tables = []
+	with Executor(max_workers=workers) as executor:
+		futures = dict()
+		for i, (table, cont) in enumerate(tables):
+			table_options = dict(options, cont=cont)
+			position = f"{i+1}/{len(tables)}"
+			future = executor.submit(
+				export_table_in_worker, table, position, connection_args, output_args, table_options, pool_id
+			)
+			futures[future] = (table, cont)
+
+		(output_format, output_path, _, _) = output_args
+		keep_partial = bool(options.get("checkpoint")) and output.can_append
+		for future in concurrent.futures.as_completed(futures):
+			(table, cont) = futures[future]
+			part_path = get_worker_output_path(output_format, output_path, table)
+			try:
+				future.result()
+				if output_format == "zip":
+					output.append_archive(part_path)
+			# Anything a worker raises (even SystemExit) shouldn't take us down too
+			except BaseException as e:
+				log(f"Failed to export {table}: {e!r}")
+				failed_tables.append(table)
+				# Don't leave a truncated file behind, unless we can continue it later
+				# or it was being continued, in which case it holds earlier rows
+				if output_format != "zip" and not keep_partial and not cont:
+					output.remove_table(table)
+			finally:
+				if output_format == "zip" and os.path.exists(part_path):
+					os.remove(part_path)
+			if on_table_done:
+				on_table_done(table, table in failed_tables)
+
+	if manager:
+		progress_queue.put(None)
+		forwarder.join()
+		manager.shutdown()
+	close_worker_connections(pool_id)
+	return failed_tables
 
 
 ################################################################################
@@ -186,11 +1120,25 @@ def export(
 	user: str ="SYSDBA",
 	password: str ="masterkey",
 	charset: str ="ISO8859_1",
-	table_list: str ="all",
+	text_charset: str ="",
+	table_list: Union[str, dict] ="all",
 	no_chunks: bool =False,
-	cont: int =0
+	chunk_size: int =0,
+	pipeline: int =0,
+	cont: Union[int, str] =0,
+	keyset: bool =True,
+	workers: int =1,
+	worker_type: str ="thread",
+	output_format: str ="csv",
+	checkpoint: bool =True,
+	delta: str ="",
+	workspace: str ="",
+	on_progress=None
 ):
-	PATH = "/data/" + filename
+	# Everything this export reads and writes (except for the manifests delta
+	# exports share between snapshots) lives in the workspace
+	WORKSPACE = get_workspace(workspace)
+	PATH = os.path.join(WORKSPACE, filename)
 	if not PATH or not os.path.isfile(PATH):
 		log(f"FB_GDB_PATH='{PATH}' is not a file!")
 		raise ValueError(f"FB_GDB_PATH='{PATH}' is not a file!")
@@ -201,16 +1149,110 @@ def export(
 	# https://github.com/nakagami/pyfirebirdsql/blob/59812c2c731bf0f364bc1ab33a46755bc206c05a/firebirdsql/consts.py#L484
 	# (and https://github.com/nakagami/pyfirebirdsql/commit/5027483b518706c61ab2a1c05c2512e5c03e0a6a)
 	CHAR = charset
+	# The charset text is actually stored in, if it's not `charset`. We keep the
+	# connection in ISO8859_1, which maps every byte to a character (the
+	# cheapest decoding, done per value by the driver, and what RDB$DB_KEY needs
+	# to round-trip), and transcode text columns to `text_charset` in bulk, a
+	# whole column of a chunk at once
+	TEXT_CODECS = get_text_codecs(CHAR, text_charset)
 
+	# 'all', table names separated by ';', or which columns and rows to export
+	# from each table; see `parse_table_list()`
 	TABLE_LIST = table_list
+	(WANTED_TABLES, TABLE_SELECTIONS) = parse_table_list(TABLE_LIST)
 	NO_CHUNKS = no_chunks
+	# Either a row offset or a key cursor ('key:...'); see `parse_cont()`
 	CONTINUE = cont
+	KEYSET = keyset
+	# How many tables to export at once, and whether to do it with threads or
+	# processes; `firebirdsql` is pure Python, so processes scale further
+	WORKERS = max(int(workers), 1)
+	WORKER_TYPE = worker_type
+	if WORKER_TYPE not in ("thread", "process"):
+		log(f"worker_type='{WORKER_TYPE}' must be 'thread' or 'process'!")
+		raise ValueError(f"worker_type='{WORKER_TYPE}' must be 'thread' or 'process'!")
+
+	# 'csv' writes a CSV per table to <workspace>/csv; 'zip' compresses the rows
+	# into '<workspace>/<filename>.zip' as they're fetched, without intermediate
+	# CSVs; 'parquet' writes a typed Parquet file per table to <workspace>/parquet
+	OUTPUT_FORMAT = output_format
+	if OUTPUT_FORMAT == "csv":
+		OUTPUT_PATH = os.path.join(WORKSPACE, "csv")
+	elif OUTPUT_FORMAT == "zip":
+		OUTPUT_PATH = os.path.join(WORKSPACE, filename.rsplit(".", maxsplit=1)[0] + ".zip")
+	elif OUTPUT_FORMAT == "parquet":
+		OUTPUT_PATH = os.path.join(WORKSPACE, "parquet")
+	else:
+		log(f"output_format='{OUTPUT_FORMAT}' must be 'csv', 'zip' or 'parquet'!")
+		raise ValueError(f"output_format='{OUTPUT_FORMAT}' must be 'csv', 'zip' or 'parquet'!")
+	# Only CSV files can be appended to
+	if OUTPUT_FORMAT != "csv" and CONTINUE and CONTINUE != "0":
+		log(f"Can't continue a previous extraction with output_format='{OUTPUT_FORMAT}'!")
+		raise ValueError(f"cont is not supported with output_format='{OUTPUT_FORMAT}'")
+
+	# In delta mode, only the chunks that changed since the last export of the
+	# same series of snapshots are written, plus a manifest saying where to find
+	# the rest; see `Delta`
+	DELTA = None
+	if delta:
+		if NO_CHUNKS:
+			log("Delta exports need chunks!")
+			raise ValueError("delta is not supported with no_chunks")
+		DELTA = Delta(
+			delta,
+			filename.rsplit(".", maxsplit=1)[0],
+			os.path.join(WORKSPACE, filename.rsplit(".", maxsplit=1)[0] + ".delta")
+		)
+
+	# Progress is saved to '<workspace>/<filename>.checkpoint', so that if the export
+	# fails or the server restarts, running it again skips the tables that were
+	# already finished and continues the others from their last chunk. A ZIP
+	# archive can't be continued, so there's nothing to checkpoint there
+	CHECKPOINT = None
+	RESUMING = False
+	if checkpoint and OUTPUT_FORMAT != "zip":
+		gdb_stat = os.stat(PATH)
+		CHECKPOINT = Checkpoint(get_checkpoint_path(WORKSPACE, filename), {
+			"gdb_size": gdb_stat.st_size,
+			"gdb_mtime": gdb_stat.st_mtime,
+			"table_list": TABLE_LIST if isinstance(TABLE_LIST, str) else json.dumps(TABLE_LIST, sort_keys=True),
+			"no_chunks": NO_CHUNKS,
+			"keyset": KEYSET,
+			"output_format": OUTPUT_FORMAT,
+			"delta": delta,
+			"text_charset": text_charset,
+		})
+		RESUMING = CHECKPOINT.load()
+		if RESUMING:
+			log(f"Found checkpoint at '{CHECKPOINT.directory}'; continuing previous export")
 
 	# Attempts connection
 	con = get_connection(PATH, user=USER, password=PASS, charset=CHAR)
+	connection_args = {
+		"db_path": PATH,
+		"user": USER,
+		"password": PASS,
+		"charset": CHAR,
+	}
+
+	# If we're continuing a previous extraction, its files are still needed
+	if (CONTINUE and CONTINUE != "0") or RESUMING:
+		log(f"Continuing previous extraction; keeping contents of {OUTPUT_PATH}")
+	elif OUTPUT_FORMAT != "zip" and os.path.exists(OUTPUT_PATH):
+		log(f"Clearing contents of {OUTPUT_PATH}")
+		shutil.rmtree(OUTPUT_PATH)
+
+	if DELTA:
+		DELTA.start(resuming=RESUMING)
+		log(f"Delta export; comparing against snapshot '{DELTA.previous_snapshot()}'")
+
+	# Parquet files are typed, and CSV columns are formatted according to their
+	# types, so we need every column's type beforehand
+	FIELD_TYPES = get_field_types(con)
+	output = open_output(OUTPUT_FORMAT, OUTPUT_PATH, FIELD_TYPES, TEXT_CODECS)
 
 	# Get metadata -- every column from every table
-	export_table_to_csv(con, "RDB$RELATION_FIELDS")
+	export_table_to_csv(con, "RDB$RELATION_FIELDS", output=output)
 
 	# Gets all available tables in the Database
 	# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-relations.html
@@ -224,17 +1266,15 @@ ORDER BY RDB$RELATION_NAME
 	found_tables = [ row[0] for row in found_tables ]
 	print(f"Found {len(found_tables)} table(s):\n" + ", ".join(found_tables))
 
-	wanted_tables = None
+	wanted_tables = WANTED_TABLES
 	tables_that_exist = None
 	# If user wants ALL tables
-	if TABLE_LIST.lower() == "all":
+	if wanted_tables is None:
 		# WE GET THEM ALL
 		wanted_tables = found_tables
 		tables_that_exist = wanted_tables
 	# Otherwise
 	else:
-		# We split each table name on ';', strip whitespace
-		wanted_tables = [ t.strip() for t in TABLE_LIST.split(";") ]
 		tables_that_exist = []
 		# For every table we found on the database
 		for table_name in found_tables:
@@ -245,32 +1285,123 @@ ORDER BY RDB$RELATION_NAME
 
 	log(f"Found {len(tables_that_exist)} requested tables (out of {len(wanted_tables)} requested, {len(found_tables)} total)\n")
 
-	log("Clearing contents of /data/csv")
-	shutil.rmtree("/data/csv")
+	# Columns are checked against the table's and conditions turned into query
+	# parameters before anything is exported, so a bad selection fails right away
+	SELECTIONS = dict()
+	for table in tables_that_exist:
+		selection = build_selection(table, TABLE_SELECTIONS.get(table), FIELD_TYPES.get(table, dict()))
+		if selection:
+			log(f"Selecting {', '.join(selection['columns'] or [ '*' ])} from {table}" + (
+				f" where {selection['where']} {selection['params']!r}" if selection["where"] else ""
+			))
+			SELECTIONS[table] = selection
 
-	CHUNK_SIZE = 10_000
-	# For every table that exists
-	for i, table in enumerate(tables_that_exist):
-		log(f"Reading table {i+1}/{len(tables_that_exist)}")
+	# Without a `chunk_size`, each table's chunks are sized by how wide its rows
+	# are, and resized by how long they take to fetch; see `ChunkSizer`. Delta
+	# exports compare chunks with those of the previous snapshot, so they must
+	# be cut at the same rows every time. With FIRST/SKIP, each chunk takes
+	# longer than the last no matter its size, so there's nothing to adapt to
+	CHUNK_SIZE = max(int(chunk_size or 0), 0)
+	if not CHUNK_SIZE and DELTA:
+		CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+	options = {
+		"no_chunks": NO_CHUNKS,
+		"chunk_size": CHUNK_SIZE,
+		"adaptive_chunks": (not CHUNK_SIZE and KEYSET),
+		# How many chunks can be fetched ahead of the one being written, in a
+		# thread of their own; with 0, fetching and writing take turns
+		"pipeline": max(int(pipeline or 0), 0),
+		"keyset": KEYSET,
+		"checkpoint": CHECKPOINT,
+		"delta": DELTA,
+		"selections": SELECTIONS,
+	}
+	(offset, last_key) = parse_cont(CONTINUE)
+	if not NO_CHUNKS and tables_that_exist:
+		if offset > 0:
+			log(f"Continuing previous extraction; skipping {offset} rows")
+		elif last_key is not None:
+			log(f"Continuing previous extraction from cursor '{CONTINUE}'")
 
-		# If user doesn't want chunks, we just try exporting the entire table
-		if NO_CHUNKS:
-			export_table_to_csv(con, table)
-		# Otherwise, we do the more labor-intensive process of chunking the results
+	# Works out where each table starts from: tables the checkpoint says are done
+	# are skipped, and the rest continue from their last chunk, if any
+	tables_to_export = []
+	for i, table in enumerate(tables_that_exist):
+		# (In a delta export, a table can be done without a file, if nothing changed)
+		exported = output.has_table(table) or (DELTA and DELTA.has_table(table))
+		if CHECKPOINT and CHECKPOINT.is_done(table) and exported:
+			log(f"Skipping {table}; already exported according to checkpoint")
+			continue
+		# For the first table, we might want to continue a previous extraction
+		if i == 0 and CONTINUE and CONTINUE != "0":
+			tables_to_export.append((table, CONTINUE))
 		else:
-			# For the first table, we might want to continue a previous extraction
-			if i == 0:
-				if CONTINUE > 0:
-					log(f"Continuing previous extraction; skipping {CONTINUE} rows")
-				export_table_to_csv_chunked(con, table, CHUNK_SIZE, cont=CONTINUE)
-			# For the rest of them, start from scratch
-			else:
-				export_table_to_csv_chunked(con, table, CHUNK_SIZE)
+			tables_to_export.append((table, get_resume_cont(table, output, CHECKPOINT)))
 
-		log(f"Done with {table}!\n")
-		log("-"*10)
+	# Sizes up the tables beforehand, to pick their chunk sizes and, with more
+	# than one worker, to start with the largest ones
+	PLANS = plan_tables(
+		con, [ table for (table, _) in tables_to_export ], count=(not NO_CHUNKS), selections=SELECTIONS
+	)
+	options["plans"] = PLANS
+	if WORKERS > 1 and tables_to_export:
+		tables_to_export = order_largest_first(tables_to_export, PLANS)
+		log("Largest tables first: " + ", ".join(
+			table for (table, _) in tables_to_export[:5]
+		) + (", ..." if len(tables_to_export) > 5 else ""))
+
+	# Whoever started the export (e.g. a background job) can follow along with
+	# `on_progress(progress)`, row by row; see `Progress`
+	progress = Progress(
+		len(tables_that_exist),
+		tables_done=(len(tables_that_exist) - len(tables_to_export)),
+		on_progress=on_progress
+	)
+	progress.report()
+	options["on_progress"] = progress.update_table
+
+	if WORKERS > 1:
+		failed_tables = export_tables_in_parallel(
+			tables_to_export,
+			connection_args,
+			output,
+			(OUTPUT_FORMAT, OUTPUT_PATH, FIELD_TYPES, TEXT_CODECS),
+			options,
+			WORKERS,
+			WORKER_TYPE,
+			on_table_done=progress.finish_table
+		)
+		# The manifest only makes sense if every table made it
+		if DELTA and not failed_tables:
+			DELTA.write_manifest(tables_that_exist, output, CHUNK_SIZE)
+		output.close()
+		release_connection(con)
+		if failed_tables:
+			log(f"{len(failed_tables)} table(s) failed: {', '.join(failed_tables)}")
+			raise RuntimeError(f"Failed to export table(s): {', '.join(failed_tables)}")
+		if DELTA:
+			DELTA.clear()
+		return
+
+	try:
+		# For every table that exists
+		for i, (table, table_cont) in enumerate(tables_to_export):
+			log(f"Reading table {i+1}/{len(tables_to_export)}")
+
+			con = export_table_with_retries(
+				con, connection_args, table, output, cont=table_cont, **options
+			)
+			progress.finish_table(table)
 
-	con.close()
+			log(f"Done with {table}!\n")
+			log("-"*10)
+		if DELTA:
+			DELTA.write_manifest(tables_that_exist, output, CHUNK_SIZE)
+	finally:
+		output.close()
+		release_connection(con)
+	if DELTA:
+		DELTA.clear()
 	return
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import uuid
+import threading
+import concurrent.futures
+
+from prometheus_client import Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+
+# How many exports can run at the same time; the rest wait in line
+MAX_JOBS = max(int(os.environ.get("EXPORT_MAX_JOBS", "1")), 1)
+# Finished jobs are forgotten after a while, so the registry doesn't grow forever
+FINISHED_JOB_TTL = 24 * 60 * 60
+
+# Seconds; jobs wait and run for anything from seconds to hours
+JOB_BUCKETS = (1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800)
+
+JOB_WAIT_SECONDS = Histogram(
+	"gdb2csv_job_wait_seconds",
+	"How long export jobs waited in line before starting",
+	buckets=JOB_BUCKETS
+)
+JOB_SECONDS = Histogram(
+	"gdb2csv_job_duration_seconds",
+	"How long export jobs ran, by outcome",
+	("status",),
+	buckets=JOB_BUCKETS
+)
+
+
+class Job:
+	"""An export running (or waiting to run) in the background. `progress` is
+	whatever the export last reported through its `on_progress` callback"""
+
+	def __init__(self, filename, options):
+		self.id = uuid.uuid4().hex
+		self.filename = filename
+		self.options = options
+		self.status = "queued"
+		self.error = None
+		self.progress = dict()
+		self.created_at = time.time()
+		self.started_at = None
+		self.finished_at = None
+
+	def to_dict(self):
+		return {
+			"id": self.id,
+			"filename": self.filename,
+			"options": self.options,
+			"status": self.status,
+			"error": self.error,
+			"progress": self.progress,
+			"created_at": self.created_at,
+			"started_at": self.started_at,
+			"finished_at": self.finished_at,
+		}
+
+
+class JobManager:
+	"""Runs `export()` calls in a thread pool, so the web server's event loop
+	stays free to answer requests (status checks, health checks, ...) while
+	exports that take hours run in the background"""
+
+	def __init__(self, export_function, max_jobs=MAX_JOBS):
+		self.export_function = export_function
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+		self.jobs = dict()
+		self.lock = threading.Lock()
+
+	def submit(self, filename, **options):
+		with self.lock:
+			self.forget_finished_jobs()
+			# Asking again for an export that's still queued or running (e.g. the
+			# caller restarted and is resuming) gets the same job, instead of a
+			# second one writing over the first one's files
+			for job in self.jobs.values():
+				if (
+					job.finished_at is None and job.filename == filename
+					and job.options.get("workspace") == options.get("workspace")
+				):
+					return job
+			job = Job(filename, options)
+			self.jobs[job.id] = job
+		self.executor.submit(self.run, job)
+		return job
+
+	def run(self, job):
+		job.status = "running"
+		job.started_at = time.time()
+		JOB_WAIT_SECONDS.observe(job.started_at - job.created_at)
+
+		def on_progress(progress):
+			job.progress = progress
+
+		try:
+			self.export_function(job.filename, on_progress=on_progress, **job.options)
+			job.status = "done"
+		except BaseException as e:
+			job.status = "failed"
+			job.error = repr(e)
+		finally:
+			job.finished_at = time.time()
+			JOB_SECONDS.labels(status=job.status).observe(job.finished_at - job.started_at)
+
+	def get(self, job_id):
+		with self.lock:
+			return self.jobs.get(job_id)
+
+	def list(self):
+		with self.lock:
+			return list(self.jobs.values())
+
+	def count_by_status(self):
+		counts = { status: 0 for status in ("queued", "running", "done", "failed") }
+		for job in self.list():
+			counts[job.status] += 1
+		return counts
+
+	def collect(self):
+		"""Reports the jobs by status, as a Prometheus collector. (The jobs only
+		exist in this process, and in multiprocess mode a `Gauge` would only
+		report what's in the files)"""
+		gauge = GaugeMetricFamily("gdb2csv_jobs", "Export jobs known to the server, by status", labels=("status",))
+		for (status, count) in self.count_by_status().items():
+			gauge.add_metric([ status ], count)
+		yield gauge
+
+	def forget_finished_jobs(self):
+		now = time.time()
+		for (job_id, job) in list(self.jobs.items()):
+			if job.finished_at and now - job.finished_at > FINISHED_JOB_TTL:
+				del self.jobs[job_id]
@@ -1,24 +1,100 @@
+import os
+
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 
-from export import export
+from export import export, start_firebird, is_firebird_ready
+from jobs import JobManager  # ./jobs.py
 
 app = FastAPI()
+# Exports run in background threads; endpoints only start and check on them
+job_manager = JobManager(export)
+
+# With PROMETHEUS_MULTIPROC_DIR set (as in the container), every process keeps
+# its metrics in files there, so the worker processes of `worker_type=process`
+# are counted too; `/metrics` adds them all up
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+	registry = CollectorRegistry()
+	multiprocess.MultiProcessCollector(registry)
+else:
+	registry = REGISTRY
+registry.register(job_manager)
+
+@app.on_event("startup")
+def startup():
+	# Start Firebird once, when the container boots, instead of on every export
+	start_firebird()
 
 @app.get("/")
 async def abcdef():
 	return { 
 		"endpoints": {
-			"/export": repr(export)
+			"/export": repr(export),
+			"/jobs": "List of export jobs",
+			"/jobs/{job_id}": "Status and progress of an export job",
+			"/health": "Whether the server is up",
+			"/metrics": "Prometheus metrics of the exports"
 		}
 	}
 
 
+@app.get("/health")
+async def health():
+	return { "success": True, "firebird": is_firebird_ready() }
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+	# Not async: reading the worker processes' files shouldn't block the loop
+	# As a header; as `media_type`, Starlette would add a second charset
+	return Response(generate_latest(registry), headers={ "Content-Type": CONTENT_TYPE_LATEST })
+
+
 @app.get("/export/{filename}")
 async def export_endpoint(
-	filename: str
+	filename: str,
+	table_list: str = "all",
+	workers: int = 1,
+	worker_type: str = "thread",
+	output_format: str = "csv",
+	delta: str = "",
+	workspace: str = "",
+	text_charset: str = "",
+	chunk_size: int = 0,
+	pipeline: int = 0
 ):
+	# Returns right away; the export itself can take hours, so the caller
+	# should poll `/jobs/{job_id}` until it's done
 	try:
-		export(filename)
+		job = job_manager.submit(
+			filename,
+			table_list=table_list,
+			workers=workers,
+			worker_type=worker_type,
+			output_format=output_format,
+			delta=delta,
+			workspace=workspace,
+			text_charset=text_charset,
+			chunk_size=chunk_size,
+			pipeline=pipeline
+		)
 	except Exception as e:
 		return { "success": False, "error": repr(e) }
-	return { "success": True }
+	return { "success": True, "job_id": job.id }
+
+
+@app.get("/jobs")
+async def list_jobs():
+	return { "jobs": [ job.to_dict() for job in job_manager.list() ] }
+
+
+@app.get("/jobs/{job_id}")
+async def check_job(job_id: str):
+	job = job_manager.get(job_id)
+	if job is None:
+		return JSONResponse(
+			status_code=404,
+			content={ "success": False, "error": f"Unknown job '{job_id}'" }
+		)
+	return job.to_dict()
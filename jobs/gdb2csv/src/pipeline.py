@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import time
+import queue
+import threading
+
+
+class Prefetcher:
+	"""Runs through `items` (an iterator, e.g. a generator that fetches chunks
+	of a table) in a background thread, staying up to `depth` items ahead of
+	whoever iterates over the `Prefetcher`. That way, fetching the next item
+	and working on the current one overlap, and at most `depth` items wait in
+	memory between the two.
+
+	`producer_idle` is how long (in seconds) the background thread spent
+	waiting for room in the queue, i.e. waiting for the consumer, and
+	`consumer_idle` is how long the consumer spent waiting for items. Whichever
+	side waits the least is the bottleneck. Errors raised by `items` are raised
+	again to the consumer. `close()` must be called once done (or if anything
+	fails), so the thread stops and isn't left holding on to anything"""
+
+	# Marks the end of `items`: `(DONE, None)`, or `(DONE, exception)`
+	DONE = object()
+	# How often a producer waiting for room checks whether it should stop
+	POLL_INTERVAL = 0.1
+
+	def __init__(self, items, depth):
+		self.items = items
+		self.queue = queue.Queue(maxsize=max(int(depth), 1))
+		self.stopping = threading.Event()
+		self.producer_idle = 0
+		self.consumer_idle = 0
+		self.thread = threading.Thread(target=self.produce, daemon=True)
+		self.thread.start()
+
+	def put(self, entry):
+		"""Returns False if we were told to stop before there was room"""
+		START_TIME = time.perf_counter()
+		try:
+			while not self.stopping.is_set():
+				try:
+					self.queue.put(entry, timeout=self.POLL_INTERVAL)
+					return True
+				except queue.Full:
+					continue
+			return False
+		finally:
+			self.producer_idle += time.perf_counter() - START_TIME
+
+	def produce(self):
+		try:
+			for item in self.items:
+				if not self.put((item, None)):
+					return
+			self.put((self.DONE, None))
+		except BaseException as e:
+			self.put((self.DONE, e))
+		finally:
+			# Runs the generator's cleanup (if it was left halfway) in its own thread
+			if hasattr(self.items, "close"):
+				self.items.close()
+
+	def __iter__(self):
+		while True:
+			START_TIME = time.perf_counter()
+			(item, error) = self.queue.get()
+			self.consumer_idle += time.perf_counter() - START_TIME
+			if item is self.DONE:
+				if error is not None:
+					raise error
+				return
+			yield item
+
+	def close(self):
+		self.stopping.set()
+		# A producer waiting for room sees `stopping` within `POLL_INTERVAL`; one
+		# in the middle of fetching an item finishes it first
+		while self.thread.is_alive():
+			try:
+				self.queue.get(timeout=self.POLL_INTERVAL)
+			except queue.Empty:
+				pass
+		self.thread.join()
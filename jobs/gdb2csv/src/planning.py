@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+# Field type codes from RDB$FIELDS.RDB$FIELD_TYPE; see writers.py
+FIELD_TYPE_VARCHAR = 37
+FIELD_TYPE_BLOB = 261
+
+# RDB$FIELD_LENGTH of a BLOB is the size of its ID, not of its contents, which
+# we can't know without reading them; so we guess, and let `ChunkSizer` find
+# out the real size as rows come in
+BLOB_BYTES = 1024
+
+# Chunks are sized to hold about this much data, whatever the width of the
+# table's rows (which goes from a few bytes to a few KB). 4MB is around what
+# the old fixed 10,000 rows came to for a typical table
+CHUNK_TARGET_BYTES = 4*1024*1024
+# Chunks that are fetched quickly grow up to this many times the target (fewer
+# round trips), and slow ones shrink down to this fraction of it (less memory,
+# and less to redo if a chunk fails)
+CHUNK_MAX_SCALE = 4
+CHUNK_MIN_SCALE = 1/16
+CHUNK_FAST_SECONDS = 1
+CHUNK_SLOW_SECONDS = 15
+MIN_CHUNK_ROWS = 100
+MAX_CHUNK_ROWS = 500_000
+
+# How many rows of each chunk are looked at to measure their width
+SAMPLE_ROWS = 64
+
+
+def estimate_column_bytes(field_type, field_length):
+	if field_type == FIELD_TYPE_BLOB:
+		return BLOB_BYTES
+	# VARCHARs are sent with their length in front; rarely are they full, but
+	# we'd rather overestimate (smaller chunks) than run out of memory
+	if field_type == FIELD_TYPE_VARCHAR:
+		return (field_length or 0) + 2
+	return field_length or 0
+
+
+def estimate_value_bytes(value):
+	if value is None:
+		return 0
+	if isinstance(value, (str, bytes)):
+		return len(value)
+	# Numbers, dates, ...: about what they take on the wire
+	return 8
+
+
+def measure_row_bytes(rows):
+	"""Average width of `rows`, from a sample spread over them"""
+	step = max(len(rows) // SAMPLE_ROWS, 1)
+	sample = rows[::step]
+	total = sum(estimate_value_bytes(value) for row in sample for value in row)
+	return max(total / len(sample), 1)
+
+
+def get_chunk_size(row_bytes, scale=1):
+	"""How many rows of `row_bytes` bytes fit in `scale` times the target"""
+	if not row_bytes:
+		return None
+	size = int(CHUNK_TARGET_BYTES * scale / row_bytes)
+	return max(MIN_CHUNK_ROWS, min(size, MAX_CHUNK_ROWS))
+
+
+class ChunkSizer:
+	"""Decides how many rows to fetch in each chunk of a table. With `adaptive`,
+	the size follows the rows as they're read: it's aimed at
+	`CHUNK_TARGET_BYTES` by the width the rows actually have (which the
+	estimate from RDB$FIELDS can be way off of), and scaled up while chunks come
+	back within `CHUNK_FAST_SECONDS`, or down while they take longer than
+	`CHUNK_SLOW_SECONDS`. Otherwise, it's always `size`"""
+
+	def __init__(self, size, row_bytes=None, adaptive=False):
+		self.size = size
+		self.row_bytes = row_bytes
+		self.adaptive = adaptive
+		self.scale = 1
+
+	def record(self, rows, seconds):
+		"""Takes in a chunk that was just fetched, and how long that took.
+		Returns whether the size of the next one changed"""
+		if not self.adaptive or not rows:
+			return False
+		self.row_bytes = measure_row_bytes(rows)
+		if seconds < CHUNK_FAST_SECONDS:
+			self.scale = min(self.scale * 2, CHUNK_MAX_SCALE)
+		elif seconds > CHUNK_SLOW_SECONDS:
+			self.scale = max(self.scale / 2, CHUNK_MIN_SCALE)
+		size = get_chunk_size(self.row_bytes, self.scale)
+		changed = (size != self.size)
+		self.size = size
+		return changed
+
+
+def get_estimated_bytes(plan):
+	if plan is None or plan.get("rows") is None:
+		return math.inf
+	return plan["rows"] * (plan.get("row_bytes") or 1)
+
+
+def order_largest_first(tables, plans):
+	"""Sorts `tables`, a list of `(table_name, cont)`, by the estimated size in
+	`plans`, largest first. When exporting in parallel, the largest table is
+	what decides how long the export takes, so it should start right away
+	instead of after a hundred small ones; the small ones then fill in the
+	gaps. Tables we know nothing about go first, since any of them could be
+	the largest"""
+	return sorted(
+		tables,
+		key=lambda table: get_estimated_bytes(plans.get(table[0])),
+		reverse=True
+	)
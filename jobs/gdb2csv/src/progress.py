@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+
+class Progress:
+	"""Keeps track of how far along an export is, table by table, and passes a
+	snapshot of it to `on_progress(progress)` every time it changes. Tables can
+	report from several worker threads at once.
+
+	For every table being exported, the snapshot has the rows done so far, the
+	table's total (if known), the bytes written, the rows per second since the
+	table started, and how long it should take to finish at that rate"""
+
+	def __init__(self, tables_total, tables_done=0, on_progress=None):
+		self.on_progress = on_progress
+		self.lock = threading.Lock()
+		self.start_time = time.time()
+		self.tables_total = tables_total
+		self.tables_done = tables_done
+		self.tables_failed = []
+		# Per table: first rows seen, when, and the latest report
+		self.tables = dict()
+		# Rows exported by tables that are already done
+		self.finished_rows = 0
+		self.finished_tables = set()
+
+	def update_table(self, table_name, rows, total_rows=None, bytes_written=None):
+		now = time.time()
+		with self.lock:
+			# Reports from worker processes can arrive after the table is done
+			if table_name in self.finished_tables:
+				return
+			if table_name not in self.tables:
+				# A table continued from a checkpoint starts with rows done already;
+				# those don't count towards its speed
+				self.tables[table_name] = {
+					"start_rows": rows,
+					"start_time": now,
+				}
+			self.tables[table_name].update({
+				"rows": rows,
+				"total_rows": total_rows,
+				"bytes": bytes_written,
+				"time": now,
+			})
+		self.report()
+
+	def finish_table(self, table_name, failed=False):
+		with self.lock:
+			self.finished_tables.add(table_name)
+			state = self.tables.pop(table_name, None)
+			if state is not None:
+				self.finished_rows += state["rows"] - state["start_rows"]
+			if failed:
+				self.tables_failed.append(table_name)
+			else:
+				self.tables_done += 1
+		self.report()
+
+	def snapshot(self):
+		now = time.time()
+		with self.lock:
+			current = dict()
+			rows_this_run = self.finished_rows
+			for (table_name, state) in self.tables.items():
+				rows_done = state["rows"] - state["start_rows"]
+				rows_this_run += rows_done
+				elapsed = now - state["start_time"]
+				rate = rows_done / elapsed if elapsed > 0 else None
+				eta = None
+				if rate and state["total_rows"] is not None:
+					eta = max(state["total_rows"] - state["rows"], 0) / rate
+				current[table_name] = {
+					"rows": state["rows"],
+					"total_rows": state["total_rows"],
+					"bytes": state["bytes"],
+					"rows_per_sec": round(rate, 1) if rate is not None else None,
+					"eta_seconds": round(eta) if eta is not None else None,
+				}
+			elapsed = now - self.start_time
+			return {
+				"tables_total": self.tables_total,
+				"tables_done": self.tables_done,
+				"tables_failed": list(self.tables_failed),
+				"current_tables": list(current.keys()),
+				"tables": current,
+				"rows": rows_this_run,
+				"rows_per_sec": round(rows_this_run / elapsed, 1) if elapsed > 0 else None,
+				"elapsed_seconds": round(elapsed),
+			}
+
+	def report(self):
+		if self.on_progress:
+			self.on_progress(self.snapshot())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+import datetime
+
+
+# Field type codes from RDB$FIELDS.RDB$FIELD_TYPE; see writers.py
+FIELD_TYPE_DATE = 12
+FIELD_TYPE_TIME = 13
+FIELD_TYPE_TIMESTAMP = 35
+
+# Column names go into the query as they are (they can't be parameters), so
+# they must be columns the table actually has, and plain identifiers: we don't
+# quote them, since dialect 1 databases don't support quoted identifiers
+IDENTIFIER = re.compile(r"^[A-Z][A-Z0-9_$]*$")
+
+# Operator => how many values it takes (None: a list of them)
+OPERATORS = {
+	"=": 1,
+	"<>": 1,
+	"<": 1,
+	"<=": 1,
+	">": 1,
+	">=": 1,
+	"in": None,
+	"is null": 0,
+	"is not null": 0,
+}
+# Firebird refuses IN lists longer than this
+MAX_IN_VALUES = 1500
+
+DATE_FORMATS = ("%Y-%m-%d",)
+TIME_FORMATS = ("%H:%M:%S", "%H:%M:%S.%f", "%H:%M")
+TIMESTAMP_FORMATS = (
+	"%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+	"%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S.%f",
+	"%Y-%m-%d",
+)
+
+
+def parse_table_list(table_list):
+	"""Returns which tables `table_list` asks for (None for all of them) and
+	what to select from each, as `{ table: { "columns": [...], "where": [...] } }`.
+
+	`table_list` is either 'all', table names separated by ';', or a dict (or
+	its JSON) of table name => selection, where `columns` lists the columns
+	to export (all of them, if missing or empty) and `where` lists conditions
+	that rows must all meet, each `{ "column": ..., "op": ..., "value": ... }`"""
+	if isinstance(table_list, str) and table_list.strip().startswith("{"):
+		try:
+			table_list = json.loads(table_list)
+		except ValueError as e:
+			raise ValueError(f"table_list isn't valid JSON: {e}")
+	if isinstance(table_list, dict):
+		specs = dict()
+		for (table_name, spec) in table_list.items():
+			spec = spec or dict()
+			if not isinstance(spec, dict) or set(spec) - { "columns", "where" }:
+				raise ValueError(f"Selection of '{table_name}' takes only 'columns' and 'where'")
+			specs[table_name.strip()] = spec
+		return (list(specs), specs)
+	if table_list.lower() == "all":
+		return (None, dict())
+	return ([ t.strip() for t in table_list.split(";") ], dict())
+
+
+def parse_value(value, field_type):
+	"""Dates and times come as strings in JSON; the driver needs them as
+	`datetime`s to send them as such"""
+	if not isinstance(value, str):
+		return value
+	formats = {
+		FIELD_TYPE_DATE: DATE_FORMATS,
+		FIELD_TYPE_TIME: TIME_FORMATS,
+		FIELD_TYPE_TIMESTAMP: TIMESTAMP_FORMATS,
+	}.get(field_type)
+	if formats is None:
+		return value
+	for value_format in formats:
+		try:
+			parsed = datetime.datetime.strptime(value, value_format)
+		except ValueError:
+			continue
+		if field_type == FIELD_TYPE_DATE:
+			return parsed.date()
+		if field_type == FIELD_TYPE_TIME:
+			return parsed.time()
+		return parsed
+	raise ValueError(f"Can't read '{value}' as a date/time (expected e.g. '2024-01-31 08:00:00')")
+
+
+def check_column(table_name, column, field_types):
+	# Unquoted identifiers are case-insensitive; Firebird keeps them uppercase
+	if isinstance(column, str):
+		column = column.strip().upper()
+	if not isinstance(column, str) or not IDENTIFIER.match(column):
+		raise ValueError(f"'{column}' isn't a valid column name")
+	if column not in field_types:
+		raise ValueError(f"Table '{table_name}' has no column '{column}'")
+	return column
+
+
+def build_selection(table_name, spec, field_types):
+	"""Turns a table's selection (see `parse_table_list()`) into what goes in
+	its queries: `{ "columns": [...] or None, "where": "...", "params": [...] }`.
+	Columns are checked against `field_types` (the table's, as returned by
+	`get_field_types()`), and values are passed as query parameters, never
+	pasted into the query. Returns None if there's nothing to select"""
+	if not spec:
+		return None
+	columns = None
+	if spec.get("columns"):
+		columns = []
+		for column in spec["columns"]:
+			column = check_column(table_name, column, field_types)
+			if column not in columns:
+				columns.append(column)
+
+	conditions = []
+	params = []
+	for condition in spec.get("where") or []:
+		if not isinstance(condition, dict):
+			raise ValueError(f"Conditions on '{table_name}' must be {{ \"column\", \"op\", \"value\" }}")
+		column = check_column(table_name, condition.get("column"), field_types)
+		op = str(condition.get("op", "")).lower()
+		if op not in OPERATORS:
+			raise ValueError(f"Unknown operator '{op}'; use one of: {', '.join(OPERATORS)}")
+		field_type = field_types[column][0]
+		value = condition.get("value")
+		arity = OPERATORS[op]
+		if arity == 0:
+			conditions.append(f"{column} {op.upper()}")
+		elif arity == 1:
+			# `column = NULL` is never true; that's what 'is null' is for
+			if value is None or isinstance(value, (list, dict)):
+				raise ValueError(f"'{op}' on '{column}' takes a single value")
+			conditions.append(f"{column} {op} ?")
+			params.append(parse_value(value, field_type))
+		else:
+			if not isinstance(value, list) or not value or len(value) > MAX_IN_VALUES:
+				raise ValueError(f"'in' on '{column}' takes a list of 1 to {MAX_IN_VALUES} values")
+			conditions.append(f"{column} IN ({', '.join('?' for _ in value)})")
+			params.extend(parse_value(v, field_type) for v in value)
+
+	if columns is None and not conditions:
+		return None
+	return {
+		"columns": columns,
+		"where": " AND ".join(f"({condition})" for condition in conditions),
+		"params": params,
+	}
+
+
+def has_column(selection, column):
+	return not selection or not selection["columns"] or column in selection["columns"]
+
+
+def get_select_list(selection, table_name=None):
+	"""What goes between SELECT and FROM; qualified by `table_name`, if given,
+	for when there are other columns before it"""
+	if not selection or not selection["columns"]:
+		return f"{table_name}.*" if table_name else "*"
+	if table_name:
+		return ", ".join(f"{table_name}.{column}" for column in selection["columns"])
+	return ", ".join(selection["columns"])
+
+
+def get_where(selection, *conditions):
+	"""The WHERE clause for the selection plus `conditions`, or ''"""
+	conditions = [ c for c in conditions if c ]
+	if selection and selection["where"]:
+		conditions.insert(0, selection["where"])
+	if not conditions:
+		return ""
+	return "WHERE " + " AND ".join(conditions)
+
+
+def get_params(selection, *params):
+	"""Parameters for `get_where(selection, ...)`, in order"""
+	return list(selection["params"] if selection else []) + list(params)
@@ -0,0 +1,740 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import csv
+import copy
+import math
+import time
+import struct
+import zipfile
+import datetime
+
+
+# We used to build a pandas DataFrame for every chunk and call `to_csv()` on it.
+# That kept each chunk in memory three times over (tuples, DataFrame, text), so
+# now rows are formatted and written straight from the cursor. To keep the
+# output byte-for-byte identical, rows are formatted the way pandas would have
+# formatted a DataFrame built from them: pandas infers one dtype per column,
+# and the dtype decides how values are written. The rules below mirror pandas
+# 1.1, which is the last release that supports Python 3.6
+
+# Values outside of this range don't fit in `datetime64[ns]`, so pandas keeps
+# the whole column as `object` and writes `str(value)` instead
+# [Ref] https://pandas.pydata.org/pandas-docs/version/1.1.5/user_guide/timeseries.html#timestamp-limitations
+DATETIME64_MIN = datetime.datetime(1677, 9, 21, 0, 12, 43, 145225)
+DATETIME64_MAX = datetime.datetime(2262, 4, 11, 23, 47, 16, 854775)
+
+# Rows are buffered in memory up to this size before being written out
+BUFFER_SIZE = 1024*1024
+
+KIND_EMPTY = "empty"
+KIND_INT = "int"
+KIND_FLOAT = "float"
+KIND_DATETIME = "datetime"
+KIND_OBJECT = "object"
+
+# Field type codes from RDB$FIELDS.RDB$FIELD_TYPE
+# [Ref] https://ib-aid.com/download/docs/firebird-language-reference-2.5/fblangref-appx04-fields.html
+FIELD_TYPE_SMALLINT = 7
+FIELD_TYPE_INTEGER = 8
+FIELD_TYPE_QUAD = 9
+FIELD_TYPE_FLOAT = 10
+FIELD_TYPE_D_FLOAT = 11
+FIELD_TYPE_DATE = 12
+FIELD_TYPE_TIME = 13
+FIELD_TYPE_CHAR = 14
+FIELD_TYPE_BIGINT = 16
+FIELD_TYPE_DOUBLE = 27
+FIELD_TYPE_TIMESTAMP = 35
+FIELD_TYPE_VARCHAR = 37
+FIELD_TYPE_CSTRING = 40
+FIELD_TYPE_BLOB = 261
+
+
+def is_null(value):
+	return value is None or (type(value) is float and math.isnan(value))
+
+
+def infer_column_kind(values):
+	"""Returns which dtype pandas would have inferred for this column"""
+	kind = KIND_EMPTY
+	has_null = False
+	for value in values:
+		if is_null(value):
+			has_null = True
+			continue
+		t = type(value)
+		if t is int:
+			value_kind = KIND_INT
+		elif t is float:
+			value_kind = KIND_FLOAT
+		elif t is datetime.datetime and DATETIME64_MIN <= value <= DATETIME64_MAX:
+			value_kind = KIND_DATETIME
+		else:
+			# Strings, Decimals, dates, times, bytes, ...
+			return KIND_OBJECT
+
+		if kind == KIND_EMPTY or kind == value_kind:
+			kind = value_kind
+		# Ints and floats together become float64
+		elif {kind, value_kind} == {KIND_INT, KIND_FLOAT}:
+			kind = KIND_FLOAT
+		else:
+			return KIND_OBJECT
+
+	# There's no NaN for int64, so a single NULL turns the column into float64,
+	# which is why we get '1.0' instead of '1'
+	if kind == KIND_INT and has_null:
+		kind = KIND_FLOAT
+	return kind
+
+
+def get_timespec(non_null):
+	"""How pandas writes a column of datetimes: if every value is at midnight,
+	it omits the time entirely ('date'); otherwise, every value gets the finest
+	precision found in the column"""
+	if all(v.time() == datetime.time(0) for v in non_null):
+		return "date"
+	if any(v.microsecond % 1000 for v in non_null):
+		return "microseconds"
+	if any(v.microsecond for v in non_null):
+		return "milliseconds"
+	return "seconds"
+
+
+def format_datetimes(values, timespec):
+	if timespec == "date":
+		return [ "" if is_null(v) else v.date().isoformat() for v in values ]
+	# Whole seconds are what `str()` gives, which `csv.writer` calls anyway
+	if timespec == "seconds":
+		return values
+	return [
+		"" if is_null(v) else v.isoformat(sep=" ", timespec=timespec)
+		for v in values
+	]
+
+
+def format_datetime_column(values, non_null=None):
+	if non_null is None:
+		non_null = [ v for v in values if not is_null(v) ]
+	return format_datetimes(values, get_timespec(non_null))
+
+
+def format_column(values):
+	kind = infer_column_kind(values)
+	if kind == KIND_EMPTY:
+		return [ "" ] * len(values)
+	if kind == KIND_INT:
+		return [ str(v) for v in values ]
+	if kind == KIND_FLOAT:
+		return [ "" if is_null(v) else repr(float(v)) for v in values ]
+	if kind == KIND_DATETIME:
+		return format_datetime_column(values)
+	# `csv.writer` calls `str()` on anything that isn't a string, like pandas
+	return [ "" if is_null(v) else v for v in values ]
+
+
+def format_rows(rows):
+	"""Formats a batch of rows (as returned by `fetchmany()`) column by column"""
+	columns = [ format_column(list(values)) for values in zip(*rows) ]
+	return zip(*columns)
+
+
+################################################################################
+
+# Inferring each column's dtype from its values (above) costs a Python-level
+# type check per value. When we know the columns' Firebird types (from
+# RDB$RELATION_FIELDS), we know what the driver returns for each, so we can
+# pick a formatter per column once per table instead. Most types need none:
+# `csv.writer` already writes None as '', `str()` for ints, Decimals, dates
+# and strings, and `repr()` for floats, same as pandas did for those dtypes
+
+def format_int_column_as_float(values):
+	return [ "" if v is None else repr(float(v)) for v in values ]
+
+
+def format_int_column(values):
+	# A single NULL turns the column into float64; see `infer_column_kind()`
+	if None in values:
+		return format_int_column_as_float(values)
+	return values
+
+
+def format_float_column(values):
+	if any(v != v for v in values if v is not None):
+		return [ "" if is_null(v) else v for v in values ]
+	return values
+
+
+def format_timestamp_column(values):
+	non_null = [ v for v in values if v is not None ]
+	if not non_null:
+		return values
+	# Out of `datetime64[ns]` range, pandas kept the column as `object`
+	if min(non_null) < DATETIME64_MIN or max(non_null) > DATETIME64_MAX:
+		return values
+	return format_datetime_column(values, non_null)
+
+
+def make_transcoder(from_codec, to_codec):
+	"""Returns a formatter that re-decodes a column of text, decoded by the
+	driver as `from_codec`, as `to_codec`. The whole column is joined and
+	transcoded at once, instead of value by value"""
+	def transcode_value(value):
+		if not isinstance(value, str):
+			return value
+		try:
+			return value.encode(from_codec).decode(to_codec)
+		except UnicodeError:
+			# Bytes that don't exist in `to_codec` are better kept as they were
+			return value
+
+	def transcode(values):
+		texts = [ "" if v is None else v for v in values ]
+		try:
+			transcoded = "\x00".join(texts).encode(from_codec).decode(to_codec).split("\x00")
+			# Text with NULs in it would split in the wrong places
+			if len(transcoded) == len(texts):
+				return transcoded
+		except (TypeError, UnicodeError):
+			pass
+		return [ transcode_value(v) for v in texts ]
+	return transcode
+
+
+################################################################################
+
+# Integer and timestamp columns are written according to every value in them
+# (a single NULL anywhere turns integers into floats, the finest precision
+# found goes for every timestamp, ...). pandas saw whole tables (or chunks of
+# a fixed 10,000 rows) at once; we see batches, which would make the output
+# depend on where each batch starts and ends. So those columns are profiled
+# over the whole table first (see `get_table_profile()` in export.py), and
+# every batch is formatted according to the profile
+
+PROFILE_INT = "int"
+PROFILE_TIMESTAMP = "timestamp"
+
+
+def get_profiled_columns(field_types):
+	"""Which columns of a table (`{ column: (field_type, sub_type, scale,
+	precision) }`) need a profile, as `{ column: PROFILE_* }`"""
+	kinds = dict()
+	for (column, (field_type, _, scale, _)) in field_types.items():
+		if field_type in (FIELD_TYPE_SMALLINT, FIELD_TYPE_INTEGER, FIELD_TYPE_BIGINT, FIELD_TYPE_QUAD) and not scale:
+			kinds[column] = PROFILE_INT
+		elif field_type == FIELD_TYPE_TIMESTAMP:
+			kinds[column] = PROFILE_TIMESTAMP
+	return kinds
+
+
+def get_timestamp_profile(low, high, has_time, fraction):
+	"""Profiles a timestamp column from its MIN(), its MAX(), whether any value
+	has a time of day, and the finest fraction of a second in any value (0:
+	none, 1: milliseconds, 2: finer than that). The profile's timespec is as
+	in `get_timespec()`, or None if the values go as they are"""
+	# All NULLs, or out of `datetime64[ns]` range (kept as `object` by pandas)
+	if low is None or low < DATETIME64_MIN or high > DATETIME64_MAX:
+		return { "timespec": None }
+	if not has_time:
+		return { "timespec": "date" }
+	return { "timespec": ("seconds", "milliseconds", "microseconds")[fraction or 0] }
+
+
+def get_profiled_formatter(field_type, profile):
+	if field_type == FIELD_TYPE_TIMESTAMP:
+		timespec = profile["timespec"]
+		if timespec is None or timespec == "seconds":
+			return None
+		return lambda values: format_datetimes(values, timespec)
+	return format_int_column_as_float if profile["nulls"] else None
+
+
+def is_text_field(field_type, sub_type=None):
+	# BLOB SUB_TYPE 1 is text, and comes decoded like CHARs and VARCHARs
+	return field_type in (FIELD_TYPE_CHAR, FIELD_TYPE_VARCHAR, FIELD_TYPE_CSTRING) or (
+		field_type == FIELD_TYPE_BLOB and sub_type == 1
+	)
+
+
+def get_column_formatter(field_type, sub_type=None, scale=None, precision=None, transcode=None, profile=None):
+	"""Returns how to format a column of the given Firebird type (as described
+	in RDB$FIELDS), or None if `csv.writer` can take its values as they are.
+	Without its `profile`, a column that needs one is inferred batch by batch"""
+	scale = scale or 0
+	if profile is not None:
+		return get_profiled_formatter(field_type, profile)
+	# NUMERIC/DECIMAL come as Decimals, which pandas kept as `object`
+	if field_type in (FIELD_TYPE_SMALLINT, FIELD_TYPE_INTEGER, FIELD_TYPE_BIGINT, FIELD_TYPE_QUAD):
+		return format_int_column if scale == 0 else None
+	if field_type in (FIELD_TYPE_FLOAT, FIELD_TYPE_D_FLOAT, FIELD_TYPE_DOUBLE):
+		return format_float_column
+	if field_type == FIELD_TYPE_TIMESTAMP:
+		return format_timestamp_column
+	# `datetime.date`s and `datetime.time`s were `object` too
+	if field_type in (FIELD_TYPE_DATE, FIELD_TYPE_TIME):
+		return None
+	# Other BLOB subtypes come as bytes, written as `str(bytes)` like pandas did
+	if is_text_field(field_type, sub_type):
+		return transcode
+	if field_type == FIELD_TYPE_BLOB:
+		return None
+	# Anything else, we'd rather infer from the values
+	return format_column
+
+
+def get_column_formatters(columns, field_types, transcode=None, profile=None):
+	"""One formatter (or None) per column; columns we don't know the type of
+	are inferred from their values, batch by batch. `profile` has the profile
+	of each column that needs one (see `get_profiled_columns()`)"""
+	profile = profile or dict()
+	return [
+		get_column_formatter(*field_types[column], transcode=transcode, profile=profile.get(column))
+		if column in field_types
+		else format_column
+		for column in columns
+	]
+
+
+class CsvTableWriter:
+	"""Writes rows to a CSV file as they're fetched, without holding the entire
+	table in memory. Output is identical to `pd.DataFrame(rows).to_csv(...)`
+	for all the rows written, as long as `formatters` (one formatter, or None,
+	per column, as returned by `get_column_formatters()`) were built with the
+	table's profile; otherwise, columns are inferred from each call to
+	`write_rows()`, as if it were a DataFrame of its own"""
+
+	def __init__(self, file, name, columns, write_header=True, formatters=None):
+		# `file` is any text file object opened with `newline=""`, since pandas
+		# also lets `csv.writer` end the lines
+		self.file = file
+		self.name = name
+		self.row_count = 0
+		self.formatters = None
+		if formatters is not None:
+			self.formatters = [ (i, f) for (i, f) in enumerate(formatters) if f is not None ]
+		self.writer = csv.writer(
+			self.file,
+			delimiter=",",
+			quotechar='"',
+			quoting=csv.QUOTE_MINIMAL,
+			lineterminator="\n"
+		)
+		if write_header:
+			self.writer.writerow(columns)
+
+	def write_rows(self, rows):
+		if not rows:
+			return
+		if self.formatters is None:
+			self.writer.writerows(format_rows(rows))
+		elif not self.formatters:
+			# Nothing to format; rows go to `csv.writer` as the driver gave them
+			self.writer.writerows(rows)
+		else:
+			columns = list(zip(*rows))
+			changed = False
+			for (i, formatter) in self.formatters:
+				values = formatter(columns[i])
+				# Most batches need no changes at all (no NULLs in integer columns,
+				# timestamps in whole seconds, ...); then the rows can go as they are
+				if values is not columns[i]:
+					columns[i] = values
+					changed = True
+			self.writer.writerows(zip(*columns) if changed else rows)
+		self.row_count += len(rows)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+################################################################################
+
+
+def get_table_formatters(output, table_name, columns, profile=None):
+	if output.field_types is None or table_name not in output.field_types:
+		return None
+	return get_column_formatters(columns, output.field_types[table_name], output.transcode, profile)
+
+
+class CsvDirectoryOutput:
+	"""Writes each table to its own '<table>.csv' file inside `directory`.
+	With `field_types` (see `ParquetDirectoryOutput`), columns are formatted
+	according to their types (and the `profile` given to `open_table()`);
+	with `transcode`, text columns go through it"""
+
+	# Whether a partially written table can be continued later, whether a
+	# table can be written again from scratch, and whether tables should be
+	# profiled before they're written
+	format = "csv"
+	can_append = True
+	can_rewrite = True
+	uses_profiles = True
+
+	def __init__(self, directory, field_types=None, transcode=None):
+		self.directory = directory
+		self.field_types = field_types
+		self.transcode = transcode
+
+	def table_path(self, table_name):
+		return os.path.join(self.directory, f"{table_name}.csv")
+
+	def open_table(self, table_name, columns, append=False, profile=None):
+		file_path = self.table_path(table_name)
+		# Guarantees /csv directory exists
+		os.makedirs(self.directory, exist_ok=True)
+		file = open(
+			file_path,
+			mode=("a" if append else "w"),
+			encoding="utf-8",
+			newline="",
+			buffering=BUFFER_SIZE
+		)
+		return CsvTableWriter(
+			file, file_path, columns,
+			write_header=(not append),
+			formatters=get_table_formatters(self, table_name, columns, profile)
+		)
+
+	def has_table(self, table_name):
+		return os.path.isfile(self.table_path(table_name))
+
+	def get_table_size(self, table_name):
+		file_path = self.table_path(table_name)
+		return os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+	def truncate_table(self, table_name, size):
+		"""Cuts the table's file back to `size` bytes; returns False if the file
+		doesn't exist or is already smaller than that"""
+		file_path = self.table_path(table_name)
+		# Nothing written yet (e.g. every chunk so far was reused in a delta export)
+		if size == 0 and not os.path.exists(file_path):
+			return True
+		if not os.path.isfile(file_path) or os.path.getsize(file_path) < size:
+			return False
+		os.truncate(file_path, size)
+		return True
+
+	def remove_table(self, table_name):
+		file_path = self.table_path(table_name)
+		if os.path.exists(file_path):
+			os.remove(file_path)
+
+	def write_file(self, name, text):
+		"""Writes a file that isn't a table (e.g. a manifest) next to the tables"""
+		os.makedirs(self.directory, exist_ok=True)
+		with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+			f.write(text)
+
+	def close(self):
+		pass
+
+
+def strip_zip64_extra(extra):
+	"""Removes the ZIP64 record (header ID 0x0001) from an entry's extra field;
+	`ZipFile` adds a fresh one when writing headers, and two would be invalid"""
+	out = b""
+	i = 0
+	while i + 4 <= len(extra):
+		(header_id, size) = struct.unpack("<HH", extra[i:i+4])
+		if header_id != 0x0001:
+			out += extra[i:i+4+size]
+		i += 4 + size
+	return out
+
+
+class ZipArchiveOutput:
+	"""Writes each table as a '<table>.csv' entry of a ZIP archive, compressing
+	rows as they're written, so the CSVs never touch the disk uncompressed.
+	Only one entry can be written at a time; parallel workers each write to
+	their own archive, which are then merged with `append_archive()`"""
+
+	format = "zip"
+	can_append = False
+	can_rewrite = False
+	uses_profiles = True
+
+	def __init__(self, zip_path, field_types=None, transcode=None):
+		self.zip_path = zip_path
+		self.field_types = field_types
+		self.transcode = transcode
+		os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+		self.zip_file = zipfile.ZipFile(
+			zip_path,
+			mode="w",
+			compression=zipfile.ZIP_DEFLATED,
+			allowZip64=True
+		)
+		# Where each table's entry starts, to tell how much has been written
+		self.entry_offsets = dict()
+
+	def open_table(self, table_name, columns, append=False, profile=None):
+		if append:
+			raise ValueError("Can't append to a table inside a ZIP archive")
+		entry_name = f"{table_name}.csv"
+		self.entry_offsets[table_name] = self.zip_file.fp.tell()
+		info = zipfile.ZipInfo(entry_name, date_time=time.localtime()[:6])
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.external_attr = 0o644 << 16
+		# We don't know the final size beforehand, so we always write ZIP64
+		# headers; otherwise entries past 2 GiB would fail halfway through
+		entry = self.zip_file.open(info, mode="w", force_zip64=True)
+		file = io.TextIOWrapper(
+			io.BufferedWriter(entry, buffer_size=BUFFER_SIZE),
+			encoding="utf-8",
+			newline=""
+		)
+		return CsvTableWriter(
+			file, f"{self.zip_path}:{entry_name}", columns,
+			formatters=get_table_formatters(self, table_name, columns, profile)
+		)
+
+	def append_archive(self, other_zip_path):
+		"""Copies every entry of another archive into this one as-is, without
+		decompressing and compressing it again"""
+		with zipfile.ZipFile(other_zip_path) as other, open(other_zip_path, "rb") as src:
+			for info in other.infolist():
+				# The entry's data starts after its local header, whose size depends
+				# on the file name and extra field lengths stored inside it
+				# [Ref] https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT (4.3.7)
+				src.seek(info.header_offset)
+				local_header = src.read(30)
+				(name_length, extra_length) = struct.unpack("<HH", local_header[26:30])
+				src.seek(info.header_offset + 30 + name_length + extra_length)
+
+				# `ZipFile` doesn't have a public API for raw copies, so we do what
+				# `ZipFile.write()` does internally: write the local header and the
+				# data, then register the entry for the central directory
+				new_info = copy.copy(info)
+				new_info.flag_bits &= ~0x08  # No data descriptor after the data
+				new_info.extra = strip_zip64_extra(info.extra)
+				new_info.header_offset = self.zip_file.fp.tell()
+				zip64 = (info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT)
+				self.zip_file.fp.write(new_info.FileHeader(zip64))
+				remaining = info.compress_size
+				while remaining > 0:
+					data = src.read(min(remaining, BUFFER_SIZE))
+					if not data:
+						raise zipfile.BadZipFile(f"Truncated entry '{info.filename}' in '{other_zip_path}'")
+					self.zip_file.fp.write(data)
+					remaining -= len(data)
+				self.zip_file.filelist.append(new_info)
+				self.zip_file.NameToInfo[new_info.filename] = new_info
+				self.zip_file.start_dir = self.zip_file.fp.tell()
+				self.zip_file._didModify = True
+
+	def has_table(self, table_name):
+		return f"{table_name}.csv" in self.zip_file.NameToInfo
+
+	def get_table_size(self, table_name):
+		"""Compressed bytes written so far for the table (including its header);
+		whatever the compressor is still holding on to isn't counted"""
+		entry_name = f"{table_name}.csv"
+		if entry_name in self.zip_file.NameToInfo:
+			return self.zip_file.NameToInfo[entry_name].compress_size
+		if table_name in self.entry_offsets:
+			return self.zip_file.fp.tell() - self.entry_offsets[table_name]
+		return None
+
+	def truncate_table(self, table_name, size):
+		return False
+
+	def remove_table(self, table_name):
+		# Entries can't be removed from a ZIP; failed tables are written to a
+		# separate archive that's simply never merged
+		pass
+
+	def write_file(self, name, text):
+		info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.external_attr = 0o644 << 16
+		self.zip_file.writestr(info, text.encode("utf-8"))
+
+	def close(self):
+		self.zip_file.close()
+
+
+################################################################################
+
+
+# NUMERIC/DECIMAL are stored as scaled integers; when RDB$FIELD_PRECISION is
+# missing (as in databases created by older versions), we assume the most
+# digits the underlying integer can hold
+DEFAULT_PRECISION = {
+	FIELD_TYPE_SMALLINT: 4,
+	FIELD_TYPE_INTEGER: 9,
+	FIELD_TYPE_BIGINT: 18,
+	FIELD_TYPE_QUAD: 18,
+}
+
+
+def get_arrow_type(field_type, sub_type=None, scale=None, precision=None):
+	"""Maps a Firebird column (as described in RDB$FIELDS) to an Arrow type.
+	Anything we don't recognize is written as text"""
+	import pyarrow as pa
+
+	scale = scale or 0
+	if field_type in DEFAULT_PRECISION and scale < 0:
+		return pa.decimal128(precision or DEFAULT_PRECISION[field_type], -scale)
+	if field_type == FIELD_TYPE_SMALLINT:
+		return pa.int16()
+	if field_type == FIELD_TYPE_INTEGER:
+		return pa.int32()
+	if field_type in (FIELD_TYPE_BIGINT, FIELD_TYPE_QUAD):
+		return pa.int64()
+	if field_type == FIELD_TYPE_FLOAT:
+		return pa.float32()
+	# In dialect 1 databases, NUMERIC(15,2) and the like are stored as DOUBLE
+	# (with a scale), and the driver gives us floats for them
+	if field_type in (FIELD_TYPE_DOUBLE, FIELD_TYPE_D_FLOAT):
+		return pa.float64()
+	if field_type == FIELD_TYPE_DATE:
+		return pa.date32()
+	# Firebird stores times with 1/10000s precision, so microseconds fit
+	if field_type == FIELD_TYPE_TIME:
+		return pa.time64("us")
+	if field_type == FIELD_TYPE_TIMESTAMP:
+		return pa.timestamp("us")
+	# BLOB SUB_TYPE 1 is text; every other subtype is binary
+	if field_type == FIELD_TYPE_BLOB and sub_type != 1:
+		return pa.binary()
+	return pa.string()
+
+
+def to_arrow_array(values, arrow_type):
+	import pyarrow as pa
+
+	# The driver already gives us the right Python types for everything but
+	# text and binary columns, which might hold whatever we fell back from
+	if pa.types.is_string(arrow_type):
+		values = [ v if v is None or isinstance(v, str) else str(v) for v in values ]
+	elif pa.types.is_binary(arrow_type):
+		values = [ v.encode("utf-8") if isinstance(v, str) else v for v in values ]
+	return pa.array(values, type=arrow_type)
+
+
+class ParquetTableWriter:
+	"""Writes rows to a Parquet file with one typed column per table column;
+	every call to `write_rows()` becomes a row group, so nothing but the current
+	chunk is ever held in memory. With `transcode` (see `make_transcoder()`),
+	text columns go through it"""
+
+	def __init__(self, file_path, columns, field_types, compression="zstd", transcode=None):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		self.name = file_path
+		self.row_count = 0
+		self.schema = pa.schema([
+			pa.field(column, get_arrow_type(*field_types[column]))
+			if column in field_types
+			else pa.field(column, pa.string())
+			for column in columns
+		])
+		self.writer = pq.ParquetWriter(file_path, self.schema, compression=compression)
+		self.transcoded = set()
+		if transcode is not None:
+			self.transcoded = {
+				i for (i, column) in enumerate(columns)
+				if column in field_types and is_text_field(*field_types[column][:2])
+			}
+		self.transcode = transcode
+
+	def write_rows(self, rows):
+		if not rows:
+			return
+		import pyarrow as pa
+
+		columns = [ list(values) for values in zip(*rows) ]
+		for i in self.transcoded:
+			# The transcoder writes NULLs as '', like the CSVs do; here they stay NULL
+			transcoded = self.transcode(columns[i])
+			columns[i] = [ None if v is None else t for (v, t) in zip(columns[i], transcoded) ]
+		arrays = [
+			to_arrow_array(values, field.type)
+			for (values, field) in zip(columns, self.schema)
+		]
+		self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+		self.row_count += len(rows)
+
+	def flush(self):
+		# Row groups are written as soon as they're complete
+		pass
+
+	def close(self):
+		self.writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+class ParquetDirectoryOutput:
+	"""Writes each table to its own '<table>.parquet' file inside `directory`.
+	`field_types` maps each table name to its columns' Firebird types, as
+	`{ column: (field_type, sub_type, scale, precision) }`; with `transcode`,
+	text columns go through it"""
+
+	# A Parquet file can't be appended to, but a table can be written again;
+	# its columns are typed, so they're written the same whatever their values
+	format = "parquet"
+	can_append = False
+	can_rewrite = True
+	uses_profiles = False
+
+	def __init__(self, directory, field_types, compression="zstd", transcode=None):
+		self.directory = directory
+		self.field_types = field_types
+		self.compression = compression
+		self.transcode = transcode
+
+	def table_path(self, table_name):
+		return os.path.join(self.directory, f"{table_name}.parquet")
+
+	def open_table(self, table_name, columns, append=False, profile=None):
+		if append:
+			raise ValueError("Can't append to an existing Parquet file")
+		os.makedirs(self.directory, exist_ok=True)
+		return ParquetTableWriter(
+			self.table_path(table_name),
+			columns,
+			self.field_types.get(table_name, dict()),
+			compression=self.compression,
+			transcode=self.transcode
+		)
+
+	def has_table(self, table_name):
+		return os.path.isfile(self.table_path(table_name))
+
+	def get_table_size(self, table_name):
+		# Row groups go to the file as they're written, so this grows with them
+		file_path = self.table_path(table_name)
+		return os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+	def truncate_table(self, table_name, size):
+		return False
+
+	def remove_table(self, table_name):
+		file_path = self.table_path(table_name)
+		if os.path.exists(file_path):
+			os.remove(file_path)
+
+	def write_file(self, name, text):
+		"""Writes a file that isn't a table (e.g. a manifest) next to the tables"""
+		os.makedirs(self.directory, exist_ok=True)
+		with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+			f.write(text)
+
+	def close(self):
+		pass
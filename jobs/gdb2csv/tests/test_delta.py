@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+
+import pytest
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_PATH, "..", "benchmarks"))
+sys.path.insert(0, os.path.join(TESTS_PATH, "..", "src"))
+import synthetic  # ../benchmarks/synthetic.py
+# The export talks to the synthetic database instead of a Firebird server
+sys.modules["firebirdsql"] = synthetic
+import delta  # ../src/delta.py
+import export  # ../src/export.py
+
+
+CHUNK_SIZE = 500
+ROWS = 2000
+SERIES = "daily"
+
+
+class TableWithNull(synthetic.SyntheticTable):
+	"""A synthetic table where one row has NULL in its INT_1 column"""
+
+	def __init__(self, *args, null_row=0, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.null_row = null_row
+
+	def get_row(self, i):
+		row = super().get_row(i)
+		if i == self.null_row:
+			return row[:1] + (None,) + row[2:]
+		return row
+
+	def get_column(self, column):
+		values = super().get_column(column)
+		if column == "INT_1":
+			values.append(None)
+		return values
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+	monkeypatch.setattr(export, "log", lambda msg: None)
+	monkeypatch.setattr(export, "is_firebird_ready", lambda timeout=0.5: True)
+	monkeypatch.setattr(delta, "DELTA_PATH", str(tmp_path / "delta"))
+	return tmp_path
+
+
+def run_snapshot(monkeypatch, tmp_path, snapshot, table):
+	"""Exports `table` as the next snapshot of the series, and makes it the one
+	the next snapshot is compared against, like the worker does once it's
+	uploaded. Returns `(manifest, rows written)`"""
+	synthetic.database = synthetic.Database([ table ])
+	workspace = str(tmp_path / snapshot)
+	os.makedirs(workspace, exist_ok=True)
+	open(os.path.join(workspace, f"{snapshot}.gdb"), "ab").close()
+	monkeypatch.setattr(export, "get_workspace", lambda workspace_name="": workspace)
+	export.export(f"{snapshot}.gdb", chunk_size=CHUNK_SIZE, delta=SERIES)
+
+	with open(os.path.join(delta.DELTA_PATH, f"{SERIES}.next.json"), "r", encoding="utf-8") as f:
+		manifest = json.load(f)
+	promoted = dict(manifest, outputs=dict(manifest["outputs"], **{ snapshot: workspace }))
+	with open(os.path.join(delta.DELTA_PATH, f"{SERIES}.json"), "w", encoding="utf-8") as f:
+		json.dump(promoted, f)
+
+	# Nothing is written for a table whose chunks are all reused
+	csv_path = os.path.join(workspace, "csv", "DAILY.csv")
+	if not os.path.exists(csv_path):
+		return (manifest["tables"]["DAILY"], [])
+	with open(csv_path, "r", encoding="utf-8") as f:
+		lines = f.read().splitlines()
+	return (manifest["tables"]["DAILY"], lines[1:])
+
+
+def test_unchanged_chunks_are_reused(environment, monkeypatch):
+	table = synthetic.SyntheticTable("DAILY", ROWS, 3, [ "int", "text" ])
+	run_snapshot(monkeypatch, environment, "day1", table)
+	(manifest, rows) = run_snapshot(monkeypatch, environment, "day2", table)
+	assert manifest["status"] == "reused"
+	assert { chunk["source"] for chunk in manifest["chunks"] } == { "day1" }
+	assert rows == []
+
+
+def test_chunks_are_rewritten_when_formatting_changes(environment, monkeypatch):
+	run_snapshot(monkeypatch, environment, "day1", synthetic.SyntheticTable("DAILY", ROWS, 3, [ "int", "text" ]))
+	# A NULL in the last chunk turns INT_1 into a column of floats ('1.0'), so
+	# the chunks before it, with the same values as before, still change
+	(manifest, rows) = run_snapshot(
+		monkeypatch, environment, "day2", TableWithNull("DAILY", ROWS, 3, [ "int", "text" ], null_row=ROWS - 1)
+	)
+	assert manifest["status"] == "written"
+	assert manifest["profile"]["INT_1"] == { "nulls": True }
+	assert { chunk["source"] for chunk in manifest["chunks"] } == { "day2" }
+	assert len(rows) == ROWS
+	assert rows[0].split(",")[1].endswith(".0")
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+
+import pytest
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_PATH, "..", "benchmarks"))
+sys.path.insert(0, os.path.join(TESTS_PATH, "..", "src"))
+import synthetic  # ../benchmarks/synthetic.py
+# The export talks to the synthetic database instead of a Firebird server
+sys.modules["firebirdsql"] = synthetic
+import export  # ../src/export.py
+
+
+CHUNK_SIZE = 500
+
+
+class Crash(BaseException):
+	"""Stands in for the process dying; nothing in the export catches it"""
+	pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+	synthetic.database = synthetic.Database([
+		synthetic.SyntheticTable("ALPHA", 1200, 4, [ "int", "text", "timestamp" ]),
+		synthetic.SyntheticTable("BETA", 2300, 4, [ "int", "text", "timestamp" ]),
+	])
+	monkeypatch.setattr(export, "log", lambda msg: None)
+	monkeypatch.setattr(export, "is_firebird_ready", lambda timeout=0.5: True)
+	queries = []
+	execute = synthetic.Cursor.execute
+	def record(cursor, query, params=None):
+		queries.append((" ".join(query.split()), params))
+		return execute(cursor, query, params)
+	monkeypatch.setattr(synthetic.Cursor, "execute", record)
+	return queries
+
+
+def run_export(monkeypatch, workspace):
+	os.makedirs(workspace, exist_ok=True)
+	open(os.path.join(workspace, "backup.gdb"), "ab").close()
+	monkeypatch.setattr(export, "get_workspace", lambda workspace_name="": workspace)
+	export.export("backup.gdb", chunk_size=CHUNK_SIZE)
+
+
+def read_outputs(workspace):
+	directory = os.path.join(workspace, "csv")
+	outputs = dict()
+	for filename in sorted(os.listdir(directory)):
+		with open(os.path.join(directory, filename), "rb") as f:
+			outputs[filename] = f.read()
+	return outputs
+
+
+def test_resume_from_partial_checkpoint(tmp_path, monkeypatch, database):
+	queries = database
+	workspace = str(tmp_path / "export")
+
+	# Dies after BETA's first two chunks are written
+	execute = synthetic.Cursor.execute
+	def crash_on_third_chunk(cursor, query, params=None):
+		if re.search(r"FROM BETA WHERE ID > \?", " ".join(query.split())) and int(params[0]) >= 2 * CHUNK_SIZE:
+			raise Crash()
+		return execute(cursor, query, params)
+	monkeypatch.setattr(synthetic.Cursor, "execute", crash_on_third_chunk)
+	with pytest.raises(Crash):
+		run_export(monkeypatch, workspace)
+	monkeypatch.setattr(synthetic.Cursor, "execute", execute)
+
+	# Running it again skips ALPHA, which was done, and continues BETA
+	del queries[:]
+	run_export(monkeypatch, workspace)
+	assert not [ query for (query, _) in queries if "* FROM ALPHA" in query ]
+	beta_chunks = [ params for (query, params) in queries if "* FROM BETA" in query ]
+	assert int(beta_chunks[0][0]) == 2 * CHUNK_SIZE
+
+	# ... and ends up with the same files as an export that never stopped
+	clean_workspace = str(tmp_path / "clean")
+	run_export(monkeypatch, clean_workspace)
+	assert read_outputs(workspace) == read_outputs(clean_workspace)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import writers  # ../src/writers.py
+
+
+FIELD_TYPES = {
+	"ID": (writers.FIELD_TYPE_INTEGER, 0, 0, 0),
+	"NOME": (writers.FIELD_TYPE_VARCHAR, 0, 0, 0),
+	"DATA": (writers.FIELD_TYPE_TIMESTAMP, 0, 0, 0),
+}
+
+
+def write_batches(columns, batches, profile):
+	buffer = io.StringIO()
+	formatters = writers.get_column_formatters(columns, FIELD_TYPES, profile=profile)
+	writer = writers.CsvTableWriter(buffer, "test", columns, formatters=formatters)
+	for batch in batches:
+		writer.write_rows(batch)
+	return buffer.getvalue()
+
+
+def test_int_column_with_null_in_later_batch():
+	# pandas saw the whole table, so the NULL made every value a float
+	output = write_batches(
+		[ "ID", "NOME" ],
+		[ [ (1, "a"), (2, "b") ], [ (None, "c") ] ],
+		{ "ID": { "nulls": True } }
+	)
+	assert output == "ID,NOME\n1.0,a\n2.0,b\n,c\n"
+
+
+def test_int_column_without_nulls():
+	output = write_batches(
+		[ "ID", "NOME" ],
+		[ [ (1, "a"), (2, "b") ], [ (3, "c") ] ],
+		{ "ID": { "nulls": False } }
+	)
+	assert output == "ID,NOME\n1,a\n2,b\n3,c\n"
+
+
+def test_timestamp_precision_from_later_batch():
+	# The first batch alone would be written as dates
+	midnight = datetime.datetime(2024, 1, 1)
+	later = datetime.datetime(2024, 1, 3, 8, 30, 0, 500000)
+	profile = { "DATA": writers.get_timestamp_profile(midnight, later, 1, 1) }
+	output = write_batches(
+		[ "DATA" ],
+		[ [ (midnight,), (midnight + datetime.timedelta(days=1),) ], [ (later,) ] ],
+		profile
+	)
+	assert output == (
+		"DATA\n"
+		"2024-01-01 00:00:00.000\n"
+		"2024-01-02 00:00:00.000\n"
+		"2024-01-03 08:30:00.500\n"
+	)
+
+
+def test_timestamp_profile():
+	low = datetime.datetime(2024, 1, 1)
+	assert writers.get_timestamp_profile(None, None, None, None) == { "timespec": None }
+	assert writers.get_timestamp_profile(datetime.datetime(1500, 1, 1), low, 1, 0) == { "timespec": None }
+	assert writers.get_timestamp_profile(low, low, 0, 0) == { "timespec": "date" }
+	assert writers.get_timestamp_profile(low, low, 1, 0) == { "timespec": "seconds" }
+	assert writers.get_timestamp_profile(low, low, 1, 2) == { "timespec": "microseconds" }
+
+
+def test_parquet_text_is_transcoded(tmp_path):
+	pq = pytest.importorskip("pyarrow.parquet")
+	# What the driver gives us for WIN1252 text, with the connection in ISO8859_1
+	text = "Atenção à saúde €"
+	as_decoded = text.encode("cp1252").decode("iso8859_1")
+	output = writers.ParquetDirectoryOutput(
+		str(tmp_path), { "T": FIELD_TYPES },
+		transcode=writers.make_transcoder("iso8859_1", "cp1252")
+	)
+	with output.open_table("T", [ "ID", "NOME" ]) as writer:
+		writer.write_rows([ (1, as_decoded), (2, None) ])
+	table = pq.read_table(output.table_path("T"))
+	assert table.column("NOME").to_pylist() == [ text, None ]